@@ -13,15 +13,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import re
+from collections import defaultdict
 from logging import getLogger
 
 from .db import select_groups
+from .merge import OutputWriter
 from .merge import create_output_table
 from .merge import group_by_keys
 from .merge import merge_dicts
-from .merge import output_row
 from .norm import smunch
-from .scratch import scratch_tables_with_cols
+from .scratch import get_distinct_values
 from .subsidiary import is_subsidiary
 from .subsidiary import select_company_to_depth
 from .url import match_urls
@@ -32,67 +33,98 @@ log = getLogger(__name__)
 TM_RE = re.compile('(®|\u2120|™)', re.U)
 
 
-def build_brand_table(output_db, scratch_db):
+def build_brand_table(output_db, scratch_db, companies=None):
+    """Build the brand table.
+
+    If *companies* is set, only build rows for brands belonging to those
+    companies, adding them to the existing table (see msd.incremental).
+    """
     log.info('  building brand table')
-    create_output_table(output_db, 'brand')
+    if companies is None:
+        create_output_table(output_db, 'brand')
 
     brand_sql = (
         'SELECT * from brand'
         ' WHERE scraper_id = ? and company = ? and brand = ?')
 
 
-    for (company, brand), scraper_map_rows in select_groups(
-            output_db, 'scraper_brand_map', ['company', 'brand']):
+    with OutputWriter(output_db, 'brand') as brand_writer:
+        for (company, brand), scraper_map_rows in select_groups(
+                output_db, 'scraper_brand_map', ['company', 'brand']):
+
+            if companies is not None and company not in companies:
+                continue
 
-        tms = {''}  # valid values for tm field
-        brand_rows = []  # rows from brand table to merge
+            tms = {''}  # valid values for tm field
+            brand_rows = []  # rows from brand table to merge
 
-        for scraper_map_row in scraper_map_rows:
-            tms.add(split_brand_and_tm(scraper_map_row['scraper_brand'])[1])
+            for scraper_map_row in scraper_map_rows:
+                tms.add(split_brand_and_tm(
+                    scraper_map_row['scraper_brand'])[1])
 
-            for brand_row in scratch_db.execute(
-                    brand_sql, [scraper_map_row['scraper_id'],
-                                scraper_map_row['scraper_company'],
-                                scraper_map_row['scraper_brand']]):
-                brand_rows.append(dict(brand_row))
-                tms.add(split_brand_and_tm(brand_row['tm'])[1])
+                for brand_row in scratch_db.execute(
+                        brand_sql, [scraper_map_row['scraper_id'],
+                                    scraper_map_row['scraper_company'],
+                                    scraper_map_row['scraper_brand']]):
+                    brand_rows.append(dict(brand_row))
+                    tms.add(split_brand_and_tm(brand_row['tm'])[1])
 
-        # build final brand row
-        brand_row = merge_dicts(
-            [dict(company=company, brand=brand)] +
-             match_urls(brand_rows, scratch_db) +
-             brand_rows)
+            # build final brand row
+            brand_row = merge_dicts(
+                [dict(company=company, brand=brand)] +
+                 match_urls(brand_rows, scratch_db) +
+                 brand_rows)
 
-        # make sure we get a valid value for tm
-        brand_row['tm'] = sorted(tms, reverse=True)[0]
+            # make sure we get a valid value for tm
+            brand_row['tm'] = sorted(tms, reverse=True)[0]
 
-        # output it
-        output_row(output_db, 'brand', brand_row)
+            # output it
+            brand_writer.add(brand_row)
 
 
-def build_scraper_brand_map_table(output_db, scratch_db):
+def build_scraper_brand_map_table(output_db, scratch_db, companies=None):
+    """Build the scraper_brand_map table, one corporate family
+    at a time.
+
+    If *companies* is set, only build rows for the families of
+    those companies, adding them to the existing table (see
+    msd.incremental). *companies* should include entire families.
+    """
     log.info('  building scraper_brand_map table')
-    create_output_table(output_db, 'scraper_brand_map')
+    if companies is None:
+        create_output_table(output_db, 'scraper_brand_map')
 
     companies_sql = 'SELECT DISTINCT(company) FROM scraper_company_map'
 
-    for (company,) in output_db.execute(companies_sql):
-        # we'll get to this along with its parent compan(ies)
-        if is_subsidiary(output_db, company):
-            continue
+    sc_to_scraper_brands = load_scraper_brands(scratch_db)
 
-        # either the top-level parent company, or a singleton
-        company_to_depth = select_company_to_depth(output_db, company)
+    with OutputWriter(output_db, 'scraper_brand_map') as map_writer:
+        for (company,) in output_db.execute(companies_sql):
+            if companies is not None and company not in companies:
+                continue
 
-        if not company_to_depth:
-            company_to_depth = {company: 0}
+            # we'll get to this along with its parent compan(ies)
+            if is_subsidiary(output_db, company):
+                continue
 
-        fill_scraper_brand_map_table_for_companies(
-            output_db, scratch_db, company_to_depth)
+            # either the top-level parent company, or a singleton
+            company_to_depth = select_company_to_depth(output_db, company)
+
+            if not company_to_depth:
+                company_to_depth = {company: 0}
+
+            fill_scraper_brand_map_table_for_companies(
+                output_db, sc_to_scraper_brands, company_to_depth,
+                map_writer)
 
 
 def fill_scraper_brand_map_table_for_companies(
-        output_db, scratch_db, company_to_depth):
+        output_db, sc_to_scraper_brands, company_to_depth, map_writer):
+    """Write rows for the given compan(ies) to *map_writer* (an
+    OutputWriter for the scraper_brand_map table).
+
+    *sc_to_scraper_brands* is the return value of load_scraper_brands()
+    """
 
     if not company_to_depth:
         raise ValueError
@@ -116,8 +148,8 @@ def fill_scraper_brand_map_table_for_companies(
     bds = []
 
     for (scraper_id, scraper_company), company in scraper_company_map.items():
-        scraper_brands = select_scraper_brands(
-            scratch_db, scraper_id, scraper_company)
+        scraper_brands = sc_to_scraper_brands.get(
+            (scraper_id, scraper_company), ())
 
         for scraper_brand in scraper_brands:
             brand, _ = split_brand_and_tm(scraper_brand)
@@ -153,26 +185,25 @@ def fill_scraper_brand_map_table_for_companies(
 
         for (scraper_id, scraper_company, scraper_brand
                 ) in bd['scraper_brands']:
-            output_row(output_db, 'scraper_brand_map', dict(
+            map_writer.add(dict(
                 brand=brand,
                 company=company,
                 scraper_id=scraper_id,
                 scraper_brand=scraper_brand,
                 scraper_company=scraper_company,
-        ))
+            ))
 
 
-def select_brands(scratch_db, scraper_companies):
+def select_brands(sc_to_scraper_brands, scraper_companies):
     """Get all possible brand names for the given compan(ies).
 
-    (Like select_scraper_brands(), but for multiple companies, and
-    automatically strips (tm))
+    *sc_to_scraper_brands* is the return value of load_scraper_brands().
+    This automatically strips (tm).
     """
     brands = set()
 
-    for scraper_id, scraper_company in scraper_companies:
-        for scraper_brand in select_scraper_brands(
-                scratch_db, scraper_id, scraper_company):
+    for sc in scraper_companies:
+        for scraper_brand in sc_to_scraper_brands.get(sc, ()):
             brand, _ = split_brand_and_tm(scraper_brand)
             if brand:
                 brands.add(brand)
@@ -180,20 +211,22 @@ def select_brands(scratch_db, scraper_companies):
     return brands
 
 
-def select_scraper_brands(scratch_db, scraper_id, scraper_company):
-    """Select all (scraper) brands for the given scraper company."""
-    scraper_brands = set()
+def load_scraper_brands(scratch_db):
+    """Map each scraper company (a tuple of (scraper_id, company)) to the
+    set of (scraper) brands for it, from any scratch table with a
+    company and brand column.
 
-    for table_name in scratch_tables_with_cols(['company', 'brand']):
-        select_sql = ('SELECT brand FROM `{}`'
-                      ' WHERE scraper_id = ? and company = ?'.format(
-                          table_name))
+    This reads all brands at once, rather than querying each table for
+    each scraper company.
+    """
+    sc_to_scraper_brands = defaultdict(set)
 
-        for row in scratch_db.execute(
-                select_sql, [scraper_id, scraper_company]):
-            scraper_brands.add(row[0])
+    for scraper_id, scraper_company, scraper_brand in get_distinct_values(
+            scratch_db, ['scraper_id', 'company', 'brand']):
+        sc_to_scraper_brands[(scraper_id, scraper_company)].add(
+            scraper_brand)
 
-    return scraper_brands
+    return sc_to_scraper_brands
 
 
 def pick_brand_name(names, company_names=()):
@@ -0,0 +1,217 @@
+# Copyright 2016 SpendRight, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Named LRU caches for functions we call over and over on the same
+arguments, with size limits you can set by name (e.g. from the command
+line) and stats about how well they're doing."""
+from contextlib import contextmanager
+from functools import lru_cache
+from functools import update_wrapper
+from logging import getLogger
+
+# default max number of results a cache remembers
+DEFAULT_CACHE_SIZE = 65536
+
+# keys in the dicts returned by Cache.stats() that only go up (until
+# the cache is cleared), so it makes sense to subtract and add them
+CACHE_COUNTERS = ('hits', 'misses', 'evictions')
+
+log = getLogger(__name__)
+
+# map from name to Cache
+_caches = {}
+
+
+class Cache(object):
+    """Wrap *func* with an LRU cache that remembers up to *maxsize*
+    results (None for unlimited). Call this like you would *func*.
+
+    Like lru_cache(), results are shared between callers, so don't
+    modify them!
+    """
+    def __init__(self, name, func, maxsize=DEFAULT_CACHE_SIZE):
+        self.name = name
+        self.func = func
+        self.set_maxsize(maxsize)
+
+        update_wrapper(self, func)
+
+    def __call__(self, *args):
+        return self._cached_func(*args)
+
+    def set_maxsize(self, maxsize):
+        """Change the max number of results to remember. This also clears
+        the cache and resets its stats."""
+        self.maxsize = maxsize
+        self._cached_func = lru_cache(maxsize)(self.func)
+
+    def clear(self):
+        """Forget all cached results and reset stats."""
+        self._cached_func.cache_clear()
+
+    def stats(self):
+        """Return a dict with the number of cache ``hits``, ``misses``,
+        and ``evictions`` since the cache was last cleared, and its
+        current ``size`` and ``maxsize``."""
+        info = self._cached_func.cache_info()
+
+        # every miss adds a result, and only evictions take them away
+        # (unless maxsize is 0, in which case nothing is ever added)
+        if info.maxsize == 0:
+            evictions = 0
+        else:
+            evictions = info.misses - info.currsize
+
+        return dict(
+            hits=info.hits,
+            misses=info.misses,
+            evictions=evictions,
+            size=info.currsize,
+            maxsize=info.maxsize,
+        )
+
+
+def cached(name, maxsize=DEFAULT_CACHE_SIZE):
+    """Decorator that wraps a function in a Cache, and registers it
+    under *name* so that set_cache_sizes() etc. can find it."""
+    def decorator(func):
+        return register_cache(Cache(name, func, maxsize))
+
+    return decorator
+
+
+def register_cache(cache):
+    """Register *cache* under its name, and return it."""
+    if cache.name in _caches:
+        raise ValueError('there is already a cache named {}'.format(
+            cache.name))
+
+    _caches[cache.name] = cache
+    return cache
+
+
+def get_cache(name):
+    """Get the cache with the given name. Raises KeyError if there isn't
+    one."""
+    return _caches[name]
+
+
+def show_caches():
+    """List the names of all caches."""
+    return sorted(_caches)
+
+
+def set_cache_sizes(sizes):
+    """Set the max size of caches from a map from cache name to max size
+    (None for unlimited). This clears those caches.
+
+    Raises ValueError if any name isn't the name of a cache.
+    """
+    unknown = sorted(set(sizes) - set(_caches))
+    if unknown:
+        raise ValueError('unknown cache(s): {} (known caches: {})'.format(
+            ', '.join(unknown), ', '.join(show_caches())))
+
+    for name, maxsize in sorted(sizes.items()):
+        _caches[name].set_maxsize(maxsize)
+
+
+def parse_cache_size(s):
+    """Parse a string like ``NAME=SIZE`` into a tuple of (name, size).
+    SIZE can be ``none`` for unlimited."""
+    name, sep, size = s.partition('=')
+
+    if not (name and sep):
+        raise ValueError('expected NAME=SIZE, not {!r}'.format(s))
+
+    if size.lower() == 'none':
+        return name, None
+
+    size = int(size)
+    if size < 0:
+        raise ValueError('cache size must not be negative')
+
+    return name, size
+
+
+def clear_caches():
+    """Forget everything every cache remembers, and reset their stats.
+    Call this between builds in a long-lived process."""
+    for cache in _caches.values():
+        cache.clear()
+
+
+def cache_stats():
+    """Return a map from cache name to its stats (see Cache.stats())."""
+    return dict((name, cache.stats()) for name, cache in _caches.items())
+
+
+def diff_cache_stats(before, after):
+    """Given the output of cache_stats() at two different times, return
+    a map from cache name to how much its counters (see CACHE_COUNTERS)
+    went up, for caches that were used at all."""
+    diff = {}
+
+    for name, stats in sorted(after.items()):
+        counters = dict(
+            (k, stats[k] - before.get(name, {}).get(k, 0))
+            for k in CACHE_COUNTERS)
+        if any(counters.values()):
+            diff[name] = counters
+
+    return diff
+
+
+@contextmanager
+def record_cache_stats(record):
+    """Set record['caches'] to how much each cache was used inside this
+    context manager (see diff_cache_stats()). *record* is usually
+    a stage record from msd.report.stage()."""
+    before = cache_stats()
+
+    yield record
+
+    record['caches'] = diff_cache_stats(before, cache_stats())
+
+
+def sum_cache_stats(records):
+    """Add up the 'caches' field (see diff_cache_stats()) of stage
+    records (see msd.report), including those from worker processes.
+
+    Returns a map from cache name to counters for every cache, with its
+    maxsize in this process.
+    """
+    totals = {}
+
+    for name, cache in sorted(_caches.items()):
+        totals[name] = dict((k, 0) for k in CACHE_COUNTERS)
+        totals[name]['maxsize'] = cache.maxsize
+
+    for record in records:
+        for name, counters in record.get('caches', {}).items():
+            for k in CACHE_COUNTERS:
+                totals[name][k] += counters[k]
+
+    return totals
+
+
+def log_cache_stats(totals):
+    """Log output of sum_cache_stats(), skipping unused caches."""
+    for name, stats in sorted(totals.items()):
+        if not (stats['hits'] or stats['misses']):
+            continue
+
+        log.info('  {} cache: {:d} hits, {:d} misses, {:d} evictions'
+                 ' (max size {})'.format(
+                     name, stats['hits'], stats['misses'],
+                     stats['evictions'], stats.get('maxsize')))
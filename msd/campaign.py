@@ -14,9 +14,9 @@
 from logging import getLogger
 
 from .db import select_groups
+from .merge import OutputWriter
 from .merge import create_output_table
 from .merge import merge_dicts
-from .merge import output_row
 from .url import match_urls
 
 log = getLogger(__name__)
@@ -26,11 +26,12 @@ def build_campaign_table(output_db, scratch_db):
     log.info('  building campaign table')
     create_output_table(output_db, 'campaign')
 
-    for (campaign_id,), rows in select_groups(
-            scratch_db, 'campaign', ['campaign_id']):
+    with OutputWriter(output_db, 'campaign') as campaign_writer:
+        for (campaign_id,), rows in select_groups(
+                scratch_db, 'campaign', ['campaign_id']):
 
-        if not campaign_id:
-            continue
+            if not campaign_id:
+                continue
 
-        campaign_row = merge_dicts(rows + match_urls(rows, scratch_db))
-        output_row(output_db, 'campaign', campaign_row)
+            campaign_row = merge_dicts(rows + match_urls(rows, scratch_db))
+            campaign_writer.add(campaign_row)
@@ -20,8 +20,8 @@ from .category_data import USELESS_CATEGORY_SUFFIXES
 from .category_data import CATEGORY_ALIASES
 from .category_data import CATEGORY_SPLITS
 from .db import select_groups
+from .merge import OutputWriter
 from .merge import create_output_table
-from .merge import output_row
 from .norm import simplify_whitespace
 from .norm import to_title_case
 from .scratch import get_distinct_values
@@ -33,30 +33,38 @@ log = getLogger(__name__)
 CATEGORY_SPLIT_RE = re.compile(r',?\s+and\s+|,\s+|\.\s+|\s*/\s*')
 
 
-def build_category_table(output_db, scratch_db):
+def build_category_table(output_db, scratch_db, companies=None):
+    """Build the category table.
+
+    If *companies* is set, only build rows for those companies (and
+    their brands), adding them to the existing table (see
+    msd.incremental).
+    """
     log.info('  building category table')
-    create_output_table(output_db, 'category')
-
-    for (company, brand), _, category_rows in select_groups_by_target(
-            output_db, scratch_db, 'category'):
-
-        # map categories from rows
-        categories = set()
-        for category_row in category_rows:
-            category = map_category(output_db,
-                                    category_row['scraper_id'],
-                                    category_row['category'])
-            if category:
-                categories.add(category)
-
-        implied_categories = get_implied_categories(output_db, categories)
-
-        for category in sorted(categories | implied_categories):
-            output_row(output_db, 'category', dict(
-                company=company,
-                brand=brand,
-                category=category,
-                is_implied=category not in categories))
+    if companies is None:
+        create_output_table(output_db, 'category')
+
+    with OutputWriter(output_db, 'category') as category_writer:
+        for (company, brand), _, category_rows in select_groups_by_target(
+                output_db, scratch_db, 'category', companies=companies):
+
+            # map categories from rows
+            categories = set()
+            for category_row in category_rows:
+                category = map_category(output_db,
+                                        category_row['scraper_id'],
+                                        category_row['category'])
+                if category:
+                    categories.add(category)
+
+            implied_categories = get_implied_categories(output_db, categories)
+
+            for category in sorted(categories | implied_categories):
+                category_writer.add(dict(
+                    company=company,
+                    brand=brand,
+                    category=category,
+                    is_implied=category not in categories))
 
 
 def build_scraper_category_map_table(output_db, scratch_db):
@@ -68,17 +76,18 @@ def build_scraper_category_map_table(output_db, scratch_db):
         get_distinct_values(scratch_db, ['scraper_id', 'category']) |
         get_distinct_values(scratch_db, ['scraper_id', 'subcategory']))
 
-    for scraper_id, scraper_category in scraper_cats:
-        # derive canonical category from scraper category
-        category = fix_category(scraper_category)
-        if not category:
-            continue
+    with OutputWriter(output_db, 'scraper_category_map') as map_writer:
+        for scraper_id, scraper_category in scraper_cats:
+            # derive canonical category from scraper category
+            category = fix_category(scraper_category)
+            if not category:
+                continue
 
-        # output mapping
-        output_row(output_db, 'scraper_category_map', dict(
-            category=category,
-            scraper_category=scraper_category,
-            scraper_id=scraper_id))
+            # output mapping
+            map_writer.add(dict(
+                category=category,
+                scraper_category=scraper_category,
+                scraper_id=scraper_id))
 
 
 def build_subcategory_table(output_db, scratch_db):
@@ -115,13 +124,14 @@ def build_subcategory_table(output_db, scratch_db):
     cat_to_ancestors = _imply_category_ancestors(cat_to_subcats)
 
     # output rows
-    for cat, ancestors in sorted(cat_to_ancestors.items()):
-        for ancestor in sorted(ancestors):
-            subcat_row = {'category': ancestor, 'subcategory': cat}
-            if (ancestor, cat) not in direct_subcategories:
-                subcat_row['is_implied'] = 1
-
-            output_row(output_db, 'subcategory', subcat_row)
+    with OutputWriter(output_db, 'subcategory') as subcategory_writer:
+        for cat, ancestors in sorted(cat_to_ancestors.items()):
+            for ancestor in sorted(ancestors):
+                subcat_row = {'category': ancestor, 'subcategory': cat}
+                if (ancestor, cat) not in direct_subcategories:
+                    subcat_row['is_implied'] = 1
+
+                subcategory_writer.add(subcat_row)
 
 
 def _imply_category_ancestors(cat_to_subcats):
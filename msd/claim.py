@@ -13,33 +13,42 @@
 # limitations under the License.
 from logging import getLogger
 
+from .merge import OutputWriter
 from .merge import create_output_table
 from .merge import merge_dicts
-from .merge import output_row
 from .rating import fix_judgment
 from .target import select_groups_by_target
 
 log = getLogger(__name__)
 
 
-def build_claim_table(output_db, scratch_db):
+def build_claim_table(output_db, scratch_db, companies=None):
+    """Build the claim table.
+
+    If *companies* is set, only build rows for those companies (and
+    their brands), adding them to the existing table (see
+    msd.incremental).
+    """
     log.info('  building claim table')
-    create_output_table(output_db, 'claim')
+    if companies is None:
+        create_output_table(output_db, 'claim')
 
-    # slice by target
-    for (company, brand), (campaign_id, claim), claim_rows in \
-        select_groups_by_target(
-            output_db, scratch_db, 'claim', ['campaign_id', 'claim']):
+    with OutputWriter(output_db, 'claim') as claim_writer:
+        # slice by target
+        for (company, brand), (campaign_id, claim), claim_rows in \
+            select_groups_by_target(
+                output_db, scratch_db, 'claim', ['campaign_id', 'claim'],
+                companies=companies):
 
-        if not (campaign_id and claim):
-            continue
+            if not (campaign_id and claim):
+                continue
 
-        claim_row = merge_dicts(claim_rows)
-        claim_row['company'] = company
-        claim_row['brand'] = brand
-        claim_row['judgment'] = fix_judgment(claim_row['judgment'])
+            claim_row = merge_dicts(claim_rows)
+            claim_row['company'] = company
+            claim_row['brand'] = brand
+            claim_row['judgment'] = fix_judgment(claim_row['judgment'])
 
-        if claim_row['judgment'] is None:
-            continue
+            if claim_row['judgment'] is None:
+                continue
 
-        output_row(output_db, 'claim', claim_row)
+            claim_writer.add(claim_row)
@@ -15,7 +15,21 @@ import logging
 from argparse import ArgumentParser
 
 import msd
+from msd.cache import clear_caches
+from msd.cache import log_cache_stats
+from msd.cache import parse_cache_size
+from msd.cache import set_cache_sizes
+from msd.cache import show_caches
+from msd.cache import sum_cache_stats
+from msd.company import DEFAULT_MAX_COMPANY_KEY_FREQ
+from msd.company import set_max_company_key_freq
+from msd.db import BUILD_PROFILES
+from msd.db import DEFAULT_BUILD_PROFILE
 from msd.output import build_output_db
+from msd.report import clear_stages
+from msd.report import get_report_path
+from msd.report import get_stages
+from msd.report import write_report
 from msd.scratch import build_scratch_db
 
 DEFAULT_SCRATCH_DB = 'msd-scratch.sqlite'
@@ -34,17 +48,54 @@ def main(args=None):
     set_up_logging(verbose=opts.verbose, quiet=opts.quiet)
 
     run(input_db_paths=opts.input_dbs, scratch_db_path=opts.scratch_db,
-        output_db_path=opts.output_db)
+        output_db_path=opts.output_db, force_rebuild_scratch=opts.force,
+        cache_sizes=dict(opts.cache_sizes),
+        jobs=opts.jobs, memory_budget=opts.memory_budget * 2**20,
+        profile=opts.profile, incremental=opts.incremental,
+        max_company_key_freq=opts.max_company_key_freq,
+        resume=opts.resume)
 
 
 def run(*,
+        cache_sizes=None,
+        force_rebuild_scratch=False,
+        incremental=False,
         input_db_paths=(),
+        jobs=1,
+        max_company_key_freq=DEFAULT_MAX_COMPANY_KEY_FREQ,
+        memory_budget=0,
         output_db_path=DEFAULT_OUTPUT_DB,
+        profile=DEFAULT_BUILD_PROFILE,
+        resume=False,
         scratch_db_path=DEFAULT_SCRATCH_DB):
 
-    build_scratch_db(scratch_db_path, input_db_paths)
+    clear_stages()
 
-    build_output_db(scratch_db_path, output_db_path)
+    # don't let a previous build in this process skew cache stats, and
+    # apply sizes before forking any worker processes
+    clear_caches()
+    if cache_sizes:
+        set_cache_sizes(cache_sizes)
+
+    # output builders (including worker processes) read this
+    set_max_company_key_freq(max_company_key_freq)
+
+    build_scratch_db(scratch_db_path, input_db_paths,
+                     force=force_rebuild_scratch, jobs=jobs,
+                     keep_previous=incremental, memory_budget=memory_budget,
+                     profile=profile)
+
+    build_output_db(scratch_db_path, output_db_path, jobs=jobs,
+                    memory_budget=memory_budget, profile=profile,
+                    incremental=incremental, resume=resume)
+
+    log.info('cache stats:')
+    log_cache_stats(sum_cache_stats(get_stages()))
+
+    # timings and row counts for each stage of the build
+    report_path = get_report_path(output_db_path)
+    log.info('writing build report to {}'.format(report_path))
+    write_report(report_path)
 
 
 def set_up_logging(*, verbose=False, quiet=False):
@@ -60,16 +111,57 @@ def parse_args(args=None):
     parser = ArgumentParser()
     parser.add_argument(
         dest='input_dbs', nargs='*',
-        help='SQLite databases and/or YAML database dumps to merge')
+        help='SQLite databases, YAML database dumps, and/or directories'
+        ' of CSV/JSON Lines table files to merge')
     parser.add_argument(
         '-v', '--verbose', dest='verbose', default=False, action='store_true',
         help='Enable debug logging')
     parser.add_argument(
         '-q', '--quiet', dest='quiet', default=False, action='store_true',
         help='Turn off info logging')
+    parser.add_argument(
+        '-c', '--cache-size', dest='cache_sizes', default=[],
+        action='append', type=parse_cache_size, metavar='NAME=SIZE',
+        help='Max number of results the named cache (e.g. company_keys)'
+        ' remembers, or "none" for no limit. May be repeated')
     parser.add_argument(
         '-f', '--force', dest='force', default=False, action='store_true',
-        help='Does nothing (scratch DB is always rebuilt)')
+        help='Rebuild the scratch DB from scratch, rather than only'
+        ' reloading inputs that have changed')
+    parser.add_argument(
+        '-I', '--incremental', dest='incremental', default=False,
+        action='store_true',
+        help='Update the existing output DB, only rebuilding rows for'
+        ' corporate families whose data changed (falls back to a full'
+        ' build if it can\'t)')
+    parser.add_argument(
+        '-j', '--jobs', dest='jobs', default=1, type=int,
+        help='Number of processes to use to load input DBs and build'
+        ' output tables. DBs have the same rows no matter what JOBS is,'
+        ' but are only byte-for-byte identical for JOBS > 1 (default:'
+        ' %(default)s)')
+    parser.add_argument(
+        '-k', '--max-company-key-freq', dest='max_company_key_freq',
+        default=DEFAULT_MAX_COMPANY_KEY_FREQ, type=int, metavar='N',
+        help="Don't group company names by variants (e.g. without"
+        ' punctuation) that more than this many company names share; 0'
+        ' means no limit (default: %(default)s)')
+    parser.add_argument(
+        '-m', '--memory-budget', dest='memory_budget', default=0, type=int,
+        metavar='MIB',
+        help='Build the scratch and output DBs in memory if they fit in'
+        ' this many MiB, and write them to disk when done (default: build'
+        ' on disk)')
+    parser.add_argument(
+        '-p', '--profile', dest='profile', default=DEFAULT_BUILD_PROFILE,
+        choices=sorted(BUILD_PROFILES),
+        help='Which SQLite PRAGMAs to use while building the scratch and'
+        ' output DBs (default: %(default)s)')
+    parser.add_argument(
+        '-r', '--resume', dest='resume', default=False, action='store_true',
+        help='If the last output build stopped partway through, reuse the'
+        ' output tables it finished (if the scratch DB is unchanged). Only'
+        ' builds run with --resume or --jobs can be resumed')
     parser.add_argument(
         '-i', '--scratch', dest='scratch_db',
         default=DEFAULT_SCRATCH_DB,
@@ -81,7 +173,14 @@ def parse_args(args=None):
         '-V', '--version', dest='version', default=False,
         action='store_true', help='Print version and exit')
 
-    return parser.parse_args(args)
+    opts = parser.parse_args(args)
+
+    for name, _ in opts.cache_sizes:
+        if name not in show_caches():
+            parser.error('unknown cache: {} (choose from {})'.format(
+                name, ', '.join(show_caches())))
+
+    return opts
 
 
 
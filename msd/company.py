@@ -12,70 +12,146 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import re
+from collections import Counter
 from collections import defaultdict
-from functools import lru_cache
+from heapq import heappush
+from heapq import heappushpop
+from itertools import groupby
 from logging import getLogger
+from time import perf_counter
 
+from .cache import cached
 from .company_data import COMPANY_ALIAS_REGEXES
 from .company_data import COMPANY_NAME_REGEXES
 from .company_data import COMPANY_TYPE_CORRECTIONS
 from .company_data import COMPANY_TYPE_RE
 from .company_data import UNSTRIPPABLE_COMPANY_TYPES
-from .db import select_groups
+from .merge import OutputWriter
 from .merge import create_output_table
 from .merge import group_by_keys
 from .merge import merge_dicts
-from .merge import output_row
 from .norm import norm
 from .norm import simplify_whitespace
+from .report import stage
+from .schema import get_schema
 from .scratch import get_distinct_values
 from .url import match_urls
 
 log = getLogger(__name__)
 
+# variant keys (see group_company_dicts()) that more than this many
+# company dicts have are too generic to group company names by; they
+# tend to chain unrelated companies together. 0 means no limit
+DEFAULT_MAX_COMPANY_KEY_FREQ = 1000
+
+MAX_COMPANY_KEY_FREQ = DEFAULT_MAX_COMPANY_KEY_FREQ
+
+# how many of the biggest groups of company names, and of the keys
+# that hold each together, to describe in the build report
+NUM_LARGEST_COMPANY_GROUPS = 10
+NUM_BRIDGING_KEYS = 5
+
+# how many aliases to remember the keys for (see get_company_keys())
+COMPANY_KEYS_CACHE_SIZE = 2 ** 16
+
 
 # use this to turn e.g. "babyGap" into "baby Gap" for matching
 # this can also turn "G.I. Joe" into "G. I. Joe"
-CAMEL_CASE_RE = re.compile('(?<=[a-z\.])(?=[A-Z])')
+CAMEL_CASE_RE = re.compile(r'(?<=[a-z\.])(?=[A-Z])')
+
 
+def build_company_table(output_db, scratch_db, companies=None):
+    """Build the company table.
 
-def build_company_table(output_db, scratch_db):
+    If *companies* is set, only build rows for those (canonical)
+    companies, adding them to the existing table (see msd.incremental).
+    """
     log.info('  building company table')
-    create_output_table(output_db, 'company')
+    if companies is None:
+        create_output_table(output_db, 'company')
 
-    company_sql = (
-        'SELECT * from company WHERE scraper_id = ? and company = ?')
+    # rather than querying the scratch and output DBs for each company,
+    # read company rows and full names in company order, one pass each
+    full_names = _select_company_full_names(output_db)
+    full_name_row = next(full_names, None)
 
-    company_full_sql = (
-        'SELECT company_name FROM company_name WHERE company = ?'
-        ' AND is_full = 1')
+    with OutputWriter(output_db, 'company') as company_writer:
+        for company, company_rows in _select_company_rows_by_company(
+                output_db, scratch_db, companies):
 
-    for (company,), scraper_map_rows in select_groups(
-            output_db, 'scraper_company_map', ['company']):
-        company_rows = []
+            # get full company name from the company_name table we built
+            while full_name_row is not None and full_name_row[0] < company:
+                full_name_row = next(full_names, None)
 
-        # get company rows from each scraper
-        for scraper_map_row in scraper_map_rows:
-            scraper_id = scraper_map_row['scraper_id']
-            scraper_company = scraper_map_row['scraper_company']
+            company_full = None
+            if full_name_row is not None and full_name_row[0] == company:
+                company_full = full_name_row[1]
 
-            company_rows.extend(
-                dict(row) for row in
-                scratch_db.execute(
-                    company_sql, [scraper_id, scraper_company]))
+            # build final company row
+            company_row = merge_dicts(
+                [dict(company=company, company_full=company_full)] +
+                match_urls(company_rows, scratch_db) +
+                company_rows)
 
-        # get full company name from the company_name table we built
-        company_full = list(output_db.execute(
-            company_full_sql, [company]))[0][0]
+            # output it
+            company_writer.add(company_row)
 
-        # build final company row
-        company_row = merge_dicts(
-            [dict(company=company, company_full=company_full)] +
-            match_urls(company_rows, scratch_db) +
-            company_rows)
 
-        # output it
-        output_row(output_db, 'company', company_row)
+def _select_company_rows_by_company(output_db, scratch_db, companies=None):
+    """Yield (company, company_rows) for each (canonical) company in
+    scraper_company_map, in order, where company_rows is a list of
+    company rows (as dicts) from the scratch DB for every scraper company
+    it maps to.
+
+    If *companies* is set, skip other companies.
+
+    We do this by copying scraper_company_map into a temp table in
+    the scratch DB, and joining it against the company table.
+    """
+    scratch_db.execute(
+        'CREATE TEMP TABLE company_map (seq integer PRIMARY KEY,'
+        ' company text, scraper_id text, scraper_company text)')
+
+    # closed before we drop company_map, in case the caller stops early
+    cursor = scratch_db.cursor()
+    try:
+        # seq is the order we build company rows in
+        with scratch_db:
+            scratch_db.executemany(
+                'INSERT INTO temp.company_map'
+                ' (company, scraper_id, scraper_company) VALUES (?, ?, ?)',
+                (tuple(row) for row in output_db.execute(
+                    'SELECT company, scraper_id, scraper_company'
+                    ' FROM scraper_company_map ORDER BY company, rowid')
+                 if companies is None or row[0] in companies))
+
+        col_names = get_schema('company').scratch_col_names
+
+        # c.rowid is NULL for scraper companies with no company rows
+        join_sql = (
+            'SELECT m.company, c.rowid, {} FROM temp.company_map AS m'
+            ' LEFT JOIN company AS c ON c.scraper_id = m.scraper_id'
+            ' AND c.company = m.scraper_company'
+            ' ORDER BY m.seq, c.rowid'.format(
+                ', '.join('c.`{}`'.format(c) for c in col_names)))
+
+        for company, rows in groupby(
+                cursor.execute(join_sql), key=lambda row: row[0]):
+            yield company, [dict(zip(col_names, row[2:]))
+                            for row in rows if row[1] is not None]
+    finally:
+        cursor.close()
+
+        with scratch_db:
+            scratch_db.execute('DROP TABLE temp.company_map')
+
+
+def _select_company_full_names(output_db):
+    """Select (company, company_name) for each name tagged is_full
+    in the company_name table, in company order (one per company)."""
+    return output_db.execute(
+        'SELECT company, company_name FROM company_name WHERE is_full = 1'
+        ' ORDER BY company, company_name')
 
 
 def build_company_name_and_scraper_company_map_tables(output_db, scratch_db):
@@ -83,11 +159,40 @@ def build_company_name_and_scraper_company_map_tables(output_db, scratch_db):
     create_output_table(output_db, 'scraper_company_map')
     create_output_table(output_db, 'company_name')
 
-    # company dicts ("cds") containing the following sets:
-    #
-    # names: possible company names
-    # aliases: name variants usable for matching (should include *names*)
-    # scraper_companies: tuples of (scraper_id, scraper_company)
+    company_dicts = load_company_dicts(scratch_db)
+
+    with stage('cluster_company_names') as record:
+        stats = {}
+
+        write_company_groups(
+            output_db, company_dicts,
+            group_company_dicts(company_dicts['cds'], stats=stats),
+            stats=stats)
+
+        record['rows_in'] = len(company_dicts['cds'])
+        record['rows_out'] = stats['num_groups']
+        record.update(describe_company_groups(stats))
+
+
+def load_company_dicts(scratch_db):
+    """Load everything we need to cluster company names from the
+    scratch DB. Returns a dict containing:
+
+    cds: list of company dicts ("cds") containing the following sets:
+         names: possible company names
+         aliases: name variants usable for matching (should include *names*)
+         scraper_companies: tuples of (scraper_id, scraper_company)
+    invariant_names: set of names that we shouldn't build variants of
+    sc_to_bad: map from scraper company to names it shouldn't be called
+    cn_sc_to_full: map from scraper company to names tagged is_full
+        in the company_name table
+    cf_sc_to_full: map from scraper company to values of company_full
+    sc_to_scraper_brands: map from scraper company to (scraper) brands
+        (see msd.brand.load_scraper_brands())
+    """
+    # avoid circular import
+    from .brand import load_scraper_brands
+
     cds = []
 
     cn_cds, invariant_names, sc_to_bad, cn_sc_to_full = (
@@ -123,73 +228,297 @@ def build_company_name_and_scraper_company_map_tables(output_db, scratch_db):
 
         cf_sc_to_full[(scraper_id, company)].add(company_full)
 
-    # group together by normed variants of aliases
-    def keyfunc(cd):
-        keys = set()
-        for alias in cd['aliases']:
-            keys.update(get_company_keys(alias))
-        return keys
+    return dict(
+        cds=cds,
+        invariant_names=invariant_names,
+        sc_to_bad=sc_to_bad,
+        cn_sc_to_full=cn_sc_to_full,
+        cf_sc_to_full=cf_sc_to_full,
+        sc_to_scraper_brands=load_scraper_brands(scratch_db),
+    )
 
-    # there are lots of these, so show progress
-    for cd_group in group_by_keys(cds, keyfunc):
-        cd = merge_dicts(cd_group)
 
-        if not cd['scraper_companies']:
-            # this shouldn't happen now; used to happen with
-            # hard-coded corrections
-            continue
+def set_max_company_key_freq(max_key_freq):
+    """Set the maximum number of company dicts that can share a variant
+    key before we stop grouping by it (see group_company_dicts()). 0
+    means no limit."""
+    global MAX_COMPANY_KEY_FREQ
+    MAX_COMPANY_KEY_FREQ = max_key_freq
 
-        # promote aliases to display names if they match a brand
-        from .brand import select_brands
 
-        brands = select_brands(scratch_db, cd['scraper_companies'])
-        normed_brands = {norm(b) for b in brands}
-        brand_names = {a for a in cd['aliases'] if norm(a) in normed_brands}
+def get_max_company_key_freq():
+    """Get the current maximum (see set_max_company_key_freq())."""
+    return MAX_COMPANY_KEY_FREQ
 
-        # look up all scraper companies in a map from scraper company to
-        # set, and merge those all into one big set
-        def get_names(sc_to_x):
-            return {n for sc in cd['scraper_companies'] for n in sc_to_x[sc]}
 
-        # exclude names marked as alias-only
-        bad_names = get_names(sc_to_bad)
-        names = (cd['names'] | brand_names) - bad_names
+def group_company_dicts(cds, stats=None):
+    """Group together company dicts by normed variants of aliases.
+    Yields lists of company dicts.
 
-        if not names:
-            # could happen if only name was flagged as is_alias?
-            continue
+    Keys that are normed aliases are always used. Other variants (e.g.
+    with punctuation removed) that more than MAX_COMPANY_KEY_FREQ company
+    dicts have are ignored. (Any name we might pick for a company is
+    one of its aliases, so this can't split company dicts that would
+    get the same name into different groups.)
+
+    If *stats* is a dict, fill it with:
+    key_freq: map from key to number of company dicts that have it
+    dropped_keys: set of variants we ignored
+    """
+    cds_and_keys = []
+    key_freq = Counter()
+    variant_freq = Counter()
+
+    for cd in cds:
+        alias_keys, variant_keys = _company_dict_keys(cd)
+        cds_and_keys.append((cd, alias_keys, variant_keys))
+        key_freq.update(alias_keys | variant_keys)
+        variant_freq.update(variant_keys)
+
+    dropped_keys = set()
+    if MAX_COMPANY_KEY_FREQ:
+        dropped_keys = {k for k, freq in variant_freq.items()
+                        if freq > MAX_COMPANY_KEY_FREQ}
+
+    def keyfunc(cd_and_keys):
+        _, alias_keys, variant_keys = cd_and_keys
+        return alias_keys | (variant_keys - dropped_keys)
+
+    if stats is not None:
+        stats['dropped_keys'] = dropped_keys
+        stats['key_freq'] = key_freq
+
+    for group in group_by_keys(cds_and_keys, keyfunc):
+        yield [cd for cd, _, _ in group]
+
+
+def _count_key_merges(cds, dropped_keys):
+    """Count how many groups of company dicts that share normed aliases
+    each variant joins together, minus one (i.e. how much it "bridges"
+    them; see group_company_dicts()).
+
+    Groups that share normed aliases never span more than one group from
+    group_company_dicts(), so you can call this on just one of those.
+    """
+    cds_and_keys = [(cd,) + _company_dict_keys(cd) for cd in cds]
+    alias_group_ids = {}
+
+    for i, group in enumerate(group_by_keys(
+            cds_and_keys, lambda cd_and_keys: cd_and_keys[1])):
+        for cd, _, _ in group:
+            alias_group_ids[id(cd)] = i
+
+    key_to_alias_groups = defaultdict(set)
+
+    # (keys that are only ever normed aliases can't join groups)
+    for cd, alias_keys, variant_keys in cds_and_keys:
+        # company dicts with no normed aliases are a group of their own
+        alias_group_id = alias_group_ids.get(id(cd), ('cd', id(cd)))
+
+        for k in (alias_keys | variant_keys) - dropped_keys:
+            key_to_alias_groups[k].add(alias_group_id)
+
+    return Counter({k: len(group_ids) - 1 for k, group_ids in
+                    key_to_alias_groups.items() if len(group_ids) > 1})
+
+
+def select_company_dicts_with_keys(cds, keys):
+    """Yield the company dicts in *cds* that have any of the given keys
+    (see group_company_dicts())."""
+    keys = set(keys)
+
+    for cd in cds:
+        alias_keys, variant_keys = _company_dict_keys(cd)
+        if not (keys.isdisjoint(alias_keys) and
+                keys.isdisjoint(variant_keys)):
+            yield cd
 
-        # pick company name and full name
-        company = pick_company_name(names)
 
-        # pick full name. prioritize names marked is_full in company_name
-        # table, then names in company_full field, then other names
-        full_names = (get_names(cn_sc_to_full) or
-                      get_names(cf_sc_to_full) or
-                      names)
-        company_full = pick_company_full(full_names)
+def _company_dict_keys(cd):
+    """Return a set of normed aliases for the given company dict, and a
+    set of any other keys for them (see get_company_keys())."""
+    alias_keys = set()
+    variant_keys = set()
 
-        # write to scraper_company_map
-        for scraper_id, scraper_company in sorted(cd['scraper_companies']):
-            output_row(output_db, 'scraper_company_map', dict(
-                company=company,
-                scraper_id=scraper_id,
-                scraper_company=scraper_company))
+    for alias in cd['aliases']:
+        keys = get_company_keys(alias)
 
-        # write to company_name
+        alias_key = simplify_whitespace(norm(alias))
+        if alias_key in keys:
+            alias_keys.add(alias_key)
 
-        # company and company_full should always be in cd; just hedging
-        company_names = cd['names'] | cd['aliases'] | {company, company_full}
+        variant_keys.update(keys)
 
-        for company_name in company_names:
-            row = dict(company=company, company_name=company_name)
+    return alias_keys, variant_keys - alias_keys
 
-            if company_name == company_full:
-                row['is_full'] = 1
-            elif company_name not in names:
-                row['is_alias'] = 1
 
-            output_row(output_db, 'company_name', row)
+def write_company_groups(output_db, company_dicts, cd_groups, stats=None):
+    """Pick a name for each group of company dicts (see
+    group_company_dicts()) and write it to the scraper_company_map and
+    company_name tables.
+
+    If *stats* is a dict, set num_groups, and add largest_groups,
+    a list of the NUM_LARGEST_COMPANY_GROUPS largest groups, as dicts
+    with the keys company, cds, and time (seconds spent on that group).
+
+    Returns the set of company names written.
+    """
+    companies = set()
+
+    num_groups = 0
+
+    # heap of (size, -index, group dict)
+    largest_groups = []
+
+    sc_to_bad = company_dicts['sc_to_bad']
+    cn_sc_to_full = company_dicts['cn_sc_to_full']
+    cf_sc_to_full = company_dicts['cf_sc_to_full']
+    sc_to_scraper_brands = company_dicts['sc_to_scraper_brands']
+
+    # avoid circular import
+    from .brand import select_brands
+
+    with OutputWriter(output_db, 'scraper_company_map') as map_writer, \
+            OutputWriter(output_db, 'company_name') as name_writer:
+        # there are lots of these, so show progress
+        for cd_group in cd_groups:
+            start = perf_counter()
+            num_groups += 1
+
+            cd = merge_dicts(cd_group)
+
+            if not cd['scraper_companies']:
+                # this shouldn't happen now; used to happen with
+                # hard-coded corrections
+                continue
+
+            # promote aliases to display names if they match a brand
+            brands = select_brands(sc_to_scraper_brands,
+                                   cd['scraper_companies'])
+            normed_brands = {norm(b) for b in brands}
+            brand_names = {a for a in cd['aliases']
+                           if norm(a) in normed_brands}
+
+            # look up all scraper companies in a map from scraper company to
+            # set, and merge those all into one big set
+            def get_names(sc_to_x):
+                return {n for sc in cd['scraper_companies']
+                        for n in sc_to_x[sc]}
+
+            # exclude names marked as alias-only
+            bad_names = get_names(sc_to_bad)
+            names = (cd['names'] | brand_names) - bad_names
+
+            if not names:
+                # could happen if only name was flagged as is_alias?
+                continue
+
+            # pick company name and full name
+            company = pick_company_name(names)
+
+            # pick full name. prioritize names marked is_full in company_name
+            # table, then names in company_full field, then other names
+            full_names = (get_names(cn_sc_to_full) or
+                          get_names(cf_sc_to_full) or
+                          names)
+            company_full = pick_company_full(full_names)
+
+            companies.add(company)
+
+            # write to scraper_company_map
+            for scraper_id, scraper_company in sorted(
+                    cd['scraper_companies']):
+                map_writer.add(dict(
+                    company=company,
+                    scraper_id=scraper_id,
+                    scraper_company=scraper_company))
+
+            # write to company_name
+
+            # company and company_full should always be in cd; just hedging
+            company_names = (
+                cd['names'] | cd['aliases'] | {company, company_full})
+
+            for company_name in company_names:
+                row = dict(company=company, company_name=company_name)
+
+                if company_name == company_full:
+                    row['is_full'] = 1
+                elif company_name not in names:
+                    row['is_alias'] = 1
+
+                name_writer.add(row)
+
+            if stats is not None:
+                group = dict(company=company, cds=cd_group,
+                             time=perf_counter() - start)
+                heap_item = (len(cd_group), -num_groups, group)
+
+                if len(largest_groups) < NUM_LARGEST_COMPANY_GROUPS:
+                    heappush(largest_groups, heap_item)
+                else:
+                    heappushpop(largest_groups, heap_item)
+
+    if stats is not None:
+        stats['num_groups'] = num_groups
+        stats['largest_groups'] = [
+            group for _, _, group in sorted(largest_groups, reverse=True)]
+
+    return companies
+
+
+def describe_company_groups(stats):
+    """Describe the biggest groups of company names, the keys that
+    held each of them together, and the keys we ignored for being too
+    common, for the build report. *stats* is a dict filled by
+    group_company_dicts() and write_company_groups().
+
+    This also logs the biggest group, and any ignored keys.
+    """
+    key_freq = stats['key_freq']
+
+    largest_groups = []
+
+    for group in stats['largest_groups']:
+        # only worth counting for the groups we describe
+        key_merges = _count_key_merges(group['cds'], stats['dropped_keys'])
+
+        keys = set()
+        for cd in group['cds']:
+            for cd_keys in _company_dict_keys(cd):
+                keys.update(cd_keys)
+
+        bridging_keys = sorted(
+            (k for k in keys if key_merges[k]),
+            key=lambda k: (-key_merges[k], k))[:NUM_BRIDGING_KEYS]
+
+        largest_groups.append(dict(
+            company=group['company'],
+            bridging_keys=[dict(key=k, freq=key_freq[k],
+                                merges=key_merges[k])
+                           for k in bridging_keys],
+            num_cds=len(group['cds']),
+            time=group['time'],
+        ))
+
+    dropped_keys = sorted(stats['dropped_keys'],
+                          key=lambda k: (-key_freq[k], k))
+
+    if largest_groups:
+        log.info('  largest company group: {} ({:d} company dicts,'
+                 ' {:.3f}s)'.format(largest_groups[0]['company'],
+                                    largest_groups[0]['num_cds'],
+                                    largest_groups[0]['time']))
+    if dropped_keys:
+        log.warning('  ignored {:d} company keys shared by more than {:d}'
+                    ' company dicts: {}'.format(
+                        len(dropped_keys), MAX_COMPANY_KEY_FREQ,
+                        ', '.join(repr(k) for k in dropped_keys[:10])))
+
+    return dict(
+        dropped_keys=[dict(key=k, freq=key_freq[k]) for k in dropped_keys],
+        largest_groups=largest_groups,
+    )
 
 
 def pick_company_name(names):
@@ -208,30 +537,44 @@ def pick_company_full(names):
                       -len(n.encode('utf8'))))[0]
 
 
+@cached('company_keys', COMPANY_KEYS_CACHE_SIZE)
 def get_company_keys(s):
-    variants = set()
-
-    variants.add(norm(CAMEL_CASE_RE.sub(' ', s)))
+    """Get a set of normed variants of *s* (a company name or alias)
+    to match it against other names.
 
+    The same aliases turn up over and over, so this is cached; don't
+    modify the result!
+    """
     norm_s = norm(s)
-    variants.add(norm_s)
-    variants.add(norm_s.replace('-', ''))
-    variants.add(norm_s.replace('-', ' '))
-    variants.add(norm_s.replace(' and ', ' & '))
-    variants.add(norm_s.replace(' and ', '&'))
-    variants.add(norm_s.replace('&', ' & '))
-    variants.add(norm_s.replace('&', ' and '))
-    variants.add(norm_s.replace('.', ''))
-    variants.add(norm_s.replace('.', '. '))
-    variants.add(norm_s.replace("'", ''))
-
-    variants = {simplify_whitespace(v) for v in variants}
+    variants = {norm_s}
+
+    # only norm again if splitting camel case actually changes anything
+    if CAMEL_CASE_RE.search(s):
+        variants.add(norm(CAMEL_CASE_RE.sub(' ', s)))
+
+    # each replacement only applies if its substring is there at all
+    for old, news in _COMPANY_KEY_REPLACEMENTS:
+        if old in norm_s:
+            for new in news:
+                variants.add(norm_s.replace(old, new))
 
     # disallow a single character as a key (see #33)
-    return {v for v in variants if len(v) > 1}
+    return frozenset(v for v in map(simplify_whitespace, variants)
+                     if len(v) > 1)
+
+
+# substrings to replace in normed names to make variants of them for
+# get_company_keys(), and what to replace each with
+_COMPANY_KEY_REPLACEMENTS = [
+    ('-', ('', ' ')),
+    (' and ', (' & ', '&')),
+    ('&', (' & ', ' and ')),
+    ('.', ('', '. ')),
+    ("'", ('',)),
+]
 
 
-@lru_cache()
+@cached('company_names')
 def get_company_names(company):
     """Get a set of possible ways to display company name."""
     return {v for v in _yield_company_names(company) if len(v) > 1}
@@ -267,7 +610,7 @@ def _yield_company_names(company):
             break
 
 
-@lru_cache()
+@cached('company_aliases')
 def get_company_aliases(company):
     """Get a set of all ways to match against this company. Some of
     these may be too abbreviated to use as the company's display name."""
@@ -332,8 +675,7 @@ def load_company_name_corrections(scratch_db):
     """Process the company_name table. Returns
     (cds, invariant_names, sc_to_bad, sc_to_full):
 
-    cds: list of company dicts (see
-         build_company_name_and_scraper_company_map_tables())
+    cds: list of company dicts (see load_company_dicts())
     invariant_names: set of names that we shouldn't build variants of
     sc_to_bad: map from (scraper_id, company) to an alias that should
          not be a canonical name for that company
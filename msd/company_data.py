@@ -117,7 +117,7 @@ COMPANY_TYPE_RE = re.compile(
     r'|P\.C\.'
     r'|Pty\.? Ltd\.?'
     r'|Pty\.?'
-    r'|S.\L\.'
+    r'|S.L\.'
     r'|SA'
     r'|SAPI DE CV SOFOM ENR'
     r'|SARL'
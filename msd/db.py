@@ -11,8 +11,107 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import re
 import sqlite3
 from itertools import groupby
+from logging import getLogger
+from os.path import abspath
+from time import perf_counter
+from urllib.request import pathname2url
+
+from .cache import cached
+from .report import discard_stages
+from .report import get_stages
+from .report import stage
+
+# number of rows to buffer before writing them out with executemany()
+DEFAULT_BATCH_SIZE = 5000
+
+# PRAGMAs to apply to the scratch and output DBs while building them.
+# These are always .tmp files that get thrown away if the build fails,
+# so we don't need them to survive a crash, just to be fast.
+BUILD_PROFILES = {
+    # SQLite's defaults
+    'safe': {},
+    'fast': dict(
+        cache_size=-256 * 1024,  # negative means KiB, so 256 MiB
+        journal_mode='MEMORY',  # not OFF; we still need ROLLBACK to work
+        mmap_size=256 * 1024 * 1024,
+        synchronous='OFF',
+        temp_store='MEMORY',
+    ),
+}
+
+DEFAULT_BUILD_PROFILE = 'fast'
+
+# the start of CREATE statements as SQLite stores them in sqlite_master,
+# up to where the name goes (see copy_db())
+CREATE_TABLE_RE = re.compile(r'^(CREATE TABLE\s+)', re.I)
+CREATE_INDEX_RE = re.compile(r'^(CREATE (?:UNIQUE )?INDEX\s+)', re.I)
+
+log = getLogger(__name__)
+
+
+class BulkInserter(object):
+    """Buffer rows for a single table, and write them out in batches
+    with executemany(), one transaction per batch.
+
+    *col_names* is the fixed list of columns to insert. Rows can either be
+    dicts (any column missing from a row is inserted as NULL) or sequences
+    of values in the same order as *col_names*. Use this as a context
+    manager to make sure the last batch gets written.
+
+    *insert_sql* is the SQL to insert a row with *col_names* (see
+    build_insert_sql()), if you already have it (e.g. from
+    msd.schema.TableSchema).
+    """
+    def __init__(self, db, table_name, col_names,
+                 batch_size=DEFAULT_BATCH_SIZE, insert_sql=None):
+        if isinstance(col_names, str):
+            raise TypeError
+
+        self.db = db
+        self.table_name = table_name
+        self.col_names = tuple(col_names)
+        self.batch_size = batch_size
+        self.insert_sql = insert_sql or build_insert_sql(
+            table_name, self.col_names)
+
+        # number of rows written to the db so far
+        self.num_rows = 0
+
+        self._batch = []
+
+    def add(self, row):
+        """Add a row (a dict) to the buffer, flushing it if it's full."""
+        self.add_values(tuple(row.get(c) for c in self.col_names))
+
+    def add_values(self, values):
+        """Add a row, as a sequence of values in the same order as
+        *col_names*."""
+        self._batch.append(values)
+
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write out buffered rows in a single transaction."""
+        if not self._batch:
+            return
+
+        with self.db:
+            self.db.executemany(self.insert_sql, self._batch)
+
+        self.num_rows += len(self._batch)
+        self._batch = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # don't write a partial batch if something went wrong
+        if exc_type is None:
+            self.flush()
 
 
 def create_table(db, table_name, columns, primary_key=None):
@@ -36,6 +135,14 @@ def create_table(db, table_name, columns, primary_key=None):
     db.execute(create_sql)
 
 
+def count_rows(db, table_names):
+    """Count the total number of rows in the given tables."""
+    sql = 'SELECT COUNT(*) FROM `{}`'
+
+    return sum(db.execute(sql.format(table_name)).fetchone()[0]
+               for table_name in table_names)
+
+
 def create_index(db, table_name, index_cols):
     if isinstance(index_cols, str):
         raise TypeError
@@ -53,26 +160,201 @@ def col_sql(col_names):
     return ', '.join('`{}`'.format(col_name) for col_name in col_names)
 
 
-def insert_row(db, table_name, row):
-    col_names, values = list(zip(*sorted(row.items())))
-
-    insert_sql = 'INSERT INTO `{}` ({}) VALUES ({})'.format(
+def build_insert_sql(table_name, col_names):
+    """Build SQL to insert a single row with the given columns."""
+    return 'INSERT INTO `{}` ({}) VALUES ({})'.format(
         table_name,
         col_sql(col_names),
         ', '.join('?' for _ in col_names))
 
-    db.execute(insert_sql, values)
+
+def insert_row(db, table_name, row):
+    col_names, values = list(zip(*sorted(row.items())))
+
+    db.execute(_cached_insert_sql(table_name, col_names), values)
+
+
+# rows passed to insert_row() tend to have the same few sets of columns
+_cached_insert_sql = cached('insert_sql', 256)(build_insert_sql)
 
 
 def open_db(path):
     """Open the sqlite database at the given path
     Use sqlite3.Row as our row_factory to wrap rows like dicts.
+
+    URI filenames are enabled, so that we can ATTACH databases using
+    read_only_uri().
     """
-    db = sqlite3.connect(path)
+    db = sqlite3.connect(path, uri=True)
     db.row_factory = sqlite3.Row
     return db
 
 
+def open_memory_db(max_size=None):
+    """Open a new in-memory database, like open_db().
+
+    If *max_size* is set, any write that would make the database bigger
+    than that many bytes fails (see is_full_error()).
+    """
+    db = open_db(':memory:')
+
+    if max_size:
+        page_size = db.execute('PRAGMA page_size').fetchone()[0]
+        db.execute('PRAGMA max_page_count = {:d}'.format(
+            max(max_size // page_size, 1)))
+
+    return db
+
+
+def is_full_error(e):
+    """Is *e* the error SQLite raises when the database is full?"""
+    return (isinstance(e, sqlite3.OperationalError) and
+            'database or disk is full' in str(e))
+
+
+def db_size(db):
+    """Size of the main database in *db*, in bytes."""
+    page_count = db.execute('PRAGMA page_count').fetchone()[0]
+    page_size = db.execute('PRAGMA page_size').fetchone()[0]
+    return page_count * page_size
+
+
+def save_db(db, path):
+    """Copy *db* (e.g. an in-memory database) to a new file at *path*
+    using SQLite's backup API, or copy_db() if this version of Python
+    doesn't have it (it's new in Python 3.7)."""
+    if not hasattr(db, 'backup'):
+        copy_db(db, path)
+        return
+
+    dest_db = sqlite3.connect(path)
+    try:
+        db.backup(dest_db)
+    finally:
+        dest_db.close()
+
+
+def copy_db(db, path):
+    """Copy the tables and indexes in *db* to a new file at *path*, one
+    table at a time with INSERT ... SELECT."""
+    schema_rows = list(db.execute(
+        "SELECT type, name, sql FROM main.sqlite_master WHERE sql NOT NULL"
+        " AND name NOT LIKE 'sqlite_%' ORDER BY rowid"))
+
+    # create tables first, and indexes after the rows are in
+    db.execute('ATTACH DATABASE ? AS dest', [path])
+    try:
+        with db:
+            for row_type, name, sql in schema_rows:
+                if row_type == 'table':
+                    db.execute(CREATE_TABLE_RE.sub(r'\1dest.', sql, 1))
+                    db.execute('INSERT INTO dest.`{}` SELECT * FROM'
+                               ' main.`{}`'.format(name, name))
+
+            for row_type, name, sql in schema_rows:
+                if row_type == 'index':
+                    db.execute(CREATE_INDEX_RE.sub(r'\1dest.', sql, 1))
+    finally:
+        db.execute('DETACH DATABASE dest')
+
+
+def build_db(path, fill_db, *, estimated_size=0, memory_budget=0):
+    """Create a new database at *path* (which shouldn't exist yet), and
+    call fill_db(db) to put data in it.
+
+    If *memory_budget* is set and *estimated_size* fits within it, build
+    the database in memory and then write it to *path* in one go. If it
+    turns out to need more than *memory_budget* bytes, throw it away
+    and start over on disk.
+
+    The in-memory attempt is recorded as a "build_db_in_memory" stage (see
+    msd.report); if it fails, we forget any stages recorded while filling
+    the database, since they get recorded again on disk.
+    """
+    if memory_budget and estimated_size <= memory_budget:
+        log.info('  building in memory (estimated {:d} MiB, budget'
+                 ' {:d} MiB)'.format(
+                     estimated_size // 2**20, memory_budget // 2**20))
+
+        num_stages = len(get_stages())
+
+        with stage('build_db_in_memory', path=path,
+                   estimated_size=estimated_size,
+                   memory_budget=memory_budget) as record:
+            db = open_memory_db(memory_budget)
+            try:
+                try:
+                    fill_db(db)
+                except sqlite3.OperationalError as e:
+                    if not is_full_error(e):
+                        raise
+                    log.warning(
+                        '  exceeded memory budget, starting over on disk')
+                    discard_stages(num_stages)
+                    record['exceeded_memory_budget'] = True
+                else:
+                    db.commit()
+
+                    log.info('  saving {:d} MiB to {}'.format(
+                        db_size(db) // 2**20, path))
+                    start = perf_counter()
+                    save_db(db, path)
+                    log.info('  saved in {:.1f}s'.format(
+                        perf_counter() - start))
+                    record['exceeded_memory_budget'] = False
+            finally:
+                db.close()
+
+        if not record['exceeded_memory_budget']:
+            return
+
+    with open_db(path) as db:
+        fill_db(db)
+
+    db.close()
+
+
+def read_only_uri(path):
+    """Convert a path to a URI filename that opens the database
+    read-only."""
+    return 'file:{}?mode=ro'.format(pathname2url(abspath(path)))
+
+
+def apply_build_profile(db, profile=DEFAULT_BUILD_PROFILE):
+    """Apply the PRAGMAs for the given profile (a key in BUILD_PROFILES)
+    to *db*.
+
+    Returns a dict mapping PRAGMA name to the value SQLite reports back,
+    so you can tell which settings actually took.
+    """
+    return apply_pragmas(db, BUILD_PROFILES[profile])
+
+
+def apply_pragmas(db, pragmas, schema='main'):
+    """Set each PRAGMA in *pragmas* (a dict) on the given schema in *db*,
+    in sorted order. Returns a dict mapping PRAGMA name to its value
+    afterwards.
+
+    PRAGMAs that don't apply (e.g. mmap_size for in-memory databases)
+    are left out of the result.
+    """
+    applied = {}
+
+    for name, value in sorted(pragmas.items()):
+        db.execute('PRAGMA {}.{} = {}'.format(schema, name, value))
+        row = db.execute('PRAGMA {}.{}'.format(schema, name)).fetchone()
+        if row is not None:
+            applied[name] = row[0]
+
+    return applied
+
+
+def pragmas_str(applied):
+    """Format the return value of apply_pragmas() for logging."""
+    return ', '.join('{}={}'.format(name, value)
+                     for name, value in sorted(applied.items())) or 'none'
+
+
 def select_groups(db, table_name, key_cols, cols=None):
     """Select all rows in the given table. Yield tuples of
     (key, [rows]), where key is the values of the various key
@@ -0,0 +1,569 @@
+# Copyright 2016 SpendRight, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Update an existing output DB rather than building it from scratch,
+by only rebuilding rows for the corporate families whose data changed.
+
+This needs the scratch DB the output DB was built from (see
+msd.scratch.get_previous_scratch_path()) so that we can tell which
+scraper companies changed. Tables that don't key on company
+(campaign, scraper, scraper_category_map, subcategory, subsidiary)
+are cheap, so we just rebuild them.
+
+Rows for each corporate family are built exactly as they would be by
+a full build, but they may end up in a different order.
+"""
+from collections import defaultdict
+from functools import partial
+from logging import getLogger
+from os import remove
+from os import rename
+from os.path import exists
+from shutil import copyfile
+
+from .brand import build_brand_table
+from .brand import build_scraper_brand_map_table
+from .campaign import build_campaign_table
+from .category import build_category_table
+from .category import build_scraper_category_map_table
+from .category import build_subcategory_table
+from .claim import build_claim_table
+from .company import build_company_table
+from .company import get_max_company_key_freq
+from .company import group_company_dicts
+from .company import load_company_dicts
+from .company import select_company_dicts_with_keys
+from .company import write_company_groups
+from .db import DEFAULT_BUILD_PROFILE
+from .db import apply_build_profile
+from .db import open_db
+from .db import read_only_uri
+from .db import show_tables
+from .output import OUTPUT_BUILDERS
+from .output import run_builder
+from .output import select_build_info
+from .output import show_output_tables
+from .output import write_build_info
+from .rating import build_rating_table
+from .scraper import build_scraper_table
+from .schema import get_schema
+from .scratch import get_previous_scratch_path
+from .scratch import get_scratch_fingerprint
+from .scratch import scratch_tables_with_cols
+from .scratch import select_input_fingerprints
+from .subsidiary import build_subsidiary_table
+
+log = getLogger(__name__)
+
+# builders for tables that don't key on company; we just rebuild these
+GLOBAL_BUILDERS = [
+    build_campaign_table,
+    build_scraper_table,
+    build_scraper_category_map_table,
+    build_subcategory_table,
+]
+
+# builders that can build rows for only some companies, in the order
+# to run them, after updating scraper_company_map and company_name
+COMPANY_BUILDERS = [
+    build_company_table,
+    build_scraper_brand_map_table,
+    build_brand_table,
+    build_category_table,
+    build_claim_table,
+    build_rating_table,
+]
+
+# if these change, every company's categories may change
+CATEGORY_TABLES = ['scraper_category_map', 'subcategory']
+
+
+def update_output_db(scratch_db_path, output_db_path, *,
+                     profile=DEFAULT_BUILD_PROFILE):
+    """Try to update the output DB at *output_db_path* to match the
+    scratch DB, only rebuilding the corporate families that changed.
+
+    Returns True if the output DB is now up-to-date, and False if we
+    can't update it incrementally (in which case, do a full build).
+    """
+    build_info = select_build_info(output_db_path)
+    if build_info is None:
+        log.info("{} doesn't record which scratch DB it was built from;"
+                 " can't update it incrementally".format(output_db_path))
+        return False
+
+    if build_info.get('max_company_key_freq') != get_max_company_key_freq():
+        log.info('{} was built with a different max company key frequency;'
+                 " can't update it incrementally".format(output_db_path))
+        return False
+
+    scratch_fingerprint = get_scratch_fingerprint(scratch_db_path)
+
+    previous_scratch_db_path = get_previous_scratch_path(scratch_db_path)
+
+    if build_info['scratch_fingerprint'] == scratch_fingerprint:
+        log.info('{} is up-to-date'.format(output_db_path))
+        if exists(previous_scratch_db_path):
+            remove(previous_scratch_db_path)
+        return True
+
+    if not (exists(previous_scratch_db_path) and
+            get_scratch_fingerprint(previous_scratch_db_path) ==
+            build_info['scratch_fingerprint']):
+        log.info("don't have the scratch DB {} was built from; can't update"
+                 " it incrementally".format(output_db_path))
+        return False
+
+    if not output_tables_match_schema(output_db_path, show_output_tables()):
+        log.info("{}'s tables don't match the current table definitions;"
+                 " can't update it incrementally".format(output_db_path))
+        return False
+
+    scratch_db = open_db(read_only_uri(scratch_db_path))
+    previous_scratch_db = open_db(read_only_uri(previous_scratch_db_path))
+    previous_output_db = open_db(read_only_uri(output_db_path))
+
+    try:
+        changed_prefixes = select_changed_scraper_prefixes(
+            select_input_fingerprints(previous_scratch_db_path),
+            select_input_fingerprints(scratch_db_path))
+
+        if changed_prefixes is None:
+            log.info("previous scratch DB doesn't match the current table"
+                     " definitions; can't update incrementally")
+            return False
+
+        scraper_companies = select_changed_scraper_companies(
+            scratch_db, previous_scratch_db_path, changed_prefixes)
+
+        if scraper_companies is None:
+            log.info('invariant company names changed; can\'t update'
+                     ' incrementally')
+            return False
+
+        log.info('updating {} ({:d} changed inputs, {:d} changed scraper'
+                 ' companies)'.format(output_db_path, len(changed_prefixes),
+                                      len(scraper_companies)))
+
+        output_db_tmp_path = output_db_path + '.tmp'
+        if exists(output_db_tmp_path):
+            remove(output_db_tmp_path)
+        copyfile(output_db_path, output_db_tmp_path)
+
+        output_db = open_db(output_db_tmp_path)
+        try:
+            apply_build_profile(output_db, profile)
+
+            # tables that don't key on company
+            for build in GLOBAL_BUILDERS:
+                rebuild_table(output_db, scratch_db, find_builder(build))
+
+            categories_changed = any(
+                tables_differ(output_db, output_db_path, table_name)
+                for table_name in CATEGORY_TABLES)
+
+            # cluster company names again, for affected families
+            reclustered_companies = update_company_tables(
+                output_db, scratch_db, previous_scratch_db,
+                previous_output_db, scraper_companies)
+
+            rebuild_table(output_db, scratch_db,
+                          find_builder(build_subsidiary_table))
+
+            companies = select_affected_companies(
+                output_db, previous_output_db, reclustered_companies)
+
+            log.info('  rebuilding rows for {:d} companies'.format(
+                len(companies)))
+
+            for build in COMPANY_BUILDERS:
+                builder = find_builder(build)
+
+                if build == build_category_table and categories_changed:
+                    rebuild_table(output_db, scratch_db, builder)
+                    continue
+
+                with output_db:
+                    delete_company_rows(
+                        output_db, builder['writes'], companies)
+
+                with output_db:
+                    run_builder(dict(builder, build=partial(
+                        build, companies=companies)), output_db, scratch_db)
+
+            with output_db:
+                write_build_info(output_db, scratch_fingerprint)
+        finally:
+            output_db.close()
+    finally:
+        scratch_db.close()
+        previous_scratch_db.close()
+        previous_output_db.close()
+
+    log.info('moving {} -> {}'.format(output_db_tmp_path, output_db_path))
+    rename(output_db_tmp_path, output_db_path)
+
+    remove(previous_scratch_db_path)
+
+    return True
+
+
+def find_builder(build):
+    """Find the entry in OUTPUT_BUILDERS for the given function."""
+    for builder in OUTPUT_BUILDERS:
+        if builder['build'] == build:
+            return builder
+
+    raise ValueError('{} is not in OUTPUT_BUILDERS'.format(build.__name__))
+
+
+def rebuild_table(output_db, scratch_db, builder):
+    """Drop the tables *builder* writes, and run it again."""
+    with output_db:
+        for table_name in builder['writes']:
+            output_db.execute('DROP TABLE `{}`'.format(table_name))
+
+        run_builder(builder, output_db, scratch_db)
+
+
+def output_tables_match_schema(output_db_path, table_names):
+    """Do the given tables exist in the output DB with the columns we
+    expect?"""
+    with open_db(read_only_uri(output_db_path)) as output_db:
+        matches = all(
+            table_name in show_tables(output_db) and
+            tuple(sorted(row['name'] for row in output_db.execute(
+                'PRAGMA table_info(`{}`)'.format(table_name)))) ==
+            get_schema(table_name).col_names
+            for table_name in table_names)
+    output_db.close()
+
+    return matches
+
+
+def select_changed_scraper_prefixes(old_fingerprints, fingerprints):
+    """Given input fingerprints (see msd.scratch.fingerprint_input())
+    for the old and new scratch DBs, return the set of scraper prefixes
+    whose inputs were added, removed, or changed.
+
+    Returns None if either set of fingerprints is None.
+    """
+    if old_fingerprints is None or fingerprints is None:
+        return None
+
+    def prefix_to_hashes(fps):
+        result = defaultdict(list)
+        for fp in fps:
+            result[fp['scraper_prefix']].append(fp['sha1'])
+        return result
+
+    old_prefix_to_hashes = prefix_to_hashes(old_fingerprints)
+    prefix_to_hashes = prefix_to_hashes(fingerprints)
+
+    return {prefix for prefix in
+            set(old_prefix_to_hashes) | set(prefix_to_hashes)
+            if old_prefix_to_hashes.get(prefix) !=
+            prefix_to_hashes.get(prefix)}
+
+
+def select_changed_scraper_companies(
+        scratch_db, previous_scratch_db_path, changed_prefixes):
+    """Compare the scratch DB with the previous one, and return the set
+    of (scraper_id, company) for every scraper company whose rows were
+    added, removed, or changed, either directly or through the url
+    table.
+
+    Only looks at rows whose scraper_id is in one of *changed_prefixes*;
+    rows from other inputs are copied verbatim between scratch DBs.
+
+    Returns None if rows that affect all companies (invariant
+    company names) changed.
+    """
+    scratch_db.execute('ATTACH DATABASE ? AS previous',
+                       [read_only_uri(previous_scratch_db_path)])
+    try:
+        scraper_ids = set()
+        for table_name in sorted(show_tables_with_scraper_id(scratch_db)):
+            for schema_name in ('main', 'previous'):
+                for (scraper_id,) in scratch_db.execute(
+                        'SELECT DISTINCT scraper_id FROM {}.`{}`'.format(
+                            schema_name, table_name)):
+                    if scraper_id is not None and any(
+                            scraper_id == prefix or
+                            scraper_id.startswith(prefix + '.')
+                            for prefix in changed_prefixes):
+                        scraper_ids.add(scraper_id)
+
+        scratch_db.execute(
+            'CREATE TEMP TABLE changed_scraper_id (scraper_id text)')
+        scratch_db.executemany(
+            'INSERT INTO temp.changed_scraper_id VALUES (?)',
+            [(scraper_id,) for scraper_id in sorted(scraper_ids)])
+
+        scraper_companies = set()
+        urls = set()
+
+        for table_name in sorted(show_tables_with_scraper_id(scratch_db)):
+            schema = get_schema(table_name)
+
+            if 'company' in schema.col_set:
+                key_cols = ['company']
+                if 'subsidiary' in schema.col_set:
+                    key_cols.append('subsidiary')
+
+                for row in _select_changed_rows(scratch_db, table_name):
+                    if table_name == 'company_name' and not row['company']:
+                        return None
+
+                    for key_col in key_cols:
+                        if row[key_col]:
+                            scraper_companies.add(
+                                (row['scraper_id'], row[key_col]))
+
+            elif table_name == 'url':
+                urls.update(
+                    row['url'] for row in
+                    _select_changed_rows(scratch_db, table_name))
+
+        # url rows from any scraper get merged into company and brand rows
+        if urls:
+            scratch_db.execute('CREATE TEMP TABLE changed_url (url text)')
+            scratch_db.executemany(
+                'INSERT INTO temp.changed_url VALUES (?)',
+                [(url,) for url in sorted(urls)])
+
+            for table_name in scratch_tables_with_cols(['company', 'url']):
+                for schema_name in ('main', 'previous'):
+                    scraper_companies.update(
+                        tuple(row) for row in scratch_db.execute(
+                            'SELECT scraper_id, company FROM {}.`{}`'
+                            ' WHERE url IN (SELECT url FROM'
+                            ' temp.changed_url)'.format(
+                                schema_name, table_name)))
+
+        return scraper_companies
+    finally:
+        with scratch_db:
+            scratch_db.execute('DROP TABLE IF EXISTS temp.changed_scraper_id')
+            scratch_db.execute('DROP TABLE IF EXISTS temp.changed_url')
+        scratch_db.execute('DETACH DATABASE previous')
+
+
+def show_tables_with_scraper_id(scratch_db):
+    """All scratch tables (they all have scraper_id)."""
+    return scratch_tables_with_cols(['scraper_id'])
+
+
+def _select_changed_rows(scratch_db, table_name):
+    """Yield rows for changed scraper IDs that are in only one of the
+    main and previous scratch DBs."""
+    cols = ', '.join('`{}`'.format(c)
+                     for c in get_schema(table_name).scratch_col_names)
+
+    select_sql = ('SELECT {} FROM {}.`{}` WHERE scraper_id IN'
+                  ' (SELECT scraper_id FROM temp.changed_scraper_id)')
+
+    for a, b in (('main', 'previous'), ('previous', 'main')):
+        for row in scratch_db.execute(
+                select_sql.format(cols, a, table_name) + ' EXCEPT ' +
+                select_sql.format(cols, b, table_name)):
+            yield row
+
+
+def tables_differ(output_db, previous_output_db_path, table_name):
+    """Does the given table in *output_db* have different rows than
+    in the previous output DB?"""
+    output_db.execute('ATTACH DATABASE ? AS previous',
+                      [read_only_uri(previous_output_db_path)])
+    try:
+        select_sql = 'SELECT * FROM {}.`{}`'
+        for a, b in (('main', 'previous'), ('previous', 'main')):
+            row = output_db.execute(
+                select_sql.format(a, table_name) + ' EXCEPT ' +
+                select_sql.format(b, table_name)).fetchone()
+            if row is not None:
+                return True
+
+        return False
+    finally:
+        output_db.execute('DETACH DATABASE previous')
+
+
+def update_company_tables(output_db, scratch_db, previous_scratch_db,
+                          previous_output_db, scraper_companies):
+    """Re-cluster company names for the groups that contain any of
+    *scraper_companies*, or any key that went over or under
+    MAX_COMPANY_KEY_FREQ (see msd.company.group_company_dicts()), and
+    update scraper_company_map and company_name to match.
+
+    Returns the set of (canonical) companies we deleted or wrote
+    (which we'll need to rebuild other tables for).
+    """
+    log.info('  updating scraper_company_map and company_name tables')
+
+    company_dicts = load_company_dicts(scratch_db)
+    stats = {}
+    cd_groups = list(group_company_dicts(company_dicts['cds'], stats))
+
+    # update_output_db() checks that the output DB was built with the
+    # same MAX_COMPANY_KEY_FREQ, so this is how it was grouped
+    old_cds = load_company_dicts(previous_scratch_db)['cds']
+    old_stats = {}
+    old_cd_groups = list(group_company_dicts(old_cds, old_stats))
+
+    # a change to one scraper can push a key shared with other scrapers
+    # over or under the limit, joining or splitting their groups
+    toggled_keys = stats['dropped_keys'] ^ old_stats['dropped_keys']
+    scraper_companies = set(scraper_companies)
+
+    if toggled_keys:
+        log.info('  {:d} company keys went over or under the max'
+                 ' frequency'.format(len(toggled_keys)))
+
+        for cd in select_company_dicts_with_keys(
+                company_dicts['cds'] + old_cds, toggled_keys):
+            scraper_companies.update(cd['scraper_companies'])
+
+    sc_to_company = {
+        (row['scraper_id'], row['scraper_company']): row['company']
+        for row in previous_output_db.execute(
+            'SELECT scraper_id, scraper_company, company'
+            ' FROM scraper_company_map')}
+
+    company_to_scs = defaultdict(set)
+    for sc, company in sc_to_company.items():
+        company_to_scs[company].add(sc)
+
+    sc_to_group_indexes = _index_groups(cd_groups)
+    sc_to_old_group_indexes = _index_groups(old_cd_groups)
+
+    select_family = partial(select_family_from_links,
+                            select_subsidiary_links(previous_output_db))
+
+    # any scraper company that was or will be grouped with an affected
+    # scraper company is affected too. So is the rest of its family,
+    # since subsidiary depth affects which company gets each brand
+    group_indexes = set()
+
+    while True:
+        old_companies = select_family(
+            {sc_to_company[sc] for sc in scraper_companies
+             if sc in sc_to_company})
+
+        new_scraper_companies = set(scraper_companies)
+
+        for company in old_companies:
+            new_scraper_companies.update(company_to_scs[company])
+
+        for sc in scraper_companies:
+            for i in sc_to_group_indexes.get(sc, ()):
+                group_indexes.add(i)
+                for cd in cd_groups[i]:
+                    new_scraper_companies.update(cd['scraper_companies'])
+
+            for i in sc_to_old_group_indexes.get(sc, ()):
+                for cd in old_cd_groups[i]:
+                    new_scraper_companies.update(cd['scraper_companies'])
+
+        if new_scraper_companies == scraper_companies:
+            break
+
+        scraper_companies = new_scraper_companies
+
+    with output_db:
+        delete_company_rows(output_db, ['scraper_company_map', 'company_name'],
+                            old_companies)
+
+    log.info('  re-clustering {:d} of {:d} company groups'.format(
+        len(group_indexes), len(cd_groups)))
+
+    new_companies = write_company_groups(
+        output_db, company_dicts,
+        (cd_groups[i] for i in sorted(group_indexes)))
+
+    return old_companies | new_companies
+
+
+def _index_groups(cd_groups):
+    """Map each scraper company to the indexes of the groups of company
+    dicts that it appears in."""
+    sc_to_group_indexes = defaultdict(set)
+
+    for i, cd_group in enumerate(cd_groups):
+        for cd in cd_group:
+            for sc in cd['scraper_companies']:
+                sc_to_group_indexes[sc].add(i)
+
+    return sc_to_group_indexes
+
+
+def select_affected_companies(output_db, previous_output_db, companies):
+    """Get the set of companies whose rows in company-keyed tables need
+    to be rebuilt: the given *companies* (the ones we re-clustered, before
+    and after), plus every company in the same corporate family as any
+    of them, before or after.
+    """
+    # links between companies in the same family, before and after
+    links = select_subsidiary_links(previous_output_db)
+    for company, linked in select_subsidiary_links(output_db).items():
+        links[company].update(linked)
+
+    return select_family_from_links(links, companies)
+
+
+def select_subsidiary_links(output_db):
+    """Map each company in the subsidiary table to the set of its parent
+    companies and subsidiaries."""
+    links = defaultdict(set)
+
+    for company, subsidiary in output_db.execute(
+            'SELECT company, subsidiary FROM subsidiary'):
+        links[company].add(subsidiary)
+        links[subsidiary].add(company)
+
+    return links
+
+
+def select_family_from_links(links, companies):
+    """Return *companies*, plus all their parent companies and
+    subsidiaries, and their parents' subsidiaries, and so on, using
+    *links* from select_subsidiary_links()."""
+    family = set(companies)
+    to_visit = sorted(family)
+
+    while to_visit:
+        company = to_visit.pop()
+
+        for c in links.get(company, ()):
+            if c not in family:
+                family.add(c)
+                to_visit.append(c)
+
+    return family
+
+
+def delete_company_rows(output_db, table_names, companies):
+    """Delete rows for the given companies from the given tables."""
+    output_db.execute('CREATE TEMP TABLE deleted_company (company text)')
+    try:
+        output_db.executemany(
+            'INSERT INTO temp.deleted_company VALUES (?)',
+            [(company,) for company in sorted(companies)])
+
+        for table_name in table_names:
+            output_db.execute(
+                'DELETE FROM `{}` WHERE company IN'
+                ' (SELECT company FROM temp.deleted_company)'.format(
+                    table_name))
+    finally:
+        output_db.execute('DROP TABLE temp.deleted_company')
@@ -0,0 +1,249 @@
+# Copyright 2016 SpendRight, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Streaming readers for input files that aren't SQLite databases."""
+import csv
+import gzip
+import json
+import re
+from os import listdir
+from os.path import basename
+from os.path import join
+
+from yaml.composer import Composer
+from yaml.constructor import SafeConstructor
+from yaml.events import MappingEndEvent
+from yaml.events import MappingStartEvent
+from yaml.events import ScalarEvent
+from yaml.events import SequenceEndEvent
+from yaml.events import SequenceStartEvent
+from yaml.events import StreamEndEvent
+from yaml.resolver import Resolver
+
+# a file containing rows for a single table, e.g. brand.csv, company.jsonl.gz
+TABLE_FILE_RE = re.compile(
+    r'^(?P<table_name>[^.]+)\.(?P<file_type>csv|jsonl)(?P<gzip>\.gz)?$',
+    re.I)
+
+# use libyaml if it's available; it's a lot faster
+try:
+    from yaml.cyaml import CParser as _YAMLParser
+except ImportError:
+    from yaml.parser import Parser
+    from yaml.reader import Reader
+    from yaml.scanner import Scanner
+
+    class _YAMLParser(Reader, Scanner, Parser):
+
+        def __init__(self, stream):
+            Reader.__init__(self, stream)
+            Scanner.__init__(self)
+            Parser.__init__(self)
+
+
+class _YAMLLoader(_YAMLParser, Composer, SafeConstructor, Resolver):
+    """Like yaml.CSafeLoader (or yaml.SafeLoader), except that we compose
+    and construct one node at a time, rather than whole documents."""
+
+    def __init__(self, stream):
+        _YAMLParser.__init__(self, stream)
+        Composer.__init__(self)
+        SafeConstructor.__init__(self)
+        Resolver.__init__(self)
+
+    def load_next_node(self):
+        """Construct the next node in the stream.
+
+        Like yaml.load(), aliases can refer to anchors anywhere earlier
+        in the document. Only anchored nodes are kept around for this,
+        not every node we've read.
+        """
+        node = Composer.compose_node(self, None, None)
+
+        return self.construct_document(node)
+
+    def skip_next_node(self):
+        """Skip over the next node in the stream, without constructing
+        it (though anchored nodes are composed, so that later aliases
+        can refer to them)."""
+        depth = 0
+
+        while True:
+            event = self.peek_event()
+
+            if (isinstance(event, (ScalarEvent, MappingStartEvent,
+                                   SequenceStartEvent)) and
+                    event.anchor is not None):
+                # compose the whole anchored node; this leaves us at
+                # the same depth
+                Composer.compose_node(self, None, None)
+            else:
+                self.get_event()
+
+                if isinstance(event, (MappingStartEvent, SequenceStartEvent)):
+                    depth += 1
+                elif isinstance(event, (MappingEndEvent, SequenceEndEvent)):
+                    depth -= 1
+
+            if depth == 0:
+                return
+
+
+class _YAMLRows(object):
+    """Iterate through the items in a YAML sequence that we've just
+    started reading, constructing them one at a time."""
+
+    def __init__(self, loader):
+        self._loader = loader
+        self._done = False
+
+    def __iter__(self):
+        while not self._done:
+            if self._loader.check_event(SequenceEndEvent):
+                self._loader.get_event()
+                self._done = True
+            else:
+                yield self._loader.load_next_node()
+
+    def skip(self):
+        """Skip any rows we haven't read yet."""
+        while not self._done:
+            if self._loader.check_event(SequenceEndEvent):
+                self._loader.get_event()
+                self._done = True
+            else:
+                self._loader.skip_next_node()
+
+
+def iter_yaml_tables(input_yaml):
+    """Read a YAML document consisting of a dictionary mapping table
+    name to list of rows. Yield tuples of (table_name, rows), where *rows*
+    is an iterable that reads rows from the stream lazily.
+
+    Tables appear in the order they are in the document. You must be done
+    with *rows* before reading the next table; any rows you don't read are
+    skipped.
+
+    Raises TypeError if the document isn't a dictionary, or a table's rows
+    aren't a list.
+    """
+    loader = _YAMLLoader(input_yaml)
+
+    try:
+        loader.get_event()  # StreamStartEvent
+
+        # empty stream
+        if loader.check_event(StreamEndEvent):
+            raise TypeError('Expected YAML to be dictionary')
+        loader.get_event()  # DocumentStartEvent
+
+        if not loader.check_event(MappingStartEvent):
+            raise TypeError('Expected YAML to be dictionary')
+        loader.get_event()
+
+        while not loader.check_event(MappingEndEvent):
+            table_name = loader.load_next_node()
+
+            if not loader.check_event(SequenceStartEvent):
+                raise TypeError(
+                    'Expected rows for table {} to be list'.format(
+                        table_name))
+            loader.get_event()
+
+            rows = _YAMLRows(loader)
+            yield table_name, rows
+            rows.skip()
+    finally:
+        loader.dispose()
+
+
+def parse_table_file_name(name):
+    """Parse the name of a table file (not the full path) into
+    (table_name, file_type), or raise ValueError.
+
+    file_type will be one of 'csv' or 'jsonl' (whether or not the file
+    is gzipped)
+    """
+    m = TABLE_FILE_RE.match(name)
+    if not m:
+        raise ValueError('Unknown table file type: {}'.format(name))
+    return m.group('table_name'), m.group('file_type').lower()
+
+
+def list_table_files(dir_path):
+    """List the paths of table files in the given directory, sorted
+    by name. Other files are ignored."""
+    return [join(dir_path, name) for name in sorted(listdir(dir_path))
+            if TABLE_FILE_RE.match(name)]
+
+
+def iter_table_file(path):
+    """Lazily read rows (as dicts) from the table file at *path*.
+    The file isn't opened until you start iterating."""
+    _, file_type = parse_table_file_name(basename(path))
+
+    if path.lower().endswith('.gz'):
+        f = gzip.open(path, mode='rt', encoding='utf-8', newline='')
+    else:
+        f = open(path, encoding='utf-8', newline='')
+
+    with f:
+        if file_type == 'csv':
+            yield from iter_csv_rows(f)
+        else:
+            yield from iter_jsonl_rows(f)
+
+
+def iter_jsonl_rows(lines):
+    """Read rows from JSON Lines (one JSON object per line), skipping
+    blank lines.
+
+    Raises TypeError if a line isn't a JSON object.
+    """
+    for line in lines:
+        if not line.strip():
+            continue
+
+        row = json.loads(line)
+        if not isinstance(row, dict):
+            raise TypeError('Expected each line of JSON to be an object')
+
+        yield row
+
+
+def iter_csv_rows(lines):
+    """Read rows from CSV with a header row, skipping blank lines.
+
+    CSV has no way to represent null, so empty values become None;
+    so do values missing from the end of a short row.
+
+    Raises ValueError if a row has more values than the header.
+    """
+    reader = csv.reader(lines)
+
+    cols = next(reader, None)
+    if not cols:
+        return
+
+    for values in reader:
+        if not values:
+            continue
+
+        if len(values) > len(cols):
+            raise ValueError(
+                'Row {:d} of CSV has more values than the header'.format(
+                    reader.line_num))
+
+        values += [None] * (len(cols) - len(values))
+
+        yield {col: value or None for col, value in zip(cols, values)}
@@ -13,21 +13,20 @@
 # limitations under the License.
 """Supporting code to merge data from the scratch table and write it
 to the output table."""
+from .db import DEFAULT_BATCH_SIZE
+from .db import BulkInserter
 from .db import create_index
 from .db import create_table
 from .db import insert_row
-from .table import TABLES
+from .schema import get_schema
 
 
 def create_output_table(output_db, table_name):
-    table_def = TABLES[table_name]
-    columns = table_def['columns']
-    primary_key = table_def['primary_key']
-    indexes = table_def.get('indexes', ())
+    schema = get_schema(table_name)
 
-    create_table(output_db, table_name, columns, primary_key)
+    create_table(output_db, table_name, schema.columns, schema.primary_key)
 
-    for index_cols in indexes:
+    for index_cols in schema.indexes:
         create_index(output_db, table_name, index_cols)
 
 
@@ -38,36 +37,41 @@ def clean_output_row(row, table_name):
     * removing extra 'scraper_id' field
     * coercing is_* fields to 0 or 1
     """
-    table_def = TABLES[table_name]
-    columns = table_def['columns']
-    primary_key = table_def.get('primary_key', ())
+    return get_schema(table_name).clean_output_row(row)
 
-    row = row.copy()
 
-    # delete extra scraper_id column
-    if 'scraper_id' in row and 'scraper_id' not in columns:
-        del row['scraper_id']
+def output_row(output_db, table_name, row):
+    """Clean row and output it to output_db."""
+    row = clean_output_row(row, table_name)
+    insert_row(output_db, table_name, row)
 
-    # make sure primary key cols exists and are non-null
-    for k in primary_key:
-        if row.get(k) is None:
-            if columns[k] == 'text':
-                row[k] = ''
-            else:
-                row[k] = 0
 
-    # make sure is_* fields exist and are either 0 or 1
-    for k in sorted(columns):
-        if k.startswith('is_'):
-            row[k] = int(bool(row.get(k)))
+class OutputWriter(BulkInserter):
+    """Clean rows for the given output table (see clean_output_row()),
+    and write them out in batches, one transaction per batch.
 
-    return row
+    Rows can have any subset of the table's columns. Use this as a
+    context manager to make sure the last batch gets written.
+    """
+    def __init__(self, output_db, table_name,
+                 batch_size=DEFAULT_BATCH_SIZE):
+        self.schema = get_schema(table_name)
 
+        super(OutputWriter, self).__init__(
+            output_db, table_name, self.schema.col_names,
+            batch_size=batch_size, insert_sql=self.schema.insert_sql)
 
-def output_row(output_db, table_name, row):
-    """Clean row and output it to output_db."""
-    row = clean_output_row(row, table_name)
-    insert_row(output_db, table_name, row)
+    def add(self, row):
+        """Clean row and add it to the buffer, flushing it if it's full."""
+        row = self.schema.clean_output_row(row)
+
+        # catch these now, rather than silently dropping them
+        col_set = self.schema.col_set
+        if not col_set.issuperset(row):
+            raise ValueError('unknown column(s) for {} table: {}'.format(
+                self.table_name, ', '.join(sorted(set(row) - col_set))))
+
+        self.add_values(tuple(row.get(c) for c in self.col_names))
 
 
 def merge_dicts(ds):
@@ -97,9 +101,17 @@ def merge_dicts(ds):
 def group_by_keys(items, keyfunc):
     """Given a list of items, returns groups of items, such that if
     any two items share a key returned by keyfunc(item), they are in the
-    same group."""
+    same group.
 
-    key_to_group = {}
+    Groups are yielded in order of their first item, and items within
+    a group stay in the same order. Items with no keys are dropped.
+    """
+    # keys are interned as ids in *key_sets*
+    key_to_id = {}
+    key_sets = DisjointSet()
+
+    # (item, id of one of its keys)
+    keyed_items = []
 
     for item in items:
         keys = keyfunc(item)
@@ -111,29 +123,96 @@ def group_by_keys(items, keyfunc):
                 '{} is not a valid set of keys (did you mean {}?)'.format(
                     repr(keys), repr([keys])))
 
-        keys = set(keys)
+        item_key_id = None
 
+        for key in keys:
+            key_id = key_to_id.get(key)
+            if key_id is None:
+                key_id = key_sets.add()
+                key_to_id[key] = key_id
 
-        group = {'keys': keys.copy(), 'items': [item]}
+            if item_key_id is None:
+                item_key_id = key_id
+            else:
+                key_sets.union(item_key_id, key_id)
 
-        # merge all matching groups into this one
-        ids_seen = set()
+        if item_key_id is not None:
+            keyed_items.append((item, item_key_id))
 
-        for key in keys:
-            group_to_merge = key_to_group.get(key)
-            if group_to_merge and id(group_to_merge) not in ids_seen:
-                group['keys'].update(group_to_merge['keys'])
-                group['items'].extend(group_to_merge['items'])
-                ids_seen.add(id(group_to_merge))
+    # read out all groups
+    root_to_group = {}
+    groups = []
 
-        # make all keys point at our new group
-        for key in group['keys']:
-            key_to_group[key] = group
+    for item, key_id in keyed_items:
+        root = key_sets.find(key_id)
 
-    # read out all groups
-    ids_seen = set()
+        group = root_to_group.get(root)
+        if group is None:
+            group = []
+            root_to_group[root] = group
+            groups.append(group)
+
+        group.append(item)
+
+    for group in groups:
+        yield group
+
+
+class DisjointSet(object):
+    """Disjoint sets of integer ids (a union-find forest), with path
+    compression and union by rank, so that merging clusters takes
+    (nearly) constant time, however big they get.
+
+    Call add() to get a new id, in its own set.
+    """
+    def __init__(self):
+        self._parents = []
+        self._ranks = []
+
+    def __len__(self):
+        return len(self._parents)
+
+    def add(self):
+        """Add a new set containing a single id, and return the id."""
+        i = len(self._parents)
+
+        self._parents.append(i)
+        self._ranks.append(0)
+
+        return i
+
+    def find(self, i):
+        """Return the root id of the set containing *i*."""
+        parents = self._parents
+
+        root = i
+        while parents[root] != root:
+            root = parents[root]
+
+        # point everything we passed through directly at the root
+        while parents[i] != root:
+            parent = parents[i]
+            parents[i] = root
+            i = parent
+
+        return root
+
+    def union(self, i, j):
+        """Merge the sets containing *i* and *j*, and return the root id
+        of the merged set."""
+        i = self.find(i)
+        j = self.find(j)
+
+        if i == j:
+            return i
+
+        # attach the shallower tree to the deeper one
+        ranks = self._ranks
+        if ranks[i] < ranks[j]:
+            i, j = j, i
+
+        self._parents[j] = i
+        if ranks[i] == ranks[j]:
+            ranks[i] += 1
 
-    for group in key_to_group.values():
-        if id(group) not in ids_seen:
-            yield group['items']
-            ids_seen.add(id(group))
+        return i
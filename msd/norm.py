@@ -20,9 +20,24 @@ import unicodedata
 from titlecase import titlecase
 from unidecode import unidecode
 
+from .cache import cached
+
 # matches all whitespace, including non-ascii (e.g. non-breaking space)
 WHITESPACE_RE = re.compile(r'\s+', re.U)
 
+# matches ASCII strings that clean_string() wouldn't change: printable
+# characters, separated by single spaces
+CLEAN_ASCII_RE = re.compile(r'^(?:[!-~]+(?: [!-~]+)*)?\Z')
+
+# default max number of (non-ASCII) strings that clean_string() remembers
+DEFAULT_CLEAN_STRING_CACHE_SIZE = 65536
+
+# matches strings that are entirely ASCII (which unidecode() leaves alone)
+ASCII_RE = re.compile(r'^[\x00-\x7f]*\Z')
+
+# default max number of strings that norm() and smunch() each remember
+DEFAULT_NORM_CACHE_SIZE = 65536
+
 
 BAD_CODEPOINTS = {
     # smart quotes
@@ -46,6 +61,16 @@ def clean_string(s):
     if not isinstance(s, str):
         raise TypeError
 
+    # most strings are already clean ASCII
+    if CLEAN_ASCII_RE.match(s):
+        return s
+
+    # the same names, etc. show up many times
+    return _clean_string(s)
+
+
+@cached('clean_string', DEFAULT_CLEAN_STRING_CACHE_SIZE)
+def _clean_string(s):
     # see issue #32 for why we use NFC
     s = unicodedata.normalize('NFC', s)
     s = s.translate(BAD_CODEPOINTS)
@@ -68,9 +93,23 @@ def to_title_case(s):
 
 def norm(s):
     """Remove accents and convert to lowercase."""
+    # unidecode() doesn't change ASCII, so we only need to lowercase it
+    if ASCII_RE.match(s):
+        return s.lower()
+
+    return _norm(s)
+
+
+@cached('norm', DEFAULT_NORM_CACHE_SIZE)
+def _norm(s):
     return unidecode(s).lower()
 
 
 def smunch(s):
     """Like norm(), except we remove whitespace and hyphens too."""
+    return _smunch(s)
+
+
+@cached('smunch', DEFAULT_NORM_CACHE_SIZE)
+def _smunch(s):
     return WHITESPACE_RE.sub('', norm(s)).replace('-', '')
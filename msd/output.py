@@ -16,10 +16,19 @@
 To avoid circular dependencies, most of the supporting code to build the
 output table is in merge.py
 """
+import multiprocessing
+import sys
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
 from logging import getLogger
+from os import makedirs
 from os import remove
 from os import rename
 from os.path import exists
+from os.path import getsize
+from os.path import join
+from shutil import rmtree
 
 from .brand import build_brand_table
 from .brand import build_scraper_brand_map_table
@@ -30,52 +39,582 @@ from .category import build_subcategory_table
 from .claim import build_claim_table
 from .company import build_company_table
 from .company import build_company_name_and_scraper_company_map_tables
+from .company import get_max_company_key_freq
 from .rating import build_rating_table
 from .scraper import build_scraper_table
 from .subsidiary import build_subsidiary_table
 
+from .cache import record_cache_stats
+from .db import DEFAULT_BUILD_PROFILE
+from .db import apply_build_profile
+from .db import build_db
+from .db import col_sql
+from .db import count_rows
+from .db import create_table
 from .db import open_db
+from .db import pragmas_str
+from .db import read_only_uri
+from .db import show_tables
+from .merge import create_output_table
+from .report import add_stages
+from .report import get_stages
+from .report import stage
+from .schema import get_schema
+from .scratch import get_previous_scratch_path
+from .scratch import get_scratch_fingerprint
 
 log = getLogger(__name__)
 
+# extra table in each staging DB, written once its builder has finished
+# (see build_staging_db()). Company names are grouped differently with
+# a different max_company_key_freq, so it's part of the checkpoint
+CHECKPOINT_TABLE = 'checkpoint'
 
-def build_output_db(scratch_db_path, output_db_path):
-    output_db_tmp_path = output_db_path + '.tmp'
+CHECKPOINT_COLUMNS = dict(
+    builder='text',
+    scratch_fingerprint='text',
+    max_company_key_freq='integer',
+)
 
-    log.info('building {}...'.format(output_db_tmp_path))
+# extra table in the output DB, recording which scratch DB it was built
+# from, and with what max_company_key_freq (see msd.incremental)
+BUILD_INFO_TABLE = 'build_info'
 
-    if exists(output_db_tmp_path):
-        remove(output_db_tmp_path)
+BUILD_INFO_COLUMNS = dict(
+    scratch_fingerprint='text',
+    max_company_key_freq='integer',
+)
 
-    with open_db(output_db_tmp_path) as output_db:
-        with open_db(scratch_db_path) as scratch_db:
-            fill_output_db(output_db, scratch_db)
-
-    log.info('moving {} -> {}'.format(output_db_tmp_path, output_db_path))
-    rename(output_db_tmp_path, output_db_path)
-
-
-def fill_output_db(output_db, scratch_db):
+# Functions that build output tables, in the order a serial build runs
+# them, with the output tables each one reads and writes. A builder can
+# run as soon as the builders that write the tables it reads are done.
+OUTPUT_BUILDERS = [
     # tables with no dependencies
-    build_campaign_table(output_db, scratch_db)
-    build_scraper_table(output_db, scratch_db)
+    dict(build=build_campaign_table,
+         reads=[],
+         writes=['campaign']),
+    dict(build=build_scraper_table,
+         reads=[],
+         writes=['scraper']),
 
     # category names
-    build_scraper_category_map_table(output_db, scratch_db)
-    build_subcategory_table(output_db, scratch_db)
+    dict(build=build_scraper_category_map_table,
+         reads=[],
+         writes=['scraper_category_map']),
+    dict(build=build_subcategory_table,
+         reads=['scraper_category_map'],
+         writes=['subcategory']),
 
     # companies
-    build_company_name_and_scraper_company_map_tables(output_db, scratch_db)
-    build_company_table(output_db, scratch_db)
+    dict(build=build_company_name_and_scraper_company_map_tables,
+         reads=[],
+         writes=['scraper_company_map', 'company_name']),
+    dict(build=build_company_table,
+         reads=['company_name', 'scraper_company_map'],
+         writes=['company']),
 
     # subsidaries
-    build_subsidiary_table(output_db, scratch_db)
+    dict(build=build_subsidiary_table,
+         reads=['scraper_company_map'],
+         writes=['subsidiary']),
 
     # brands
-    build_scraper_brand_map_table(output_db, scratch_db)
-    build_brand_table(output_db, scratch_db)
+    dict(build=build_scraper_brand_map_table,
+         reads=['scraper_company_map', 'subsidiary'],
+         writes=['scraper_brand_map']),
+    dict(build=build_brand_table,
+         reads=['scraper_brand_map'],
+         writes=['brand']),
 
     # things that key on company, brand
-    build_category_table(output_db, scratch_db)
-    build_claim_table(output_db, scratch_db)
-    build_rating_table(output_db, scratch_db)
+    dict(build=build_category_table,
+         reads=['scraper_brand_map', 'scraper_category_map',
+                'scraper_company_map', 'subcategory'],
+         writes=['category']),
+    dict(build=build_claim_table,
+         reads=['scraper_brand_map', 'scraper_company_map'],
+         writes=['claim']),
+    dict(build=build_rating_table,
+         reads=['scraper_brand_map', 'scraper_company_map'],
+         writes=['rating']),
+]
+
+
+def build_output_db(scratch_db_path, output_db_path, *,
+                    jobs=1, memory_budget=0, profile=DEFAULT_BUILD_PROFILE,
+                    incremental=False, resume=False):
+    """Build the output DB from the scratch DB, using the given
+    set of PRAGMAs (see msd.db.BUILD_PROFILES). The scratch DB is
+    opened read-only.
+
+    If *jobs* is more than 1 or *resume* is true, each builder in
+    OUTPUT_BUILDERS writes into its own staging DB, and independent
+    builders run in parallel in up to *jobs* processes. We then merge the
+    staging DBs into the output DB in a fixed order, so these builds
+    give the same file (byte-for-byte) no matter what *jobs* is.
+    Otherwise, we run the builders directly into the output DB (see
+    fill_output_db()) without writing everything twice. That gives the
+    same tables and rows, in the same order, but not necessarily the
+    same bytes (SQLite may lay out pages differently).
+
+    If *memory_budget* is set, and the staging DBs (or for a direct
+    build, the scratch DB) fit into that many bytes, we build the output
+    DB in memory, and write it to disk at the end (see msd.db.build_db()).
+
+    The staging DBs live in a directory next to the output DB (see
+    get_staging_dir()), which we delete once the output DB is done. If
+    *resume* is true, and an earlier build didn't finish, reuse the
+    staging DBs it finished from the same scratch DB (see
+    select_reusable_builders()) rather than running their builders again.
+
+    If *incremental* is true, first try to update the existing output DB
+    in place, only rebuilding rows for companies whose data changed (see
+    msd.incremental.update_output_db()), and only do a full build if
+    that's not possible.
+    """
+    # avoid circular import
+    from .incremental import update_output_db
+
+    if incremental and exists(output_db_path):
+        with stage('update_output_db', path=output_db_path) as record:
+            record['updated'] = update_output_db(
+                scratch_db_path, output_db_path, profile=profile)
+
+        if record['updated']:
+            return
+
+    num_stages = len(get_stages())
+
+    with stage('build_output_db', path=output_db_path) as record:
+        output_db_tmp_path = output_db_path + '.tmp'
+
+        log.info('building {}...'.format(output_db_tmp_path))
+
+        if exists(output_db_tmp_path):
+            remove(output_db_tmp_path)
+
+        # put staging DBs next to the output DB, not in (possibly small) /tmp
+        staging_dir = get_staging_dir(output_db_path)
+
+        if exists(staging_dir) and not resume:
+            rmtree(staging_dir)
+
+        scratch_fingerprint = get_scratch_fingerprint(scratch_db_path)
+
+        if jobs > 1 or resume:
+            build_output_db_from_staging_dbs(
+                scratch_db_path, output_db_tmp_path, staging_dir,
+                jobs=jobs, memory_budget=memory_budget, profile=profile,
+                resume=resume, scratch_fingerprint=scratch_fingerprint)
+        else:
+            build_output_db_directly(
+                scratch_db_path, output_db_tmp_path,
+                memory_budget=memory_budget, profile=profile,
+                scratch_fingerprint=scratch_fingerprint)
+
+        log.info('moving {} -> {}'.format(output_db_tmp_path, output_db_path))
+        rename(output_db_tmp_path, output_db_path)
+
+        # only useful for updating an output DB built from it
+        previous_scratch_db_path = get_previous_scratch_path(scratch_db_path)
+        if exists(previous_scratch_db_path):
+            remove(previous_scratch_db_path)
+
+        record['rows_in'] = sum(
+            r['rows_in'] for r in get_stages(num_stages)
+            if r['name'] == 'build_output_table')
+
+        with open_db(read_only_uri(output_db_path)) as output_db:
+            record['rows_out'] = count_rows(output_db, show_output_tables())
+        output_db.close()
+
+
+def build_output_db_from_staging_dbs(
+        scratch_db_path, output_db_tmp_path, staging_dir, *,
+        jobs=1, memory_budget=0, profile=DEFAULT_BUILD_PROFILE,
+        resume=False, scratch_fingerprint=None):
+    """Run each builder into its own staging DB in *staging_dir* (see
+    build_staging_dbs()), and then merge them into a new output DB at
+    *output_db_tmp_path*. Helper for build_output_db()."""
+    makedirs(staging_dir, exist_ok=True)
+
+    try:
+        staging_db_paths = build_staging_dbs(
+            scratch_db_path, staging_dir, jobs=jobs, profile=profile,
+            resume=resume, scratch_fingerprint=scratch_fingerprint)
+    except BaseException:
+        log.error('output tables built so far are in {}; use --resume'
+                  ' to pick up where this left off'.format(staging_dir))
+        raise
+
+    def fill(output_db):
+        applied = apply_build_profile(output_db, profile)
+        log.info('  build profile {}: {} (output)'.format(
+            profile, pragmas_str(applied)))
+
+        merge_staging_dbs(output_db, staging_db_paths)
+
+        with output_db:
+            write_build_info(output_db, scratch_fingerprint)
+
+    build_db(output_db_tmp_path, fill,
+             estimated_size=sum(getsize(path) for path in staging_db_paths),
+             memory_budget=memory_budget)
+
+    rmtree(staging_dir)
+
+
+def build_output_db_directly(
+        scratch_db_path, output_db_tmp_path, *,
+        memory_budget=0, profile=DEFAULT_BUILD_PROFILE,
+        scratch_fingerprint=None):
+    """Run every builder, in order, directly into a new output DB at
+    *output_db_tmp_path* (see fill_output_db()). Helper for
+    build_output_db()."""
+    scratch_db = open_db(read_only_uri(scratch_db_path))
+
+    try:
+        log.info('  build profile {}: {} (scratch)'.format(
+            profile, pragmas_str(apply_build_profile(scratch_db, profile))))
+
+        def fill(output_db):
+            applied = apply_build_profile(output_db, profile)
+            log.info('  build profile {}: {} (output)'.format(
+                profile, pragmas_str(applied)))
+
+            with output_db:
+                fill_output_db(output_db, scratch_db)
+                write_build_info(output_db, scratch_fingerprint)
+
+        # the output DB is smaller than the scratch DB
+        build_db(output_db_tmp_path, fill,
+                 estimated_size=getsize(scratch_db_path),
+                 memory_budget=memory_budget)
+    finally:
+        scratch_db.close()
+
+
+def fill_output_db(output_db, scratch_db):
+    """Run every builder in OUTPUT_BUILDERS, in order, writing directly
+    into *output_db*."""
+    for builder in OUTPUT_BUILDERS:
+        run_builder(builder, output_db, scratch_db)
+
+
+def show_output_tables():
+    """List all the tables that builders write, in order."""
+    return [table_name for builder in OUTPUT_BUILDERS
+            for table_name in builder['writes']]
+
+
+def run_builder(builder, output_db, scratch_db):
+    """Run a builder from OUTPUT_BUILDERS, recording it as a stage
+    (see msd.report). Rows in are all the rows the builder fetches from
+    either DB; rows out are the rows in the tables it writes. We also
+    record how the builder used each cache (see msd.cache)."""
+    with stage('build_output_table', table=builder['writes'][0],
+               writes=builder['writes']) as record, \
+            record_cache_stats(record):
+        num_rows_in = [0]
+
+        def count_rows_in(row_factory):
+            def counting_row_factory(cursor, row):
+                num_rows_in[0] += 1
+                return row_factory(cursor, row) if row_factory else row
+
+            return counting_row_factory
+
+        output_row_factory = output_db.row_factory
+        scratch_row_factory = scratch_db.row_factory
+
+        output_db.row_factory = count_rows_in(output_row_factory)
+        scratch_db.row_factory = count_rows_in(scratch_row_factory)
+        try:
+            builder['build'](output_db, scratch_db)
+        finally:
+            output_db.row_factory = output_row_factory
+            scratch_db.row_factory = scratch_row_factory
+
+        record['rows_in'] = num_rows_in[0]
+        record['rows_out'] = count_rows(output_db, builder['writes'])
+
+
+def get_builder_dependencies():
+    """Return a list containing, for each builder in OUTPUT_BUILDERS,
+    the set of indexes of builders that write the tables it reads.
+
+    Raises ValueError unless every table read is written by exactly one
+    builder that comes before it.
+    """
+    table_to_writer = {}
+    dependencies = []
+
+    for i, builder in enumerate(OUTPUT_BUILDERS):
+        deps = set()
+        for table_name in builder['reads']:
+            if table_name not in table_to_writer:
+                raise ValueError(
+                    '{} reads {}, which no earlier builder writes'.format(
+                        builder['build'].__name__, table_name))
+            deps.add(table_to_writer[table_name])
+
+        dependencies.append(deps)
+
+        for table_name in builder['writes']:
+            if table_name in table_to_writer:
+                raise ValueError('more than one builder writes {}'.format(
+                    table_name))
+            table_to_writer[table_name] = i
+
+    return dependencies
+
+
+def get_staging_dir(output_db_path):
+    """Where build_output_db() puts staging DBs for the given output DB
+    (e.g. msd.sqlite -> msd.sqlite.staging)."""
+    return output_db_path + '.staging'
+
+
+def build_staging_dbs(scratch_db_path, staging_dir, *,
+                      jobs=1, profile=DEFAULT_BUILD_PROFILE, resume=False,
+                      scratch_fingerprint=None):
+    """Run each builder in OUTPUT_BUILDERS into its own staging DB in
+    *staging_dir*. Returns a list of staging DB paths, one per builder.
+
+    If *jobs* is more than 1, run each builder in a pool of that many
+    processes as soon as its dependencies are done.
+
+    If *resume* is true, skip builders whose staging DBs are already
+    done (see select_reusable_builders()).
+    """
+    dependencies = get_builder_dependencies()
+
+    staging_db_paths = [join(staging_dir, '{:d}.sqlite'.format(i))
+                        for i in range(len(OUTPUT_BUILDERS))]
+
+    if scratch_fingerprint is None:
+        scratch_fingerprint = get_scratch_fingerprint(scratch_db_path)
+
+    if resume:
+        done = select_reusable_builders(
+            staging_db_paths, scratch_fingerprint)
+    else:
+        done = set()
+
+    for i, builder in enumerate(OUTPUT_BUILDERS):
+        if i in done:
+            log.info('  reusing {} table from {}'.format(
+                builder['writes'][0], staging_db_paths[i]))
+        elif exists(staging_db_paths[i]):
+            # left over from a builder that didn't finish
+            remove(staging_db_paths[i])
+
+    def args(i):
+        return (i, scratch_db_path, staging_db_paths,
+                sorted(dependencies[i]), profile, scratch_fingerprint)
+
+    if jobs > 1 and not can_fork_workers():
+        # worker processes must share our hash seed, so that builders
+        # iterate through sets in the same order they would here
+        log.warning("can't fork, so building output tables serially")
+        jobs = 1
+
+    if jobs <= 1:
+        # OUTPUT_BUILDERS is in dependency order. Stages get recorded
+        # in this process, so we can ignore the return value
+        for i in range(len(OUTPUT_BUILDERS)):
+            if i not in done:
+                build_staging_db(*args(i))
+
+        return staging_db_paths
+
+    with ProcessPoolExecutor(
+            max_workers=jobs, **fork_executor_kwargs()) as executor:
+
+        future_to_index = {}
+        started = set(done)
+
+        while len(done) < len(OUTPUT_BUILDERS):
+            for i, deps in enumerate(dependencies):
+                if i not in started and deps <= done:
+                    future = executor.submit(build_staging_db, *args(i))
+                    future_to_index[future] = i
+                    started.add(i)
+
+            finished, _ = wait(future_to_index, return_when=FIRST_COMPLETED)
+
+            for future in finished:
+                # also re-raises errors from the builder
+                add_stages(future.result())
+                done.add(future_to_index.pop(future))
+
+    return staging_db_paths
+
+
+def can_fork_workers():
+    """Can ProcessPoolExecutor fork its worker processes?"""
+    if sys.version_info >= (3, 7):
+        return 'fork' in multiprocessing.get_all_start_methods()
+    elif sys.version_info >= (3, 4):
+        # no mp_context; workers use the default start method
+        return multiprocessing.get_start_method() == 'fork'
+    else:
+        # no start methods at all; Unix always forks
+        return sys.platform != 'win32'
+
+
+def fork_executor_kwargs():
+    """Keyword arguments to make ProcessPoolExecutor fork its worker
+    processes (mp_context is new in Python 3.7; before that, it uses
+    the default start method, see can_fork_workers())."""
+    if sys.version_info >= (3, 7):
+        return dict(mp_context=multiprocessing.get_context('fork'))
+    else:
+        return {}
+
+
+def build_staging_db(i, scratch_db_path, staging_db_paths, deps,
+                     profile=DEFAULT_BUILD_PROFILE, scratch_fingerprint=None):
+    """Run the *i*th builder in OUTPUT_BUILDERS, writing into a new
+    staging DB at staging_db_paths[i]. The staging DBs of the builders
+    in *deps* are attached read-only, so that the builder can read the
+    tables they wrote.
+
+    When the builder is done, write a checkpoint (see CHECKPOINT_TABLE)
+    recording *scratch_fingerprint* and the current max company key
+    frequency (see msd.company.set_max_company_key_freq()), so that we
+    can resume from this staging DB if the output build doesn't finish.
+
+    Returns a list of stages recorded (see msd.report) while building.
+    """
+    builder = OUTPUT_BUILDERS[i]
+    num_stages = len(get_stages())
+
+    scratch_db = open_db(read_only_uri(scratch_db_path))
+    staging_db = open_db(staging_db_paths[i])
+
+    try:
+        apply_build_profile(scratch_db, profile)
+        apply_build_profile(staging_db, profile)
+
+        # SQLite looks up tables in main first, then attached DBs
+        for j in deps:
+            staging_db.execute('ATTACH DATABASE ? AS dep_{:d}'.format(j),
+                               [read_only_uri(staging_db_paths[j])])
+
+        with staging_db:
+            run_builder(builder, staging_db, scratch_db)
+
+        for j in deps:
+            staging_db.execute('DETACH DATABASE dep_{:d}'.format(j))
+
+        with staging_db:
+            create_table(staging_db, CHECKPOINT_TABLE, CHECKPOINT_COLUMNS)
+            staging_db.execute(
+                'INSERT INTO `{}` (builder, scratch_fingerprint,'
+                ' max_company_key_freq) VALUES (?, ?, ?)'.format(
+                    CHECKPOINT_TABLE),
+                [builder['build'].__name__, scratch_fingerprint,
+                 get_max_company_key_freq()])
+    finally:
+        staging_db.close()
+        scratch_db.close()
+
+    return get_stages(num_stages)
+
+
+def write_build_info(output_db, scratch_fingerprint):
+    """Record that *output_db* was built from a scratch DB with the
+    given fingerprint (see msd.scratch.get_scratch_fingerprint()), with
+    the current max company key frequency."""
+    output_db.execute('DROP TABLE IF EXISTS `{}`'.format(BUILD_INFO_TABLE))
+    create_table(output_db, BUILD_INFO_TABLE, BUILD_INFO_COLUMNS)
+    output_db.execute(
+        'INSERT INTO `{}` (scratch_fingerprint, max_company_key_freq)'
+        ' VALUES (?, ?)'.format(BUILD_INFO_TABLE),
+        [scratch_fingerprint, get_max_company_key_freq()])
+
+
+def select_build_info(output_db_path):
+    """Get the build info from the given output DB, as a dict, or None
+    if it doesn't exist or doesn't have any."""
+    if not exists(output_db_path):
+        return None
+
+    with open_db(read_only_uri(output_db_path)) as output_db:
+        if BUILD_INFO_TABLE not in show_tables(output_db):
+            build_info = None
+        else:
+            row = output_db.execute(
+                'SELECT * FROM `{}`'.format(BUILD_INFO_TABLE)).fetchone()
+            build_info = dict(row) if row else None
+    output_db.close()
+
+    return build_info
+
+
+def select_reusable_builders(staging_db_paths, scratch_fingerprint):
+    """Return the set of indexes of builders in OUTPUT_BUILDERS whose
+    staging DBs we can reuse.
+
+    A staging DB is reusable if it has a checkpoint for the same builder,
+    *scratch_fingerprint*, and max company key frequency, and the
+    staging DBs of the builders it depends on are reusable too.
+    """
+    dependencies = get_builder_dependencies()
+    reusable = set()
+
+    # OUTPUT_BUILDERS is in dependency order
+    for i, builder in enumerate(OUTPUT_BUILDERS):
+        if not dependencies[i] <= reusable:
+            continue
+
+        checkpoint = select_checkpoint(staging_db_paths[i])
+        if checkpoint == dict(
+                builder=builder['build'].__name__,
+                scratch_fingerprint=scratch_fingerprint,
+                max_company_key_freq=get_max_company_key_freq()):
+            reusable.add(i)
+
+    return reusable
+
+
+def select_checkpoint(staging_db_path):
+    """Get the checkpoint from the given staging DB, as a dict, or None
+    if it doesn't exist or isn't finished."""
+    if not exists(staging_db_path):
+        return None
+
+    with open_db(read_only_uri(staging_db_path)) as staging_db:
+        sql = ("SELECT 1 FROM sqlite_master WHERE type = 'table'"
+               " AND name = ?")
+        if not staging_db.execute(sql, [CHECKPOINT_TABLE]).fetchone():
+            checkpoint = None
+        else:
+            # checkpoints from older versions may lack some columns
+            row = staging_db.execute(
+                'SELECT * FROM `{}`'.format(CHECKPOINT_TABLE)).fetchone()
+            checkpoint = dict(row) if row else None
+    staging_db.close()
+
+    return checkpoint
+
+
+def merge_staging_dbs(output_db, staging_db_paths):
+    """Copy the tables from each builder's staging DB into *output_db*,
+    in the order of OUTPUT_BUILDERS, preserving row order."""
+    for builder, staging_db_path in zip(OUTPUT_BUILDERS, staging_db_paths):
+        output_db.execute('ATTACH DATABASE ? AS staging',
+                          [read_only_uri(staging_db_path)])
+        try:
+            with output_db:
+                for table_name in builder['writes']:
+                    create_output_table(output_db, table_name)
+
+                    cols = col_sql(get_schema(table_name).col_names)
+                    output_db.execute(
+                        'INSERT INTO main.`{}` ({}) SELECT {} FROM'
+                        ' staging.`{}` ORDER BY rowid'.format(
+                            table_name, cols, cols, table_name))
+        finally:
+            output_db.execute('DETACH DATABASE staging')
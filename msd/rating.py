@@ -14,51 +14,60 @@
 from logging import getLogger
 
 
+from .merge import OutputWriter
 from .merge import create_output_table
 from .merge import merge_dicts
-from .merge import output_row
 from .target import select_groups_by_target
 
 log = getLogger(__name__)
 
 
-def build_rating_table(output_db, scratch_db):
+def build_rating_table(output_db, scratch_db, companies=None):
+    """Build the rating table.
+
+    If *companies* is set, only build rows for those companies (and
+    their brands), adding them to the existing table (see
+    msd.incremental).
+    """
     log.info('  building rating table')
-    create_output_table(output_db, 'rating')
+    if companies is None:
+        create_output_table(output_db, 'rating')
 
     def keyfunc(row):
         return row['campaign_id']
 
-    # slice by target
-    for (company, brand), campaign_id, rating_rows in \
-        select_groups_by_target(
-            output_db, scratch_db, 'rating', ['campaign_id']):
+    with OutputWriter(output_db, 'rating') as rating_writer:
+        # slice by target
+        for (company, brand), campaign_id, rating_rows in \
+            select_groups_by_target(
+                output_db, scratch_db, 'rating', ['campaign_id'],
+                companies=companies):
 
-        if not (campaign_id):
-            continue
+            if not (campaign_id):
+                continue
 
-        rating_row = merge_dicts(rating_rows)
+            rating_row = merge_dicts(rating_rows)
 
-        rating_row['company'] = company
-        rating_row['brand'] = brand
-        if rating_row['grade']:
-            rating_row['grade'] = str(rating_row['grade']).upper()
+            rating_row['company'] = company
+            rating_row['brand'] = brand
+            if rating_row['grade']:
+                rating_row['grade'] = str(rating_row['grade']).upper()
 
-        rating_row['judgment'] = fix_judgment(rating_row['judgment'])
+            rating_row['judgment'] = fix_judgment(rating_row['judgment'])
 
-        if rating_row['judgment'] is None and rating_row['grade']:
-            rating_row['judgment'] = grade_to_judgment(rating_row['grade'])
+            if rating_row['judgment'] is None and rating_row['grade']:
+                rating_row['judgment'] = grade_to_judgment(rating_row['grade'])
 
-        if rating_row['judgment'] is None:
-            continue
+            if rating_row['judgment'] is None:
+                continue
 
-        # fill min_score
-        if (rating_row.get('score') is not None and
-            rating_row.get('min_score') is None):
+            # fill min_score
+            if (rating_row.get('score') is not None and
+                rating_row.get('min_score') is None):
 
-            rating_row['min_score'] = 0
+                rating_row['min_score'] = 0
 
-        output_row(output_db, 'rating', rating_row)
+            rating_writer.add(rating_row)
 
 
 def fix_judgment(judgment):
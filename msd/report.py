@@ -0,0 +1,124 @@
+# Copyright 2016 SpendRight, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Record how long each stage of the build takes, and write it to
+a JSON report."""
+import json
+import sys
+from contextlib import contextmanager
+from os import getpid
+from os.path import splitext
+from time import perf_counter
+from time import process_time
+
+import msd
+from msd.cache import sum_cache_stats
+
+# resource is Unix-only
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# stages recorded in this process, in the order they finished
+_stages = []
+
+
+@contextmanager
+def stage(name, **info):
+    """Time the code inside this context manager, and record it as
+    a stage named *name*. Keyword arguments are added to the record.
+
+    Yields the record (a dict), so you can fill in rows_in and rows_out.
+    When done, it also contains wall_time and cpu_time (in seconds),
+    peak_rss (bytes, if we can tell), and the pid of the process.
+
+    cpu_time is only for this process, not any worker processes.
+    """
+    record = dict(name=name, rows_in=None, rows_out=None)
+    record.update(info)
+
+    start_wall = perf_counter()
+    start_cpu = process_time()
+
+    yield record
+
+    record['wall_time'] = perf_counter() - start_wall
+    record['cpu_time'] = process_time() - start_cpu
+    record['peak_rss'] = get_peak_rss()
+    record['pid'] = getpid()
+
+    _stages.append(record)
+
+
+def get_peak_rss():
+    """Return the peak resident set size of this process in bytes,
+    or None if we can't tell on this platform."""
+    if resource is None:
+        return None
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # macOS reports bytes, everything else reports KiB
+    if sys.platform == 'darwin':
+        return maxrss
+    else:
+        return maxrss * 1024
+
+
+def get_stages(start=0):
+    """Get the stages recorded in this process, starting at index *start*.
+
+    Worker processes should use this to pass their stages back to
+    the parent (which can call add_stages()).
+    """
+    return _stages[start:]
+
+
+def add_stages(stages):
+    """Add stages recorded in another process."""
+    _stages.extend(stages)
+
+
+def discard_stages(start):
+    """Forget the stages recorded in this process starting at index
+    *start* (e.g. for work that's going to be done over)."""
+    del _stages[start:]
+
+
+def clear_stages():
+    del _stages[:]
+
+
+def get_report_path(output_db_path):
+    """Where to put the report for the given output DB (e.g. msd.sqlite ->
+    msd.report.json)."""
+    return splitext(output_db_path)[0] + '.report.json'
+
+
+def write_report(report_path, stages=None):
+    """Write a JSON report of the given stages (by default, all the stages
+    recorded in this process), and the total hits, misses, and evictions
+    for each cache during those stages (see msd.cache)."""
+    if stages is None:
+        stages = get_stages()
+
+    report = dict(
+        caches=sum_cache_stats(stages),
+        msd_version=msd.__version__,
+        stages=stages,
+    )
+
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write('\n')
@@ -0,0 +1,150 @@
+# Copyright 2016 SpendRight, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compiled versions of the table definitions in msd.table.TABLES, so
+we don't have to work out the same things from them for every row."""
+from types import MappingProxyType
+
+from .db import build_insert_sql
+from .table import TABLES
+
+
+class TableSchema(object):
+    """Everything we need to know about one table in TABLES, worked out
+    ahead of time. Use get_schema() rather than creating these directly.
+
+    Output tables have the columns in the table definition. Scratch
+    tables also have a scraper_id column.
+    """
+    __slots__ = (
+        '_key_defaults',
+        '_strip_scraper_id',
+        'bool_cols',
+        'col_names',
+        'col_set',
+        'columns',
+        'indexes',
+        'insert_sql',
+        'name',
+        'primary_key',
+        'scratch_col_names',
+        'scratch_col_set',
+        'scratch_insert_sql',
+        'table_def',
+        'text_key_cols',
+    )
+
+    def __init__(self, name, table_def):
+        columns = table_def['columns']
+        col_names = tuple(sorted(columns))
+        scratch_col_names = tuple(sorted(set(columns) | {'scraper_id'}))
+        primary_key = tuple(table_def.get('primary_key', ()))
+
+        # the table definition this was compiled from (see get_schema())
+        self.table_def = table_def
+
+        self.name = name
+        self.columns = MappingProxyType(dict(columns))  # name -> type
+        self.col_names = col_names
+        self.col_set = frozenset(col_names)
+        self.primary_key = primary_key
+        self.indexes = tuple(tuple(index_cols) for index_cols in
+                             table_def.get('indexes', ()))
+
+        # is_* columns, which are always 0 or 1 in the output DB
+        self.bool_cols = tuple(c for c in col_names if c.startswith('is_'))
+
+        # primary key columns we make non-null in the scratch DB
+        self.text_key_cols = frozenset(
+            c for c in primary_key if columns.get(c) == 'text')
+
+        self.scratch_col_names = scratch_col_names
+        self.scratch_col_set = frozenset(scratch_col_names)
+
+        # to insert rows into the output and scratch DBs (see
+        # msd.merge.OutputWriter and msd.scratch.dump_table_to_scratch())
+        self.insert_sql = build_insert_sql(name, col_names)
+        self.scratch_insert_sql = build_insert_sql(name, scratch_col_names)
+
+        # (the url table's primary key includes scraper_id, which only
+        # exists in the scratch DB)
+        self._strip_scraper_id = 'scraper_id' not in columns
+        self._key_defaults = tuple(
+            (c, '' if columns[c] == 'text' else 0)
+            for c in primary_key if c in columns)
+
+    def __setattr__(self, name, value):
+        if hasattr(self, name):
+            raise AttributeError("can't modify {}".format(name))
+        super(TableSchema, self).__setattr__(name, value)
+
+    def __repr__(self):
+        return '<TableSchema {}>'.format(self.name)
+
+    def clean_output_row(self, row):
+        """Return a cleaned copy of row (a dict) for the output DB
+        (see msd.merge.clean_output_row())."""
+        row = row.copy()
+
+        if self._strip_scraper_id:
+            row.pop('scraper_id', None)
+
+        for k, default in self._key_defaults:
+            if row.get(k) is None:
+                row[k] = default
+
+        for k in self.bool_cols:
+            row[k] = int(bool(row.get(k)))
+
+        return row
+
+
+# table name -> TableSchema
+_schemas = {}
+
+# TableSchemas for every table, sorted by name (see get_schemas())
+_sorted_schemas = ()
+
+
+def get_schema(table_name):
+    """Get the TableSchema for the given table in TABLES, or raise
+    KeyError.
+
+    If TABLES[table_name] has been replaced since we compiled it (e.g.
+    patched by a test), compile it again.
+    """
+    table_def = TABLES[table_name]
+
+    schema = _schemas.get(table_name)
+    if schema is None or schema.table_def is not table_def:
+        schema = TableSchema(table_name, table_def)
+        _schemas[table_name] = schema
+
+    return schema
+
+
+def get_schemas():
+    """Get a tuple of TableSchemas for all tables in TABLES, sorted by
+    name."""
+    global _sorted_schemas
+
+    if not (len(_sorted_schemas) == len(TABLES) and all(
+            TABLES.get(s.name) is s.table_def for s in _sorted_schemas)):
+        _sorted_schemas = tuple(
+            get_schema(table_name) for table_name in sorted(TABLES))
+
+    return _sorted_schemas
+
+
+# compile everything once, up front
+get_schemas()
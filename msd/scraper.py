@@ -16,9 +16,9 @@
 from logging import getLogger
 
 from .db import select_groups
+from .merge import OutputWriter
 from .merge import create_output_table
 from .merge import merge_dicts
-from .merge import output_row
 
 log = getLogger(__name__)
 
@@ -27,11 +27,12 @@ def build_scraper_table(output_db, scratch_db):
     log.info('  building scraper table')
     create_output_table(output_db, 'scraper')
 
-    for (scraper_id,), rows in select_groups(
-            scratch_db, 'scraper', ['scraper_id']):
+    with OutputWriter(output_db, 'scraper') as scraper_writer:
+        for (scraper_id,), rows in select_groups(
+                scratch_db, 'scraper', ['scraper_id']):
 
-        if not scraper_id:
-            continue
+            if not scraper_id:
+                continue
 
-        scraper_row = merge_dicts(rows)
-        output_row(output_db, 'scraper', scraper_row)
+            scraper_row = merge_dicts(rows)
+            scraper_writer.add(scraper_row)
@@ -13,19 +13,53 @@
 # limitations under the License.
 """Building the scratch (intermediate) database."""
 import re
-import yaml
+from collections import Counter
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from functools import partial
+from hashlib import sha1
 from logging import getLogger
 from os import remove
 from os import rename
+from os import stat
+from os.path import abspath
+from os.path import basename
+from os.path import dirname
 from os.path import exists
+from os.path import isdir
+from os.path import join
 from os.path import normpath
-
+from os.path import split
+from sqlite3 import NotSupportedError
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from .cache import record_cache_stats
+from .db import DEFAULT_BUILD_PROFILE
+from .db import BulkInserter
+from .db import apply_build_profile
+from .db import apply_pragmas
+from .db import build_db
+from .db import col_sql
+from .db import count_rows
 from .db import create_index
 from .db import create_table
 from .db import insert_row
 from .db import open_db
+from .db import pragmas_str
+from .db import read_only_uri
 from .db import show_tables
+from .input import iter_table_file
+from .input import iter_yaml_tables
+from .input import list_table_files
+from .input import parse_table_file_name
 from .norm import clean_string
+from .report import add_stages
+from .report import get_stages
+from .report import stage
+from .schema import get_schema
+from .schema import get_schemas
 from .table import TABLES
 
 log = getLogger(__name__)
@@ -34,8 +68,42 @@ log = getLogger(__name__)
 _INPUT_PATH_RE = re.compile(
     r'^(?P<scraper_prefix>.*)\.(?P<extension>(sqlite|yaml))$', re.I)
 
-
-def build_scratch_db(scratch_db_path, input_db_paths):
+# extra table in the scratch DB, recording which inputs it was built from
+INPUT_FINGERPRINT_TABLE = 'input_fingerprint'
+
+INPUT_FINGERPRINT_COLUMNS = dict(
+    mtime='real',
+    path='text',
+    scraper_prefix='text',
+    sha1='text',
+    size='integer',
+)
+
+# sets of columns the output build needs all distinct values of. We
+# materialise these at the end of the scratch build; see
+# build_distinct_values_tables()
+DISTINCT_VALUES_COLS = [
+    ('scraper_id', 'category'),
+    ('scraper_id', 'company'),
+    ('scraper_id', 'company', 'brand'),
+    ('scraper_id', 'company', 'company_full'),
+    ('scraper_id', 'subcategory'),
+    ('scraper_id', 'subsidiary'),
+]
+
+# rough ratio of the size of the scratch DB to the total size of its
+# inputs (because of indexes etc.). Only used to decide whether to try
+# building the scratch DB in memory.
+SCRATCH_DB_SIZE_RATIO = 3
+
+# how much of an input file to read at a time when hashing it
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def build_scratch_db(scratch_db_path, input_db_paths, *,
+                     defer_indexes=True, force=False, jobs=1,
+                     keep_previous=False, memory_budget=0,
+                     profile=DEFAULT_BUILD_PROFILE):
     """Take data from the various input databases, and put it into
     a single, indexed database with correct table definitions.
 
@@ -48,58 +116,469 @@ def build_scratch_db(scratch_db_path, input_db_paths):
 
     This also cleans smart quotes, excess whitespace, etc. out of the
     input data.
+
+    We record a fingerprint (size, mtime, and SHA1 hash) of each input
+    in the scratch DB. Unless *force* is set, data for inputs that haven't
+    changed is copied straight from the existing scratch DB rather than
+    reloaded, and if no inputs have changed, we leave the scratch DB alone.
+    Either way, the result is the same as building from scratch.
+
+    If *defer_indexes* is true (the default), we load data into bare
+    tables and build indexes once all the data is in. This results in
+    the same database, but is a lot faster than updating indexes
+    on every insert.
+
+    If *jobs* is more than 1, we load each input into its own temporary
+    "shard" database in a pool of that many processes, and then copy
+    the shards into the scratch DB in the same order as *input_db_paths*.
+    The scratch DB has the same rows in the same order no matter what
+    *jobs* is, but isn't byte-for-byte the same as one loaded serially.
+
+    *profile* is the name of the set of PRAGMAs (see
+    msd.db.BUILD_PROFILES) to use for the scratch DB and any shards.
+    Input databases are always attached read-only.
+
+    If *memory_budget* is set, and we estimate the scratch DB will fit
+    into that many bytes, we build it in memory, and write it to disk
+    at the end (see msd.db.build_db()).
+
+    If *keep_previous* is true, and we replace an existing scratch DB,
+    move it to get_previous_scratch_path() rather than deleting it (so
+    that msd.incremental can tell what changed). If there's already a
+    previous scratch DB there, the output DB hasn't caught up with it
+    yet, so we keep that one instead.
     """
+    num_stages = len(get_stages())
+
+    with stage('build_scratch_db', path=scratch_db_path,
+               up_to_date=False) as record:
+        input_db_paths = list(input_db_paths)
+
+        old_fingerprints = None
+        if exists(scratch_db_path) and not force:
+            old_fingerprints = select_input_fingerprints(scratch_db_path)
+
+        if old_fingerprints is None:
+            old_fingerprints = []
+            up_to_date = False
+        else:
+            up_to_date = ([fp['path'] for fp in old_fingerprints] ==
+                          [normpath(path) for path in input_db_paths])
+
+        path_to_old_fingerprint = {
+            fp['path']: fp for fp in old_fingerprints}
+
+        fingerprints = [
+            fingerprint_input(
+                path, path_to_old_fingerprint.get(normpath(path)))
+            for path in input_db_paths]
+
+        reusable_paths = _select_reusable_paths(
+            fingerprints, old_fingerprints)
+
+        if up_to_date and len(reusable_paths) == len(input_db_paths):
+            log.info('{} is up-to-date'.format(scratch_db_path))
+            record['up_to_date'] = True
+            return
+
+        scratch_db_tmp_path = scratch_db_path + '.tmp'
+        if exists(scratch_db_tmp_path):
+            remove(scratch_db_tmp_path)
+
+        log.info('building {}...'.format(scratch_db_tmp_path))
+
+        build_db(scratch_db_tmp_path,
+                 partial(fill_scratch_db,
+                         scratch_db_path=scratch_db_path,
+                         input_db_paths=input_db_paths,
+                         fingerprints=fingerprints,
+                         reusable_paths=reusable_paths,
+                         defer_indexes=defer_indexes,
+                         jobs=jobs,
+                         profile=profile),
+                 estimated_size=SCRATCH_DB_SIZE_RATIO * sum(
+                     fp['size'] for fp in fingerprints),
+                 memory_budget=memory_budget)
+
+        previous_scratch_db_path = get_previous_scratch_path(scratch_db_path)
+        if (keep_previous and exists(scratch_db_path) and
+                not exists(previous_scratch_db_path)):
+            log.info('moving {} -> {}'.format(
+                scratch_db_path, previous_scratch_db_path))
+            rename(scratch_db_path, previous_scratch_db_path)
+
+        log.info('moving {} -> {}'.format(
+            scratch_db_tmp_path, scratch_db_path))
+        rename(scratch_db_tmp_path, scratch_db_path)
+
+        # rows loaded from inputs (including by worker processes)
+        record['rows_in'] = sum(
+            r['rows_in'] for r in get_stages(num_stages)
+            if r['name'] in ('copy_table_to_scratch',
+                             'dump_table_to_scratch'))
+
+        with open_db(read_only_uri(scratch_db_path)) as scratch_db:
+            record['rows_out'] = count_rows(scratch_db, sorted(TABLES))
+        scratch_db.close()
+
+
+def get_previous_scratch_path(scratch_db_path):
+    """Where build_scratch_db() keeps the scratch DB it replaced, if
+    asked to (e.g. msd-scratch.sqlite -> msd-scratch.sqlite.prev)."""
+    return scratch_db_path + '.prev'
+
+
+def fill_scratch_db(scratch_db, *, scratch_db_path, input_db_paths,
+                    fingerprints, reusable_paths, defer_indexes=True, jobs=1,
+                    profile=DEFAULT_BUILD_PROFILE):
+    """Load data into the new (empty) DB *scratch_db*, which will
+    replace the one at *scratch_db_path*. Rows for inputs in
+    *reusable_paths* are copied from the old scratch DB. Helper for
+    build_scratch_db()."""
     scratch_db_tmp_path = scratch_db_path + '.tmp'
-    if exists(scratch_db_tmp_path):
-        remove(scratch_db_tmp_path)
 
-    log.info('building {}...'.format(scratch_db_tmp_path))
+    paths_to_load = [path for path in input_db_paths
+                     if normpath(path) not in reusable_paths]
+
+    with ExitStack() as stack:
+        log.info('  build profile {}: {}'.format(
+            profile, pragmas_str(apply_build_profile(scratch_db, profile))))
+
+        create_scratch_tables(scratch_db, indexes=not defer_indexes)
+        create_table(scratch_db, INPUT_FINGERPRINT_TABLE,
+                     INPUT_FINGERPRINT_COLUMNS)
+
+        if reusable_paths:
+            scratch_db.execute(
+                'ATTACH DATABASE ? AS old', [read_only_uri(scratch_db_path)])
+            stack.callback(scratch_db.execute, 'DETACH DATABASE old')
+
+        shard_results = None
+        if jobs > 1 and len(paths_to_load) > 1:
+            # put shards next to the scratch DB, not in (possibly small) /tmp
+            shard_dir = stack.enter_context(TemporaryDirectory(
+                prefix='msd-shards-',
+                dir=dirname(abspath(scratch_db_tmp_path))))
+            executor = stack.enter_context(
+                ProcessPoolExecutor(max_workers=jobs))
+
+            # map() yields results in order, so we can merge each shard
+            # while later inputs are still loading
+            shard_results = executor.map(
+                build_shard, paths_to_load,
+                [join(shard_dir, '{:d}.sqlite'.format(i))
+                 for i in range(len(paths_to_load))],
+                [profile] * len(paths_to_load))
+
+        for input_db_path, fingerprint in zip(input_db_paths, fingerprints):
+            if fingerprint['path'] in reusable_paths:
+                log.info('reusing data from {} (unchanged)'.format(
+                    input_db_path))
+                copy_rows(scratch_db, 'old',
+                          *_namespace_sql(fingerprint['scraper_prefix']))
+            elif shard_results:
+                log.info('merging shard for {}'.format(input_db_path))
+                shard_path, stages = next(shard_results)
+                add_stages(stages)
+                merge_shard(scratch_db, shard_path)
+            else:
+                log.info('dumping data from {} -> {}'.format(
+                    input_db_path, scratch_db_tmp_path))
+                dump_input_to_scratch(input_db_path, scratch_db)
 
-    with open_db(scratch_db_tmp_path) as scratch_db:
+            with scratch_db:
+                insert_row(scratch_db, INPUT_FINGERPRINT_TABLE, fingerprint)
 
-        create_scratch_tables(scratch_db)
+        if defer_indexes:
+            create_scratch_indexes(scratch_db)
 
-        for input_db_path in input_db_paths:
-            log.info('dumping data from {} -> {}'.format(
-                input_db_path, scratch_db_tmp_path))
+        build_distinct_values_tables(scratch_db)
 
-            scraper_prefix, file_type = parse_input_path(input_db_path)
 
-            if file_type == 'sqlite':
-                with open_db(input_db_path) as input_db:
-                    dump_db_to_scratch(input_db, scratch_db, scraper_prefix)
-            else:
-                assert file_type == 'yaml'
-                with open(input_db_path, mode='rb') as input_yaml:
-                    dump_yaml_to_scratch(
-                        input_yaml, scratch_db, scraper_prefix)
+def fingerprint_input(input_db_path, old_fingerprint=None):
+    """Get a fingerprint for the given input, as a dict with the keys
+    path, scraper_prefix, size, mtime, and sha1.
+
+    If size and mtime match *old_fingerprint*, we trust its hash rather
+    than reading the entire file again.
+
+    For a directory, size is the total size of its table files, mtime
+    is the latest mtime of the directory and its table files, and sha1
+    covers the names and contents of the table files.
+    """
+    scraper_prefix, file_type = parse_input_path(input_db_path)
+
+    if file_type == 'dir':
+        table_file_paths = list_table_files(input_db_path)
+        table_file_sts = [stat(path) for path in table_file_paths]
+
+        size = sum(st.st_size for st in table_file_sts)
+        mtime = max([stat(input_db_path).st_mtime] +
+                    [st.st_mtime for st in table_file_sts])
+    else:
+        st = stat(input_db_path)
+        size = st.st_size
+        mtime = st.st_mtime
+
+    if (old_fingerprint and
+            old_fingerprint['size'] == size and
+            old_fingerprint['mtime'] == mtime):
+        sha1 = old_fingerprint['sha1']
+    elif file_type == 'dir':
+        sha1 = _hash_files(table_file_paths)
+    else:
+        sha1 = _hash_file(input_db_path)
+
+    return dict(
+        path=normpath(input_db_path),
+        scraper_prefix=scraper_prefix,
+        size=size,
+        mtime=mtime,
+        sha1=sha1,
+    )
+
+
+def _hash_file(path, h=None):
+    if h is None:
+        h = sha1()
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def _hash_files(paths):
+    h = sha1()
+
+    for path in paths:
+        # so that renaming or splitting files changes the hash
+        h.update('{}\0{:d}\0'.format(
+            basename(path), stat(path).st_size).encode('utf-8'))
+        _hash_file(path, h)
+
+    return h.hexdigest()
+
+
+def select_input_fingerprints(scratch_db_path):
+    """Get the input fingerprints recorded in the given scratch DB,
+    in the order inputs were loaded.
+
+    Returns None if the scratch DB doesn't have fingerprints, or
+    its tables don't match the current table definitions (so we can't
+    reuse any of it).
+    """
+    scratch_db = open_db(scratch_db_path)
+    try:
+        table_names = set(show_tables(scratch_db))
+
+        if INPUT_FINGERPRINT_TABLE not in table_names:
+            return None
+
+        for table_name in sorted(TABLES):
+            if table_name not in table_names:
+                return None
+
+            col_names = sorted(
+                row['name'] for row in scratch_db.execute(
+                    'PRAGMA table_info(`{}`)'.format(table_name)))
+            if col_names != scratch_col_names(table_name):
+                return None
+
+        return [dict(row) for row in scratch_db.execute(
+            'SELECT * FROM `{}` ORDER BY rowid'.format(
+                INPUT_FINGERPRINT_TABLE))]
+    finally:
+        scratch_db.close()
+
+
+def get_scratch_fingerprint(scratch_db_path):
+    """Get a fingerprint (a hex digest) for the contents of the given
+    scratch DB, so that we can tell if the output DB is being built
+    from the same data.
+
+    This is based on the input fingerprints, so it doesn't require
+    reading the entire scratch DB. A scratch DB without input
+    fingerprints gets a hash of the whole file.
+    """
+    fingerprints = select_input_fingerprints(scratch_db_path)
+
+    if fingerprints is None:
+        return _hash_file(scratch_db_path)
+
+    h = sha1()
+    for fp in fingerprints:
+        h.update('{}\0{}\0'.format(
+            fp['scraper_prefix'], fp['sha1']).encode('utf-8'))
+
+    return h.hexdigest()
+
+
+def _select_reusable_paths(fingerprints, old_fingerprints):
+    """Return the set of (normalized) paths of inputs that haven't
+    changed since the old scratch DB was built.
+
+    We don't reuse inputs whose namespace overlaps another input's
+    (e.g. "sr" and "sr.company") because we can't reliably tell
+    their rows apart. For the same reason, we don't reuse inputs that
+    are listed more than once (now or in the old scratch DB); each
+    copy gets loaded again, just as if we were building from scratch.
+    """
+    path_to_old_fingerprint = {fp['path']: fp for fp in old_fingerprints}
+
+    duplicate_paths = {
+        path for fps in (fingerprints, old_fingerprints)
+        for path, count in Counter(fp['path'] for fp in fps).items()
+        if count > 1}
+
+    prefix_to_paths = defaultdict(set)
+    for fp in fingerprints + old_fingerprints:
+        prefix_to_paths[fp['scraper_prefix']].add(fp['path'])
+
+    def overlaps_other_namespace(prefix):
+        return len(prefix_to_paths[prefix]) > 1 or any(
+            p.startswith(prefix + '.') or prefix.startswith(p + '.')
+            for p in prefix_to_paths)
+
+    reusable_paths = set()
 
-    log.info('moving {} -> {}'.format(scratch_db_tmp_path, scratch_db_path))
-    rename(scratch_db_tmp_path, scratch_db_path)
+    for fp in fingerprints:
+        old_fp = path_to_old_fingerprint.get(fp['path'])
 
+        if (old_fp and
+                fp['path'] not in duplicate_paths and
+                old_fp['sha1'] == fp['sha1'] and
+                old_fp['scraper_prefix'] == fp['scraper_prefix'] and
+                not overlaps_other_namespace(fp['scraper_prefix'])):
+            reusable_paths.add(fp['path'])
 
-def create_scratch_tables(scratch_db):
-    """Add tables to the given (open) SQLite DB."""
+    return reusable_paths
+
+
+def _namespace_sql(scraper_prefix):
+    """Return a WHERE clause and params that match rows from the input
+    with the given *scraper_prefix*."""
+    return ('scraper_id = ? OR substr(scraper_id, 1, ?) = ?',
+            [scraper_prefix, len(scraper_prefix) + 1, scraper_prefix + '.'])
+
+
+def dump_input_to_scratch(input_db_path, scratch_db):
+    """Dump data from the input file at the given path into the
+    given (open) scratch DB."""
+    scraper_prefix, file_type = parse_input_path(input_db_path)
+
+    if file_type == 'sqlite':
+        copy_db_to_scratch(input_db_path, scratch_db, scraper_prefix)
+    elif file_type == 'yaml':
+        with open(input_db_path, mode='rb') as input_yaml:
+            dump_yaml_to_scratch(input_yaml, scratch_db, scraper_prefix)
+    elif file_type == 'dir':
+        for path in list_table_files(input_db_path):
+            dump_table_file_to_scratch(path, scratch_db, scraper_prefix)
+    else:
+        assert file_type in ('csv', 'jsonl')
+        dump_table_file_to_scratch(input_db_path, scratch_db, scraper_prefix)
+
+
+def build_shard(input_db_path, shard_path, profile=DEFAULT_BUILD_PROFILE):
+    """Dump a single input into a new, unindexed scratch DB at
+    *shard_path*. Runs in a worker process. Returns *shard_path*
+    and a list of stages recorded (see msd.report) while loading it."""
+    num_stages = len(get_stages())
+
+    log.info('dumping data from {} -> {}'.format(input_db_path, shard_path))
+
+    with open_db(shard_path) as shard_db:
+        apply_build_profile(shard_db, profile)
+        create_scratch_tables(shard_db, indexes=False)
+        dump_input_to_scratch(input_db_path, shard_db)
+
+    shard_db.close()
+
+    return shard_path, get_stages(num_stages)
+
+
+def merge_shard(scratch_db, shard_path):
+    """Copy all rows from the shard DB at *shard_path* into
+    *scratch_db*, preserving their order."""
+    scratch_db.execute('ATTACH DATABASE ? AS shard',
+                       [read_only_uri(shard_path)])
+    try:
+        copy_rows(scratch_db, 'shard')
+    finally:
+        scratch_db.execute('DETACH DATABASE shard')
+
+
+def copy_rows(scratch_db, db_name, where_sql=None, params=()):
+    """Copy rows from scratch tables in the attached DB *db_name*
+    into *scratch_db*, preserving their order. Optionally, only copy rows
+    matching *where_sql*."""
+    with scratch_db:
+        for table_name in sorted(TABLES):
+            cols = col_sql(scratch_col_names(table_name))
+
+            select_sql = 'SELECT {} FROM {}.`{}`'.format(
+                cols, db_name, table_name)
+            if where_sql:
+                select_sql += ' WHERE ' + where_sql
+
+            scratch_db.execute(
+                'INSERT INTO main.`{}` ({}) {} ORDER BY rowid'.format(
+                    table_name, cols, select_sql),
+                params)
+
+
+def create_scratch_tables(scratch_db, indexes=True):
+    """Add tables to the given (open) SQLite DB.
+
+    If *indexes* is false, leave it to create_scratch_indexes() to
+    index the tables later.
+    """
     for table_name in sorted(TABLES):
-        create_scratch_table(scratch_db, table_name)
+        create_scratch_table(scratch_db, table_name, indexes=indexes)
+
 
+def scratch_col_names(table_name):
+    """Sorted list of columns in the given scratch table (which, unlike
+    output tables, always has a scraper_id column)."""
+    return list(get_schema(table_name).scratch_col_names)
 
-def create_scratch_table(scratch_db, table_name):
-    table_def = TABLES[table_name]
 
-    columns = table_def['columns'].copy()
+def create_scratch_table(scratch_db, table_name, indexes=True):
+    columns = dict(get_schema(table_name).columns)
     columns['scraper_id'] = 'text'
 
     create_table(scratch_db, table_name, columns)
 
+    if indexes:
+        create_scratch_table_indexes(scratch_db, table_name)
+
+
+def create_scratch_indexes(scratch_db):
+    """Index all tables created with create_scratch_tables(indexes=False).
+    """
+    log.info('indexing scratch tables')
+    start = perf_counter()
+
+    for table_name in sorted(TABLES):
+        create_scratch_table_indexes(scratch_db, table_name)
+
+    log.info('  indexed scratch tables in {:.1f}s'.format(
+        perf_counter() - start))
+
+
+def create_scratch_table_indexes(scratch_db, table_name):
+    schema = get_schema(table_name)
+
     # add "primary key" (non-unique) index
-    index_cols = list(table_def.get('primary_key', ()))
+    index_cols = list(schema.primary_key)
     if 'scraper_id' not in index_cols:
         index_cols = ['scraper_id'] + index_cols
     create_index(scratch_db, table_name, index_cols)
 
     # add other indexes
-    for index_cols in table_def.get('indexes', ()):
+    for index_cols in schema.indexes:
         create_index(scratch_db, table_name, index_cols)
 
 
@@ -107,12 +586,31 @@ def parse_input_path(path):
     """Parse an input path into (scraper_prefix, file_type), or raise
     ValueError.
 
-    file_type will be one of 'sqlite' or 'yaml'
+    file_type will be one of 'sqlite', 'yaml', 'csv', 'jsonl', or 'dir'
+
+    A directory (e.g. sr.company/) contains a CSV or JSON Lines file
+    for each table, named after the table (e.g. brand.csv, or
+    company.jsonl.gz; see msd.input.TABLE_FILE_RE). Its path is the
+    scraper prefix. A table file on its own gets its scraper prefix from
+    the directory it's in.
     """
+    if path and isdir(path):
+        return normpath(path), 'dir'
+
     m = _INPUT_PATH_RE.match(normpath(path))
-    if not m:
-        raise ValueError('Unknown input file type: {}'.format(path))
-    return m.group('scraper_prefix'), m.group('extension').lower()
+    if m:
+        return m.group('scraper_prefix'), m.group('extension').lower()
+
+    dir_path, file_name = split(normpath(path))
+    if dir_path:
+        try:
+            _, file_type = parse_table_file_name(file_name)
+        except ValueError:
+            pass
+        else:
+            return dir_path, file_type
+
+    raise ValueError('Unknown input file type: {}'.format(path))
 
 
 def dump_db_to_scratch(input_db, scratch_db, scraper_prefix=''):
@@ -130,65 +628,346 @@ def dump_db_to_scratch(input_db, scratch_db, scraper_prefix=''):
         dump_table_to_scratch(table_name, rows, scratch_db, scraper_prefix)
 
 
-def dump_yaml_to_scratch(input_yaml, scratch_db, scraper_prefix):
-    data = yaml.load(input_yaml)
+def copy_db_to_scratch(input_db_path, scratch_db, scraper_prefix=''):
+    """Like dump_db_to_scratch(), but ATTACH the input DB and copy each
+    table with a single INSERT ... SELECT, cleaning strings with
+    a SQL function, rather than pulling every row into Python."""
+    _create_clean_function(scratch_db)
+
+    scratch_db.execute('ATTACH DATABASE ? AS input_db',
+                       [read_only_uri(input_db_path)])
+    try:
+        # read the input through the same size mmap as the scratch DB
+        # (if any); safe because we opened the input read-only
+        mmap_size = scratch_db.execute('PRAGMA main.mmap_size').fetchone()
+        if mmap_size:
+            apply_pragmas(scratch_db, dict(mmap_size=mmap_size[0]),
+                          schema='input_db')
 
-    if not isinstance(data, dict):
-        raise TypeError('Expected YAML to be dictionary')
+        input_table_names = [row[0] for row in scratch_db.execute(
+            "SELECT name FROM input_db.sqlite_master WHERE type = 'table'")]
 
-    for table_name, rows in sorted(data.items()):
-        if not isinstance(rows, list):
-            raise TypeError(
-                'Expected rows for table {} to be list'.format(table_name))
+        for table_name in sorted(input_table_names):
+            copy_table_to_scratch(table_name, scratch_db, scraper_prefix)
+    finally:
+        scratch_db.execute('DETACH DATABASE input_db')
 
+
+def copy_table_to_scratch(table_name, scratch_db, scraper_prefix):
+    """Copy the given table from the attached DB "input_db" into
+    the scratch DB, with the same results as dump_table_to_scratch()."""
+    if table_name not in TABLES:
+        log.info('  ignoring extra table: {}'.format(table_name))
+        return
+
+    log.info('  copying table: {}'.format(table_name))
+
+    schema = get_schema(table_name)
+    start = perf_counter()
+
+    input_cols = {row[1] for row in scratch_db.execute(
+        'PRAGMA input_db.table_info(`{}`)'.format(table_name))}
+
+    extra_cols = sorted(input_cols - schema.scratch_col_set)
+    if extra_cols:
+        log.info('  ignoring extra columns in {}: {}'.format(
+            table_name, ', '.join(extra_cols)))
+
+    # see clean_input_row(); we make (text) primary key columns non-null
+    primary_key = schema.text_key_cols
+
+    def col_expr(col_name):
+        if col_name in input_cols:
+            expr = 'msd_clean(`{}`)'.format(col_name)
+            if col_name in primary_key:
+                expr = "coalesce({}, '')".format(expr)
+            return expr
+        elif col_name in primary_key:
+            return "''"
+        else:
+            return None
+
+    col_names = []
+    exprs = []
+    params = []
+
+    for col_name in schema.scratch_col_names:
+        expr = col_expr(col_name)
+
+        # namespace scraper_id (see InputPlan.scratch_values()). NULL
+        # means the same thing as no scraper_id at all
+        if col_name == 'scraper_id':
+            if expr is None:
+                expr = '?'
+                params.append(scraper_prefix)
+            else:
+                expr = "coalesce(? || '.' || {}, ?)".format(expr)
+                params.extend([scraper_prefix, scraper_prefix])
+
+        if expr is not None:
+            col_names.append(col_name)
+            exprs.append(expr)
+
+    with stage('copy_table_to_scratch', table=table_name,
+               scraper_prefix=scraper_prefix) as record, \
+            record_cache_stats(record):
+        with scratch_db:
+            cursor = scratch_db.execute(
+                'INSERT INTO main.`{}` ({}) SELECT {} FROM input_db.`{}`'
+                .format(table_name, col_sql(col_names), ', '.join(exprs),
+                        table_name),
+                params)
+
+        record['rows_in'] = record['rows_out'] = cursor.rowcount
+
+    _log_rows_per_sec(table_name, cursor.rowcount, perf_counter() - start)
+
+
+def _create_clean_function(db):
+    """Register msd_clean(), which is clean_string() for strings, and
+    does nothing to other values."""
+    try:
+        db.create_function('msd_clean', 1, _clean_value, deterministic=True)
+    except (NotSupportedError, TypeError):
+        # deterministic requires Python 3.8 and SQLite 3.8.3
+        db.create_function('msd_clean', 1, _clean_value)
+
+
+def _clean_value(value):
+    if isinstance(value, str):
+        return clean_string(value)
+    else:
+        return value
+
+
+def dump_yaml_to_scratch(input_yaml, scratch_db, scraper_prefix):
+    # read one row at a time, rather than loading the entire file
+    for table_name, rows in iter_yaml_tables(input_yaml):
         dump_table_to_scratch(table_name, rows, scratch_db, scraper_prefix)
 
 
+def dump_table_file_to_scratch(path, scratch_db, scraper_prefix):
+    """Stream rows from a single CSV or JSON Lines table file into
+    the scratch DB."""
+    table_name, _ = parse_table_file_name(basename(path))
+
+    # rows are read lazily, so ignored tables are never even opened
+    dump_table_to_scratch(
+        table_name, iter_table_file(path), scratch_db, scraper_prefix)
+
+
 def dump_table_to_scratch(table_name, rows, scratch_db, scraper_prefix):
+    """Clean the given rows (dicts or sqlite3.Rows), and insert them into
+    the given table in the scratch DB."""
     if table_name not in TABLES:
         log.info('  ignoring extra table: {}'.format(table_name))
         return
 
     log.info('  dumping table: {}'.format(table_name))
 
-    table_def = TABLES[table_name]
+    start = perf_counter()
+
+    # map from input columns to InputPlan. Input tables always have the
+    # same columns, but rows from YAML files might not
+    plans = {}
+
+    with stage('dump_table_to_scratch', table=table_name,
+               scraper_prefix=scraper_prefix) as record, \
+            record_cache_stats(record):
+        schema = get_schema(table_name)
+
+        with BulkInserter(scratch_db, table_name, schema.scratch_col_names,
+                          insert_sql=schema.scratch_insert_sql) as inserter:
+            for input_cols, values in _iter_row_tuples(rows):
+                plan = plans.get(input_cols)
 
-    for i, row in enumerate(rows):
-        row = dict(row)
+                if plan is None:
+                    plan = InputPlan(table_name, input_cols)
 
-        # deal with extra columns
-        if i == 0:  # only need to check once
-            expected_cols = set(table_def['columns']) | {'scraper_id'}
-            extra_cols = sorted(set(row) - expected_cols)
-            if extra_cols:
-                log.info('  ignoring extra columns in {}: {}'.format(
-                    table_name, ', '.join(extra_cols)))
+                    # deal with extra columns (only need to check once)
+                    if not plans and plan.extra_cols:
+                        log.info('  ignoring extra columns in {}: {}'.format(
+                            table_name, ', '.join(plan.extra_cols)))
 
-        # clean ugly data, dump extra columns
-        row = clean_input_row(row, table_name)
+                    plans[input_cols] = plan
 
-        # pick scraper_id
-        if 'scraper_id' in row:
-            row['scraper_id'] = scraper_prefix + '.' + row['scraper_id']
+                inserter.add_values(
+                    plan.scratch_values(values, scraper_prefix))
+
+        # every row we read gets inserted
+        record['rows_in'] = record['rows_out'] = inserter.num_rows
+
+    _log_rows_per_sec(table_name, inserter.num_rows, perf_counter() - start)
+
+
+def _iter_row_tuples(rows):
+    """Yield (input_cols, values) for each row, where both are tuples."""
+    input_cols = None
+
+    for row in rows:
+        if isinstance(row, dict):
+            yield tuple(row), tuple(row.values())
         else:
-            row['scraper_id'] = scraper_prefix
+            # rows from the same cursor all have the same columns
+            if input_cols is None:
+                input_cols = tuple(row.keys())
+            yield input_cols, tuple(row)
 
-        # insert!
-        insert_row(scratch_db, table_name, row)
 
+class InputPlan(object):
+    """How to clean rows of input data with a particular set of columns
+    and put them into a scratch table. Build this once per input table,
+    and then pass each row through as a tuple.
+
+    *cols* is the (sorted) columns we keep: columns that are in both the
+    input and the table definition, plus primary key columns, which
+    we make non-null.
+    """
+    def __init__(self, table_name, input_cols):
+        if table_name in TABLES:
+            schema = get_schema(table_name)
+            valid_cols = schema.scratch_col_set
+            # currently all our primary key columns are text
+            key_cols = schema.text_key_cols
+        else:
+            schema = None
+            valid_cols = {'scraper_id'}
+            key_cols = frozenset()
+
+        col_to_index = {col_name: i for i, col_name in enumerate(input_cols)}
+
+        self.table_name = table_name
+        self.cols = tuple(sorted((set(input_cols) & valid_cols) | key_cols))
+        self.extra_cols = tuple(sorted(set(input_cols) - valid_cols))
+
+        def getter(col_name):
+            # index of column in input (or None), default value
+            return (col_to_index.get(col_name),
+                    '' if col_name in key_cols else None)
+
+        self._getters = [getter(col_name) for col_name in self.cols]
+
+        # same thing, for every column in the scratch table
+        if schema is not None:
+            scratch_cols = schema.scratch_col_names
+            self._scratch_getters = [
+                getter(col_name) for col_name in scratch_cols]
+            self._scraper_id_index = scratch_cols.index('scraper_id')
+            self._has_scraper_id = 'scraper_id' in self.cols
+
+    def clean(self, values):
+        """Clean the given tuple of input values, returning a list of
+        values for *cols*."""
+        return _clean_values(values, self._getters)
+
+    def scratch_values(self, values, scraper_prefix):
+        """Clean the given tuple of input values, returning a list of
+        values for every column in the scratch table (see
+        scratch_col_names()), with namespaced scraper_id (a null
+        scraper_id is the same as not having one)."""
+        result = _clean_values(values, self._scratch_getters)
+
+        i = self._scraper_id_index
+        if self._has_scraper_id and result[i] is not None:
+            result[i] = scraper_prefix + '.' + result[i]
+        else:
+            result[i] = scraper_prefix
+
+        return result
+
+
+def _clean_values(values, getters):
+    result = []
+
+    for i, default in getters:
+        value = default if i is None else values[i]
+
+        if value is None:
+            value = default
+        elif isinstance(value, str):
+            value = clean_string(value)
+
+        result.append(value)
+
+    return result
+
+
+def _log_rows_per_sec(table_name, num_rows, elapsed):
+    # avoid dividing by zero on tiny tables
+    rate = num_rows / elapsed if elapsed > 0 else 0.0
+
+    log.info('  dumped {:d} rows into {} in {:.1f}s ({:.0f} rows/sec)'.format(
+        num_rows, table_name, elapsed, rate))
 
 
 def scratch_tables_with_cols(cols):
-    cols = set(cols)
-    return [table_name for table_name, table_def in sorted(TABLES.items())
-            if not (cols - set(table_def['columns']) - {'scraper_id'})]
+    cols = frozenset(cols)
+    return [schema.name for schema in get_schemas()
+            if cols <= schema.scratch_col_set]
+
+
+def distinct_values_table_name(cols):
+    return 'distinct_' + '_'.join(cols)
+
+
+def build_distinct_values_tables(scratch_db):
+    """For each set of columns in DISTINCT_VALUES_COLS, create a table
+    containing every distinct value of those columns in any scratch table,
+    so that get_distinct_values() doesn't have to scan every table again.
+
+    Values are inserted in the same order that scanning the tables would
+    find them.
+    """
+    log.info('building distinct values tables')
+    start = perf_counter()
+
+    with scratch_db:
+        for cols in DISTINCT_VALUES_COLS:
+            table_name = distinct_values_table_name(cols)
+            cols_sql = col_sql(cols)
+
+            # all of these columns are text
+            create_table(scratch_db, table_name, dict.fromkeys(cols, 'text'),
+                         primary_key=cols)
+
+            # the primary key doesn't stop duplicates with NULLs in
+            # them, so check for those with IS, which treats NULLs as equal
+            exists_sql = ' AND '.join(
+                'd.`{}` IS s.`{}`'.format(col, col) for col in cols)
+
+            for scratch_table_name in scratch_tables_with_cols(cols):
+                scratch_db.execute(
+                    'INSERT INTO `{}` ({}) SELECT {} FROM `{}` AS s'
+                    ' WHERE NOT EXISTS (SELECT 1 FROM `{}` AS d WHERE {})'
+                    ' GROUP BY {}'.format(
+                        table_name, cols_sql,
+                        ', '.join('s.`{}`'.format(col) for col in cols),
+                        scratch_table_name, table_name, exists_sql,
+                        cols_sql))
+
+    log.info('  built distinct values tables in {:.1f}s'.format(
+        perf_counter() - start))
 
 
 def get_distinct_values(scratch_db, cols):
     """Get all distinct values of the given list of columns from
-    any table that has all of the given columns."""
+    any table that has all of the given columns.
+
+    This reads from the table made by build_distinct_values_tables() if
+    there is one, and otherwise scans each table.
+    """
     values = set()
 
+    table_name = distinct_values_table_name(cols)
+    if (tuple(cols) in DISTINCT_VALUES_COLS and
+            table_name in show_tables(scratch_db)):
+        select_sql = 'SELECT {} FROM `{}` ORDER BY rowid'.format(
+            col_sql(cols), table_name)
+        for row in scratch_db.execute(select_sql):
+            values.add(tuple(row))
+
+        return values
+
     for table_name in scratch_tables_with_cols(cols):
         cols_sql = ', '.join('`{}`'.format(col) for col in cols)
 
@@ -202,27 +981,10 @@ def get_distinct_values(scratch_db, cols):
 
 def clean_input_row(row, table_name):
     """Clean each value in the given row of input data, and remove
-    extra columns."""
-    table_def = TABLES.get(table_name, {})
-    column_types = table_def.get('columns', {})
-    valid_cols = set(column_types) | {'scraper_id'}
-
-    cleaned = {}
-
-    for col_name, value in sorted(row.items()):
-        if col_name not in valid_cols:
-            continue
-
-        if isinstance(value, str):
-            value = clean_string(value)
+    extra columns.
 
-        cleaned[col_name] = value
-
-    # make sure primary key columns aren't null or unset
-    for key_col_name in table_def.get('primary_key', ()):
-        if cleaned.get(key_col_name) is None:
-            if column_types.get(key_col_name) == 'text':
-                cleaned[key_col_name] = ''
-            # currently all our primary key columns are text
-
-    return cleaned
+    (dump_table_to_scratch() uses InputPlan directly, so it doesn't have
+    to do this work for every row.)
+    """
+    plan = InputPlan(table_name, tuple(row))
+    return dict(zip(plan.cols, plan.clean(tuple(row.values()))))
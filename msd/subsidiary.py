@@ -15,8 +15,8 @@ from collections import defaultdict
 from logging import getLogger
 
 from .company import map_company
+from .merge import OutputWriter
 from .merge import create_output_table
-from .merge import output_row
 
 log = getLogger(__name__)
 
@@ -80,14 +80,15 @@ def build_subsidiary_table(output_db, scratch_db):
 
     # output rows
 
-    for company, ancestry in sorted(company_to_ancestry.items()):
-        for depth, ancestor in enumerate(reversed(ancestry)):
-            output_row(output_db, 'subsidiary', dict(
-                company=ancestor,
-                company_depth=depth,
-                subsidiary=company,
-                subsidiary_depth=len(ancestry),
-            ))
+    with OutputWriter(output_db, 'subsidiary') as subsidiary_writer:
+        for company, ancestry in sorted(company_to_ancestry.items()):
+            for depth, ancestor in enumerate(reversed(ancestry)):
+                subsidiary_writer.add(dict(
+                    company=ancestor,
+                    company_depth=depth,
+                    subsidiary=company,
+                    subsidiary_depth=len(ancestry),
+                ))
 
 
 def is_subsidiary(output_db, company):
@@ -33,16 +33,21 @@ def map_target(output_db, scraper_id, scraper_company, scraper_brand=''):
 
 
 def select_groups_by_target(
-        output_db, scratch_db, table_name, key_cols=()):
+        output_db, scratch_db, table_name, key_cols=(), companies=None):
     """Yield all rows from the given table, grouped by target (company/brand)
     and, optionally, key_cols.
 
+    If *companies* is set, only yield targets belonging to those companies.
+
     Yields (company, brand), (key_col_value, ...), [row]
     """
     if isinstance(key_cols, str):
         raise TypeError
 
     for (company, brand), target_map_rows in _select_target_groups(output_db):
+        if companies is not None and company not in companies:
+            continue
+
         key_to_rows = defaultdict(list)
 
         for row in _select_by_targets(
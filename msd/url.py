@@ -12,9 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """Merge in extra data scraped from a url."""
-from functools import lru_cache
-
-from .table import TABLES
+from .cache import cached
+from .schema import get_schema
 
 
 def match_urls(rows, scratch_db):
@@ -36,9 +35,10 @@ def match_urls(rows, scratch_db):
     return matches
 
 
-@lru_cache()
+# this only ever has one value
+@cached('match_urls_select_sql', 1)
 def _match_urls_select_sql():
-    cols = [c for c in TABLES['url']['columns']
+    cols = [c for c in get_schema('url').col_names
             if c not in {'last_scraped', 'scraper_id', 'url'}]
 
     return 'SELECT {} FROM url WHERE url = ?'.format(
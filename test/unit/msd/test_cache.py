@@ -0,0 +1,182 @@
+# Copyright 2016 SpendRight, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from unittest import TestCase
+from unittest.mock import patch
+
+import msd.cache
+from msd.cache import Cache
+from msd.cache import cached
+from msd.cache import clear_caches
+from msd.cache import diff_cache_stats
+from msd.cache import get_cache
+from msd.cache import parse_cache_size
+from msd.cache import record_cache_stats
+from msd.cache import set_cache_sizes
+from msd.cache import sum_cache_stats
+
+
+def double(x):
+    return x * 2
+
+
+class CacheTestCase(TestCase):
+
+    def setUp(self):
+        # don't touch msd's real caches
+        patcher = patch.object(msd.cache, '_caches', {})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class TestCache(CacheTestCase):
+
+    def test_call(self):
+        cache = Cache('double', double)
+
+        self.assertEqual(cache(2), 4)
+        self.assertEqual(cache(2), 4)
+        self.assertEqual(cache(3), 6)
+
+        self.assertEqual(cache.__name__, 'double')
+        self.assertEqual(
+            cache.stats(),
+            dict(hits=1, misses=2, evictions=0, size=2, maxsize=65536))
+
+    def test_evictions(self):
+        cache = Cache('double', double, 2)
+
+        for x in (1, 2, 3, 1):
+            cache(x)
+
+        self.assertEqual(
+            cache.stats(),
+            dict(hits=0, misses=4, evictions=2, size=2, maxsize=2))
+
+    def test_no_evictions_when_maxsize_is_zero(self):
+        cache = Cache('double', double, 0)
+
+        for x in (1, 2, 1):
+            self.assertEqual(cache(x), x * 2)
+
+        self.assertEqual(
+            cache.stats(),
+            dict(hits=0, misses=3, evictions=0, size=0, maxsize=0))
+
+    def test_set_maxsize(self):
+        cache = Cache('double', double, 2)
+        cache(1)
+
+        cache.set_maxsize(None)
+        self.assertEqual(
+            cache.stats(),
+            dict(hits=0, misses=0, evictions=0, size=0, maxsize=None))
+
+        for x in (1, 2, 3, 1):
+            cache(x)
+
+        self.assertEqual(cache.stats()['evictions'], 0)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_clear(self):
+        cache = Cache('double', double)
+        cache(1)
+        cache(1)
+
+        cache.clear()
+
+        self.assertEqual(cache.stats()['hits'], 0)
+        self.assertEqual(cache.stats()['size'], 0)
+
+
+class TestRegistry(CacheTestCase):
+
+    def test_cached(self):
+        @cached('triple', 10)
+        def triple(x):
+            return x * 3
+
+        self.assertEqual(triple(2), 6)
+        self.assertIs(get_cache('triple'), triple)
+        self.assertEqual(triple.maxsize, 10)
+
+    def test_duplicate_name(self):
+        cached('double')(double)
+        self.assertRaises(ValueError, cached('double'), double)
+
+    def test_set_cache_sizes(self):
+        cache = cached('double', 10)(double)
+
+        set_cache_sizes({'double': 1})
+        self.assertEqual(cache.maxsize, 1)
+
+        self.assertRaises(ValueError, set_cache_sizes, {'triple': 1})
+
+    def test_clear_caches(self):
+        cache = cached('double')(double)
+        cache(1)
+
+        clear_caches()
+
+        self.assertEqual(cache.stats()['misses'], 0)
+
+
+class TestParseCacheSize(TestCase):
+
+    def test_parse(self):
+        self.assertEqual(parse_cache_size('norm=100'), ('norm', 100))
+        self.assertEqual(parse_cache_size('norm=None'), ('norm', None))
+
+    def test_bad(self):
+        self.assertRaises(ValueError, parse_cache_size, 'norm')
+        self.assertRaises(ValueError, parse_cache_size, '=100')
+        self.assertRaises(ValueError, parse_cache_size, 'norm=lots')
+        self.assertRaises(ValueError, parse_cache_size, 'norm=-1')
+
+
+class TestCacheStats(CacheTestCase):
+
+    def test_diff_cache_stats(self):
+        self.assertEqual(
+            diff_cache_stats(
+                dict(foo=dict(hits=1, misses=2, evictions=0, size=2),
+                     bar=dict(hits=1, misses=2, evictions=0, size=2)),
+                dict(foo=dict(hits=4, misses=3, evictions=1, size=2),
+                     bar=dict(hits=1, misses=2, evictions=0, size=2))),
+            dict(foo=dict(hits=3, misses=1, evictions=1)))
+
+    def test_record_cache_stats(self):
+        cache = cached('double')(double)
+        cache(1)
+
+        with record_cache_stats(dict(name='foo')) as record:
+            cache(1)
+            cache(2)
+
+        self.assertEqual(
+            record,
+            dict(name='foo',
+                 caches=dict(double=dict(hits=1, misses=1, evictions=0))))
+
+    def test_sum_cache_stats(self):
+        cached('double', 10)(double)
+
+        self.assertEqual(
+            sum_cache_stats([
+                dict(name='foo',
+                     caches=dict(double=dict(hits=1, misses=1, evictions=0))),
+                dict(name='bar'),
+                dict(name='baz',
+                     caches=dict(double=dict(hits=2, misses=3, evictions=1))),
+            ]),
+            dict(double=dict(hits=3, misses=4, evictions=1, maxsize=10)))
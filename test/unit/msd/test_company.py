@@ -12,16 +12,26 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 from unittest import TestCase
+from unittest.mock import patch
+
+import msd.company
 
 from msd.company import build_company_name_and_scraper_company_map_tables
+from msd.company import build_company_table
 from msd.company import get_company_aliases
+from msd.company import get_company_keys
 from msd.company import get_company_names
+from msd.company import group_company_dicts
 from msd.company import pick_company_full
 from msd.company import pick_company_name
+from msd.company import select_company_dicts_with_keys
+from msd.report import clear_stages
+from msd.report import get_stages
 
 from ...db import DBTestCase
 from ...db import insert_rows
 from ...db import select_all
+from ...db import strip_null
 
 
 class TestGetCompanyNames(TestCase):
@@ -77,6 +87,35 @@ class TestGetCompanyAliases(TestCase):
                          {'Zappos.com', 'Zappos'})
 
 
+class TestGetCompanyKeys(TestCase):
+
+    def test_hyphen(self):
+        self.assertEqual(get_company_keys('Foo-Bar'),
+                         {'foo bar', 'foo-bar', 'foobar'})
+
+    def test_ampersand(self):
+        self.assertEqual(get_company_keys('AT&T'),
+                         {'at & t', 'at and t', 'at&t'})
+        self.assertEqual(
+            get_company_keys('Procter and Gamble'),
+            {'procter & gamble', 'procter and gamble', 'procter&gamble'})
+
+    def test_camel_case(self):
+        self.assertEqual(get_company_keys('babyGap'),
+                         {'baby gap', 'babygap'})
+
+    def test_periods(self):
+        self.assertEqual(get_company_keys('G.I. Joe'),
+                         {'g. i. joe', 'g.i. joe', 'gi joe'})
+
+    def test_accents_and_apostrophe(self):
+        self.assertEqual(get_company_keys("L'Or\xe9al"),
+                         {"l'oreal", 'loreal'})
+
+    def test_too_short(self):
+        self.assertEqual(get_company_keys('A'), set())
+
+
 class TestPickCompanyName(TestCase):
 
     def test_empty(self):
@@ -231,6 +270,36 @@ class TestBuildCompanyNameAndScraperCompanyMapTables(DBTestCase):
                          if row['is_full']}
         self.assertEqual(company_fulls, {'ASUSTek Computer Inc.'})
 
+    def test_report_largest_groups(self):
+        clear_stages()
+        self.addCleanup(clear_stages)
+
+        # Foo-Bar joins the other two together
+        insert_rows(self.scratch_db, 'company', [
+            dict(company='Foo.Bar', scraper_id='a'),
+            dict(company='Foo Bar', scraper_id='b'),
+            dict(company='Foo-Bar', scraper_id='c'),
+            dict(company='Baz', scraper_id='c'),
+        ])
+
+        build_company_name_and_scraper_company_map_tables(
+            self.output_db, self.scratch_db)
+
+        record = [r for r in get_stages()
+                  if r['name'] == 'cluster_company_names'][0]
+
+        self.assertEqual(record['rows_in'], 4)
+        self.assertEqual(record['rows_out'], 2)
+        self.assertEqual(record['dropped_keys'], [])
+
+        largest = record['largest_groups'][0]
+        self.assertEqual(largest['num_cds'], 3)
+        self.assertEqual(
+            {k['key'] for k in largest['bridging_keys']},
+            {'foo bar', 'foobar'})
+
+        self.assertEqual(record['largest_groups'][1]['company'], 'Baz')
+
     def test_the_limited(self):
         # "The Limited" is a very old name for L Brands
         insert_rows(self.scratch_db, 'company_name', [
@@ -259,3 +328,115 @@ class TestBuildCompanyNameAndScraperCompanyMapTables(DBTestCase):
         self.assertEqual(
             company_map.get(('campaign/hsus_fur_free', 'The Limited')),
             'L Brands')
+
+
+class TestGroupCompanyDicts(TestCase):
+
+    def cd(self, scraper_id, name):
+        return dict(aliases={name}, names={name},
+                    scraper_companies={(scraper_id, name)})
+
+    def group(self, cds, **kwargs):
+        return [sorted(n for cd in group for n in cd['names'])
+                for group in group_company_dicts(cds, **kwargs)]
+
+    def test_group_by_variants(self):
+        # "foobar" is a variant of both names
+        self.assertEqual(
+            self.group([self.cd('a', 'Foo.Bar'), self.cd('b', 'Foo-Bar')]),
+            [['Foo-Bar', 'Foo.Bar']])
+
+    def test_max_key_freq(self):
+        stats = {}
+
+        with patch.object(msd.company, 'MAX_COMPANY_KEY_FREQ', 1):
+            self.assertEqual(
+                self.group([self.cd('a', 'Foo.Bar'), self.cd('b', 'Foo-Bar')],
+                           stats=stats),
+                [['Foo.Bar'], ['Foo-Bar']])
+
+        self.assertEqual(stats['dropped_keys'], {'foobar'})
+        self.assertEqual(stats['key_freq']['foobar'], 2)
+
+    def test_max_key_freq_keeps_normed_aliases(self):
+        with patch.object(msd.company, 'MAX_COMPANY_KEY_FREQ', 1):
+            self.assertEqual(
+                self.group([self.cd('a', 'Foo'), self.cd('b', 'FOO'),
+                            self.cd('c', 'Bar')]),
+                [['FOO', 'Foo'], ['Bar']])
+
+    def test_select_company_dicts_with_keys(self):
+        cds = [self.cd('a', 'Foo.Bar'), self.cd('b', 'Foo'),
+               self.cd('c', 'Foo-Bar')]
+
+        self.assertEqual(
+            list(select_company_dicts_with_keys(cds, {'foobar'})),
+            [cds[0], cds[2]])
+        self.assertEqual(
+            list(select_company_dicts_with_keys(cds, {'foo'})), [cds[1]])
+
+
+class TestBuildCompanyTable(DBTestCase):
+
+    SCRATCH_TABLES = {
+        'brand', 'category', 'claim', 'company', 'company_name',
+        'rating', 'scraper_brand_map', 'scraper_company_map',
+        'subsidiary', 'url'}
+
+    def setUp(self):
+        super(TestBuildCompanyTable, self).setUp()
+
+        insert_rows(self.scratch_db, 'company', [
+            dict(company='Foo Inc.', scraper_id='sr.company',
+                 url='http://foo.com'),
+            dict(company='Foo', scraper_id='sr.campaign.qux',
+                 hq_country='US', email='info@foo.com'),
+            dict(company='Foo', scraper_id='sr.campaign.quux',
+                 phone='555-0100'),
+            dict(company='Bar', scraper_id='sr.company'),
+        ])
+        insert_rows(self.scratch_db, 'brand', [
+            dict(company='Baz Co.', brand='Bazz',
+                 scraper_id='sr.campaign.qux'),
+        ])
+        insert_rows(self.scratch_db, 'url', [
+            dict(url='http://foo.com', twitter_handle='@foo',
+                 scraper_id='sr.url'),
+        ])
+
+        build_company_name_and_scraper_company_map_tables(
+            self.output_db, self.scratch_db)
+
+    def test_merge_company_rows(self):
+        build_company_table(self.output_db, self.scratch_db)
+
+        self.assertEqual(
+            [strip_null(row) for row in select_all(self.output_db, 'company')],
+            [dict(company='Bar', company_full='Bar'),
+             dict(company='Baz', company_full='Baz Co.'),
+             dict(company='Foo', company_full='Foo Inc.',
+                  email='info@foo.com', hq_country='US', phone='555-0100',
+                  twitter_handle='@foo', url='http://foo.com')])
+
+    def test_companies(self):
+        build_company_table(self.output_db, self.scratch_db)
+        self.output_db.execute("DELETE FROM company WHERE company != 'Bar'")
+
+        build_company_table(self.output_db, self.scratch_db,
+                            companies={'Baz', 'Foo'})
+
+        self.assertEqual(
+            sorted(row['company'] for row in
+                   select_all(self.output_db, 'company')),
+            ['Bar', 'Baz', 'Foo'])
+
+    def test_cleans_up_after_error(self):
+        with patch.object(msd.company, 'match_urls', side_effect=ValueError):
+            self.assertRaises(ValueError, build_company_table,
+                              self.output_db, self.scratch_db)
+
+        # temp table is gone, so we can build again
+        self.output_db.execute('DROP TABLE company')
+        build_company_table(self.output_db, self.scratch_db)
+
+        self.assertEqual(len(select_all(self.output_db, 'company')), 3)
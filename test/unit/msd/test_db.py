@@ -11,14 +11,221 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import sqlite3
+from os.path import join
+from unittest.mock import patch
+
+import msd.db
+
+from msd.db import BulkInserter
+from msd.db import apply_build_profile
+from msd.db import build_db
+from msd.db import copy_db
 from msd.db import insert_row
+from msd.db import open_db
+from msd.db import read_only_uri
 from msd.db import select_groups
+from msd.db import show_tables
+from msd.report import clear_stages
+from msd.report import get_stages
+from msd.report import stage
 
 from ...db import DBTestCase
 from ...db import insert_rows
+from ...db import select_all
 from ...db import sorted_rows
 
 
+class TestBulkInserter(DBTestCase):
+
+    OUTPUT_TABLES = ['scraper_company_map']
+
+    COLS = ['company', 'scraper_company', 'scraper_id']
+
+    def test_empty(self):
+        with BulkInserter(self.output_db, 'scraper_company_map',
+                          self.COLS) as inserter:
+            pass
+
+        self.assertEqual(inserter.num_rows, 0)
+        self.assertEqual(select_all(self.output_db, 'scraper_company_map'),
+                         [])
+
+    def test_batches(self):
+        ROWS = [
+            dict(company='Foo', scraper_company='Foo', scraper_id='a'),
+            dict(company='Foo', scraper_company='Foo Inc.', scraper_id='b'),
+            dict(company='Bar', scraper_company='Bar', scraper_id='c'),
+        ]
+
+        with BulkInserter(self.output_db, 'scraper_company_map',
+                          self.COLS, batch_size=2) as inserter:
+            for row in ROWS:
+                inserter.add(row)
+
+            # first batch should already be written
+            self.assertEqual(inserter.num_rows, 2)
+
+        self.assertEqual(inserter.num_rows, 3)
+        self.assertEqual(select_all(self.output_db, 'scraper_company_map'),
+                         sorted_rows(ROWS))
+
+    def test_add_values(self):
+        with BulkInserter(self.output_db, 'scraper_company_map',
+                          self.COLS) as inserter:
+            inserter.add_values(('Foo', 'Foo Inc.', 'a'))
+
+        self.assertEqual(
+            select_all(self.output_db, 'scraper_company_map'),
+            [dict(company='Foo', scraper_company='Foo Inc.', scraper_id='a')])
+
+    def test_missing_columns_are_null(self):
+        with BulkInserter(self.output_db, 'scraper_company_map',
+                          self.COLS) as inserter:
+            inserter.add(dict(company='Foo', scraper_company='Foo'))
+
+        self.assertEqual(
+            select_all(self.output_db, 'scraper_company_map'),
+            [dict(company='Foo', scraper_company='Foo', scraper_id=None)])
+
+    def test_no_flush_on_error(self):
+        def add_and_fail():
+            with BulkInserter(self.output_db, 'scraper_company_map',
+                              self.COLS) as inserter:
+                inserter.add(dict(company='Foo'))
+                raise ValueError
+
+        self.assertRaises(ValueError, add_and_fail)
+        self.assertEqual(select_all(self.output_db, 'scraper_company_map'),
+                         [])
+
+
+class TestApplyBuildProfile(DBTestCase):
+
+    def test_safe(self):
+        self.assertEqual(apply_build_profile(self.output_db, 'safe'), {})
+
+    def test_fast(self):
+        db = open_db(join(self.tmp_dir, 'fast.sqlite'))
+        self.addCleanup(db.close)
+
+        self.assertEqual(
+            apply_build_profile(db, 'fast'),
+            dict(cache_size=-262144, journal_mode='memory',
+                 mmap_size=268435456, synchronous=0, temp_store=2))
+
+    def test_in_memory_db_has_no_mmap(self):
+        self.assertNotIn('mmap_size',
+                         apply_build_profile(self.output_db, 'fast'))
+
+    def test_unknown_profile(self):
+        self.assertRaises(KeyError,
+                          apply_build_profile, self.output_db, 'ludicrous')
+
+
+class TestBuildDB(DBTestCase):
+
+    def fill(self, db, num_rows=10):
+        with stage('fill'), db:
+            db.execute('CREATE TABLE foo (bar text)')
+            db.executemany('INSERT INTO foo (bar) VALUES (?)',
+                           [('x' * 1000,)] * num_rows)
+
+        self.num_fills += 1
+
+    def build(self, fill, **kwargs):
+        self.num_fills = 0
+
+        path = join(self.tmp_dir, 'foo.sqlite')
+        build_db(path, fill, **kwargs)
+
+        db = open_db(path)
+        self.addCleanup(db.close)
+
+        return db.execute('SELECT COUNT(*) FROM foo').fetchone()[0]
+
+    def test_on_disk(self):
+        self.assertEqual(self.build(self.fill), 10)
+        self.assertEqual(self.num_fills, 1)
+
+    def test_in_memory(self):
+        with patch.object(msd.db, 'save_db', wraps=msd.db.save_db) as m:
+            self.assertEqual(self.build(self.fill, memory_budget=2**20), 10)
+
+        self.assertTrue(m.called)
+        self.assertEqual(self.num_fills, 1)
+
+    def test_estimate_over_budget(self):
+        self.assertEqual(self.build(self.fill, memory_budget=2**20,
+                                    estimated_size=2**21), 10)
+        self.assertEqual(self.num_fills, 1)
+
+    def test_fall_back_to_disk(self):
+        def fill(db):
+            self.fill(db, num_rows=2000)  # about 2 MiB
+
+        clear_stages()
+        self.addCleanup(clear_stages)
+
+        self.assertEqual(self.build(fill, memory_budget=2**20), 2000)
+        # the first (in-memory) attempt didn't finish
+        self.assertEqual(self.num_fills, 1)
+
+        # only the attempt that finished is recorded
+        stages = get_stages()
+        self.assertEqual([r['name'] for r in stages],
+                         ['build_db_in_memory', 'fill'])
+        self.assertTrue(stages[0]['exceeded_memory_budget'])
+
+    def test_save_without_backup_api(self):
+        db = open_db(':memory:')
+        self.addCleanup(db.close)
+
+        with db:
+            db.execute('CREATE TABLE foo (bar text, baz integer)')
+            db.execute('CREATE UNIQUE INDEX foo_bar ON foo (bar)')
+            db.execute('CREATE TABLE `qux` (quux text, PRIMARY KEY(quux))')
+            db.executemany('INSERT INTO foo (bar, baz) VALUES (?, ?)',
+                           [('a', 1), ('b', None)])
+
+        path = join(self.tmp_dir, 'foo.sqlite')
+        copy_db(db, path)
+
+        copied_db = open_db(path)
+        self.addCleanup(copied_db.close)
+
+        self.assertEqual(show_tables(copied_db), ['foo', 'qux'])
+        self.assertEqual(select_all(copied_db, 'foo'),
+                         select_all(db, 'foo'))
+
+        schema_sql = ('SELECT type, name, tbl_name, sql FROM sqlite_master'
+                      ' ORDER BY name')
+        self.assertEqual(
+            [tuple(row) for row in copied_db.execute(schema_sql)],
+            [tuple(row) for row in db.execute(schema_sql)])
+
+
+class TestReadOnlyURI(DBTestCase):
+
+    def test_attach_read_only(self):
+        path = join(self.tmp_dir, 'input.sqlite')
+        with open_db(path) as input_db:
+            input_db.execute('CREATE TABLE foo (bar text)')
+            insert_row(input_db, 'foo', dict(bar='baz'))
+        input_db.close()
+
+        self.output_db.execute(
+            'ATTACH DATABASE ? AS input_db', [read_only_uri(path)])
+
+        self.assertEqual(
+            [tuple(row) for row in
+             self.output_db.execute('SELECT * FROM input_db.foo')],
+            [('baz',)])
+        self.assertRaises(
+            sqlite3.OperationalError, self.output_db.execute,
+            "INSERT INTO input_db.foo VALUES ('qux')")
+
+
 class TestSelectGroups(DBTestCase):
 
     OUTPUT_TABLES = ['scraper_company_map']
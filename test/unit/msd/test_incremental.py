@@ -0,0 +1,292 @@
+# Copyright 2016 SpendRight, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from os import remove
+from os.path import exists
+from os.path import join
+from unittest import TestCase
+from unittest.mock import patch
+
+import msd.company
+from msd.db import open_db
+from msd.db import show_tables
+from msd.incremental import select_changed_scraper_prefixes
+from msd.incremental import update_output_db
+from msd.output import build_output_db
+from msd.report import clear_stages
+from msd.report import get_stages
+from msd.scratch import build_scratch_db
+from msd.scratch import get_previous_scratch_path
+
+from ...db import DBTestCase
+from ...db import insert_rows
+from ...db import select_all
+
+
+class TestSelectChangedScraperPrefixes(TestCase):
+
+    def test_changed(self):
+        self.assertEqual(
+            select_changed_scraper_prefixes(
+                [dict(scraper_prefix='a', sha1='1'),
+                 dict(scraper_prefix='b', sha1='2'),
+                 dict(scraper_prefix='c', sha1='3')],
+                [dict(scraper_prefix='a', sha1='1'),
+                 dict(scraper_prefix='b', sha1='4'),
+                 dict(scraper_prefix='d', sha1='5')]),
+            {'b', 'c', 'd'})
+
+    def test_none(self):
+        self.assertIsNone(select_changed_scraper_prefixes(
+            None, [dict(scraper_prefix='a', sha1='1')]))
+
+
+class TestUpdateOutputDB(DBTestCase):
+
+    def setUp(self):
+        super(TestUpdateOutputDB, self).setUp()
+
+        self.scratch_db_path = join(self.tmp_dir, 'msd-scratch.sqlite')
+        self.output_db_path = join(self.tmp_dir, 'msd.sqlite')
+
+        self.company_input_path = join(self.tmp_dir, 'sr.company.sqlite')
+        self.campaign_input_path = join(self.tmp_dir, 'sr.campaign.qux.sqlite')
+        self.other_input_path = join(self.tmp_dir, 'sr.company.baz.sqlite')
+
+        with open_db(self.company_input_path) as input_db:
+            input_db.execute(
+                'CREATE TABLE company (company text, url text)')
+            input_db.execute(
+                'CREATE TABLE subsidiary (company text, subsidiary text)')
+            input_db.execute(
+                'CREATE TABLE brand (company text, brand text)')
+            input_db.execute(
+                'CREATE TABLE category (company text, brand text,'
+                ' category text)')
+
+            insert_rows(input_db, 'company', [
+                dict(company='Foo Inc.', url='http://foo.com'),
+                dict(company='Bar Corp.'),
+            ])
+            insert_rows(input_db, 'subsidiary', [
+                dict(company='Foo Inc.', subsidiary='Bar Corp.'),
+            ])
+            insert_rows(input_db, 'brand', [
+                dict(company='Bar Corp.', brand='Barz'),
+            ])
+            insert_rows(input_db, 'category', [
+                dict(company='Bar Corp.', brand='Barz',
+                     category='Food and Drink'),
+            ])
+        input_db.close()
+
+        with open_db(self.campaign_input_path) as input_db:
+            input_db.execute(
+                'CREATE TABLE campaign (campaign text)')
+            input_db.execute(
+                'CREATE TABLE rating (company text, brand text,'
+                ' judgment integer)')
+
+            insert_rows(input_db, 'campaign', [
+                dict(campaign='Qux Guide'),
+            ])
+            insert_rows(input_db, 'rating', [
+                dict(company='Foo', judgment=1),
+                dict(company='Baz', brand='Bazz', judgment=-1),
+            ])
+        input_db.close()
+
+        with open_db(self.other_input_path) as input_db:
+            input_db.execute(
+                'CREATE TABLE brand (company text, brand text)')
+
+            insert_rows(input_db, 'brand', [
+                dict(company='Baz Co.', brand='Bazz'),
+            ])
+        input_db.close()
+
+        self.input_paths = [self.company_input_path,
+                            self.campaign_input_path,
+                            self.other_input_path]
+
+        self.build(incremental=True)
+
+        clear_stages()
+        self.addCleanup(clear_stages)
+
+    def build(self, output_db_path=None, **kwargs):
+        incremental = kwargs.get('incremental', False)
+
+        build_scratch_db(self.scratch_db_path, self.input_paths,
+                         keep_previous=incremental)
+        build_output_db(self.scratch_db_path,
+                        output_db_path or self.output_db_path, **kwargs)
+
+    def assert_same_as_full_build(self):
+        expected_path = join(self.tmp_dir, 'expected.sqlite')
+        build_output_db(self.scratch_db_path, expected_path)
+
+        output_db = open_db(self.output_db_path)
+        self.addCleanup(output_db.close)
+        expected_db = open_db(expected_path)
+        self.addCleanup(expected_db.close)
+
+        self.assertEqual(show_tables(output_db), show_tables(expected_db))
+
+        for table_name in show_tables(expected_db):
+            self.assertEqual(select_all(output_db, table_name),
+                             select_all(expected_db, table_name))
+
+    def updated(self):
+        return [r['updated'] for r in get_stages()
+                if r['name'] == 'update_output_db']
+
+    def built_tables(self):
+        return sorted(r['table'] for r in get_stages()
+                      if r['name'] == 'build_output_table')
+
+    def test_add_brand(self):
+        with open_db(self.company_input_path) as input_db:
+            insert_rows(input_db, 'brand', [
+                dict(company='Foo Inc.', brand='Fooz'),
+            ])
+        input_db.close()
+
+        self.build(incremental=True)
+
+        self.assertEqual(self.updated(), [True])
+        self.assertFalse(exists(get_previous_scratch_path(
+            self.scratch_db_path)))
+
+        self.assert_same_as_full_build()
+
+        output_db = open_db(self.output_db_path)
+        self.addCleanup(output_db.close)
+        self.assertEqual(
+            sorted(row['brand'] for row in select_all(output_db, 'brand')),
+            ['Barz', 'Bazz', 'Fooz'])
+
+    def test_change_subsidiary(self):
+        with open_db(self.company_input_path) as input_db:
+            input_db.execute('DELETE FROM subsidiary')
+        input_db.close()
+
+        self.build(incremental=True)
+
+        self.assertEqual(self.updated(), [True])
+        self.assert_same_as_full_build()
+
+    def test_remove_input(self):
+        self.input_paths.remove(self.other_input_path)
+
+        self.build(incremental=True)
+
+        self.assertEqual(self.updated(), [True])
+        self.assert_same_as_full_build()
+
+    def test_change_campaign(self):
+        with open_db(self.campaign_input_path) as input_db:
+            input_db.execute('UPDATE rating SET judgment = 0'
+                             " WHERE company = 'Foo'")
+        input_db.close()
+
+        self.build(incremental=True)
+
+        self.assertEqual(self.updated(), [True])
+        self.assert_same_as_full_build()
+
+    def test_up_to_date(self):
+        self.build(incremental=True)
+
+        self.assertEqual(self.updated(), [True])
+        self.assertEqual(self.built_tables(), [])
+
+    def test_changed_max_company_key_freq(self):
+        with patch.object(msd.company, 'MAX_COMPANY_KEY_FREQ', 1):
+            self.build(incremental=True)
+
+            self.assertEqual(self.updated(), [False])
+            self.assertNotEqual(self.built_tables(), [])
+            self.assert_same_as_full_build()
+
+    def test_key_goes_over_max_company_key_freq(self):
+        # "foobar" is a variant of both names, so they're grouped together
+        with open_db(self.company_input_path) as input_db:
+            insert_rows(input_db, 'company', [dict(company='Foo.Bar')])
+        input_db.close()
+
+        with open_db(self.other_input_path) as input_db:
+            insert_rows(input_db, 'brand', [
+                dict(company='Foo-Bar', brand='Foobarz'),
+            ])
+        input_db.close()
+
+        def num_foo_bar_companies():
+            with open_db(self.output_db_path) as output_db:
+                num = output_db.execute(
+                    'SELECT COUNT(DISTINCT company) FROM scraper_company_map'
+                    " WHERE scraper_company LIKE 'Foo_Bar'").fetchone()[0]
+            output_db.close()
+            return num
+
+        with patch.object(msd.company, 'MAX_COMPANY_KEY_FREQ', 2):
+            self.build(incremental=True)
+            self.assertEqual(num_foo_bar_companies(), 1)
+
+            clear_stages()
+
+            # a third company in another input makes "foobar" too common
+            # to group by, which should split the first two up
+            with open_db(self.campaign_input_path) as input_db:
+                insert_rows(input_db, 'rating', [
+                    dict(company="Foo'Bar", judgment=0),
+                ])
+            input_db.close()
+
+            self.build(incremental=True)
+
+            self.assertEqual(self.updated(), [True])
+            self.assert_same_as_full_build()
+            self.assertEqual(num_foo_bar_companies(), 3)
+
+    def test_no_previous_scratch_db(self):
+        with open_db(self.company_input_path) as input_db:
+            insert_rows(input_db, 'brand', [
+                dict(company='Foo Inc.', brand='Fooz'),
+            ])
+        input_db.close()
+
+        # scratch DB is rebuilt without keeping the old one
+        build_scratch_db(self.scratch_db_path, self.input_paths)
+
+        self.assertFalse(update_output_db(
+            self.scratch_db_path, self.output_db_path))
+
+        build_output_db(self.scratch_db_path, self.output_db_path,
+                        incremental=True)
+
+        self.assertEqual(self.updated(), [False])
+        self.assert_same_as_full_build()
+
+    def test_no_build_info(self):
+        with open_db(self.output_db_path) as output_db:
+            output_db.execute('DROP TABLE build_info')
+        output_db.close()
+
+        remove(self.scratch_db_path)
+        self.build(incremental=True)
+
+        self.assertEqual(self.updated(), [False])
+        self.assertFalse(exists(get_previous_scratch_path(
+            self.scratch_db_path)))
+        self.assert_same_as_full_build()
@@ -0,0 +1,187 @@
+# Copyright 2016 SpendRight, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import gzip
+from io import BytesIO
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from yaml.composer import ComposerError
+
+from msd.input import iter_csv_rows
+from msd.input import iter_jsonl_rows
+from msd.input import iter_table_file
+from msd.input import iter_yaml_tables
+from msd.input import list_table_files
+from msd.input import parse_table_file_name
+
+
+class TestIterYAMLTables(TestCase):
+
+    def read(self, yaml_bytes):
+        return [(table_name, list(rows))
+                for table_name, rows in iter_yaml_tables(BytesIO(yaml_bytes))]
+
+    def test_empty_dict(self):
+        self.assertEqual(self.read(b'{}'), [])
+
+    def test_tables_in_document_order(self):
+        self.assertEqual(
+            self.read(b'scraper: [{scraper_id: a}]\n'
+                      b'brand:\n'
+                      b'- {company: Foo, brand: Fooz}\n'
+                      b'- {company: Foo, brand: Foozle}\n'),
+            [('scraper', [dict(scraper_id='a')]),
+             ('brand', [dict(company='Foo', brand='Fooz'),
+                        dict(company='Foo', brand='Foozle')])])
+
+    def test_aliases_within_row(self):
+        self.assertEqual(
+            self.read(b'brand:\n'
+                      b'- {company: &c Foo, brand: *c}\n'),
+            [('brand', [dict(company='Foo', brand='Foo')])])
+
+    def test_aliases_across_rows(self):
+        self.assertEqual(
+            self.read(b'brand:\n'
+                      b'- {company: &c Foo, brand: Fooz}\n'
+                      b'- {company: *c, brand: Foozle}\n'),
+            [('brand', [dict(company='Foo', brand='Fooz'),
+                        dict(company='Foo', brand='Foozle')])])
+
+    def test_aliases_to_skipped_rows(self):
+        tables = []
+
+        for table_name, rows in iter_yaml_tables(BytesIO(
+                b'foo: [{bar: [1, &c {baz: 2}]}, {qux: 3}]\n'
+                b'brand: [{brand: Fooz, baz: *c}]\n')):
+            if table_name == 'brand':
+                tables.append((table_name, list(rows)))
+
+        self.assertEqual(tables,
+                         [('brand', [dict(brand='Fooz', baz=dict(baz=2))])])
+
+    def test_undefined_alias(self):
+        self.assertRaises(
+            ComposerError, self.read,
+            b'brand:\n'
+            b'- {company: *c, brand: Fooz}\n')
+
+    def test_skips_unread_rows(self):
+        tables = []
+
+        for table_name, rows in iter_yaml_tables(BytesIO(
+                b'foo: [{bar: [1, {baz: 2}]}, {qux: 3}]\n'
+                b'brand: [{brand: Fooz}]\n')):
+            if table_name == 'brand':
+                tables.append((table_name, list(rows)))
+
+        self.assertEqual(tables, [('brand', [dict(brand='Fooz')])])
+
+    def test_empty_document(self):
+        self.assertRaises(TypeError, self.read, b'')
+
+    def test_not_a_dict(self):
+        self.assertRaises(TypeError, self.read, b'- {brand: Fooz}\n')
+
+    def test_rows_not_a_list(self):
+        self.assertRaises(TypeError, self.read, b'brand: {brand: Fooz}\n')
+        self.assertRaises(TypeError, self.read, b'brand: Fooz\n')
+        self.assertRaises(TypeError, self.read, b'brand:\n')
+
+
+class TestParseTableFileName(TestCase):
+
+    def test_csv(self):
+        self.assertEqual(parse_table_file_name('brand.csv'),
+                         ('brand', 'csv'))
+
+    def test_gzipped_jsonl(self):
+        self.assertEqual(parse_table_file_name('company.JSONL.gz'),
+                         ('company', 'jsonl'))
+
+    def test_other_format(self):
+        self.assertRaises(ValueError, parse_table_file_name, 'brand.yaml')
+
+    def test_dots_in_table_name(self):
+        self.assertRaises(ValueError, parse_table_file_name, 'sr.brand.csv')
+
+
+class TestIterJSONLRows(TestCase):
+
+    def test_skip_blank_lines(self):
+        self.assertEqual(
+            list(iter_jsonl_rows([
+                '{"company": "Foo", "brand": "Fooz"}\n',
+                '\n',
+                '{"company": "Foo", "brand": null}',
+            ])),
+            [dict(company='Foo', brand='Fooz'),
+             dict(company='Foo', brand=None)])
+
+    def test_not_an_object(self):
+        self.assertRaises(TypeError, list, iter_jsonl_rows(['["Foo"]']))
+
+
+class TestIterCSVRows(TestCase):
+
+    def test_empty(self):
+        self.assertEqual(list(iter_csv_rows([])), [])
+
+    def test_empty_values_are_null(self):
+        self.assertEqual(
+            list(iter_csv_rows([
+                'company,brand,url\r\n',
+                'Foo,"Fooz, Inc.",\r\n',
+                '\r\n',
+                'Bar\r\n',
+            ])),
+            [dict(company='Foo', brand='Fooz, Inc.', url=None),
+             dict(company='Bar', brand=None, url=None)])
+
+    def test_too_many_values(self):
+        self.assertRaises(ValueError, list, iter_csv_rows([
+            'company\r\n', 'Foo,Fooz\r\n']))
+
+
+class TestTableFiles(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = mkdtemp()
+        self.addCleanup(rmtree, self.tmp_dir)
+
+    def test_list_table_files(self):
+        for name in ('company.jsonl', 'brand.csv.gz', 'README.txt'):
+            open(join(self.tmp_dir, name), 'w').close()
+
+        self.assertEqual(list_table_files(self.tmp_dir),
+                         [join(self.tmp_dir, 'brand.csv.gz'),
+                          join(self.tmp_dir, 'company.jsonl')])
+
+    def test_gzipped_csv(self):
+        path = join(self.tmp_dir, 'brand.csv.gz')
+        with gzip.open(path, 'wt', encoding='utf-8') as f:
+            f.write('company,brand\nFoo,F\u00f6\u00f6z\n')
+
+        self.assertEqual(list(iter_table_file(path)),
+                         [dict(company='Foo', brand='F\u00f6\u00f6z')])
+
+    def test_jsonl(self):
+        path = join(self.tmp_dir, 'company.jsonl')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('{"company": "Foo", "url": "http://foo.com"}\n')
+
+        self.assertEqual(list(iter_table_file(path)),
+                         [dict(company='Foo', url='http://foo.com')])
@@ -11,12 +11,19 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from unittest import TestCase
 from unittest.mock import patch
 
 from msd.table import TABLES
+from msd.merge import DisjointSet
+from msd.merge import OutputWriter
 from msd.merge import clean_output_row
+from msd.merge import group_by_keys
+from msd.schema import get_schema
 
 from ...case import PatchTestCase
+from ...db import DBTestCase
+from ...db import select_all
 
 
 class TestCleanOutputRow(PatchTestCase):
@@ -69,3 +76,106 @@ class TestCleanOutputRow(PatchTestCase):
         self.assertEqual(
             clean_output_row(dict(namespace='metasyntactic'), 'foo'),
             dict(namespace='metasyntactic'))
+
+
+class TestOutputWriter(DBTestCase):
+
+    OUTPUT_TABLES = ['subcategory']
+
+    def test_cleans_rows(self):
+        with OutputWriter(self.output_db, 'subcategory') as writer:
+            writer.add(dict(category='Food', subcategory='Candy',
+                            is_implied=True, scraper_id='sr.foo'))
+            writer.add(dict(category='Food', subcategory='Snacks'))
+
+        self.assertEqual(writer.num_rows, 2)
+        self.assertEqual(
+            select_all(self.output_db, 'subcategory'),
+            [dict(category='Food', subcategory='Snacks', is_implied=0),
+             dict(category='Food', subcategory='Candy', is_implied=1)])
+
+    def test_uses_schema_insert_sql(self):
+        writer = OutputWriter(self.output_db, 'subcategory')
+
+        self.assertIs(writer.insert_sql, get_schema('subcategory').insert_sql)
+
+    def test_batches(self):
+        with OutputWriter(self.output_db, 'subcategory',
+                          batch_size=2) as writer:
+            for subcategory in ('A', 'B', 'C'):
+                writer.add(dict(category='Food', subcategory=subcategory))
+
+            # first batch is already committed
+            self.assertEqual(writer.num_rows, 2)
+            self.assertFalse(self.output_db.in_transaction)
+
+        self.assertEqual(writer.num_rows, 3)
+        self.assertEqual(len(select_all(self.output_db, 'subcategory')), 3)
+
+    def test_unknown_column(self):
+        with OutputWriter(self.output_db, 'subcategory') as writer:
+            self.assertRaises(ValueError, writer.add,
+                              dict(category='Food', subcategory='Candy',
+                                   namespace='metasyntactic'))
+
+        self.assertEqual(writer.num_rows, 0)
+
+
+class TestGroupByKeys(TestCase):
+
+    def group(self, items):
+        return list(group_by_keys(items, lambda item: item[1:]))
+
+    def test_empty(self):
+        self.assertEqual(self.group([]), [])
+
+    def test_chain(self):
+        # the last item links the first two groups
+        self.assertEqual(
+            self.group([('a', 1, 2), ('b', 3), ('c', 4), ('d', 2, 3)]),
+            [[('a', 1, 2), ('b', 3), ('d', 2, 3)], [('c', 4)]])
+
+    def test_groups_in_order_of_first_item(self):
+        self.assertEqual(
+            self.group([('a', 1), ('b', 2), ('c', 1), ('d', 3), ('e', 2)]),
+            [[('a', 1), ('c', 1)], [('b', 2), ('e', 2)], [('d', 3)]])
+
+    def test_drop_items_with_no_keys(self):
+        self.assertEqual(
+            self.group([('a',), ('b', 1), ('c',)]),
+            [[('b', 1)]])
+
+    def test_long_chain(self):
+        items = [('x', i, i + 1) for i in range(10000)]
+
+        self.assertEqual(self.group(reversed(items)),
+                         [list(reversed(items))])
+
+    def test_str_keys(self):
+        self.assertRaises(
+            TypeError, list, group_by_keys(['foo'], lambda item: item))
+
+
+class TestDisjointSet(TestCase):
+
+    def test_union_and_find(self):
+        ds = DisjointSet()
+        ids = [ds.add() for _ in range(5)]
+
+        self.assertEqual(ids, [0, 1, 2, 3, 4])
+        self.assertEqual(len(ds), 5)
+
+        ds.union(0, 1)
+        ds.union(3, 4)
+        root = ds.union(1, 4)
+
+        self.assertEqual({ds.find(i) for i in (0, 1, 3, 4)}, {root})
+        self.assertNotEqual(ds.find(2), root)
+
+    def test_union_same_set(self):
+        ds = DisjointSet()
+        a = ds.add()
+        b = ds.add()
+
+        root = ds.union(a, b)
+        self.assertEqual(ds.union(b, a), root)
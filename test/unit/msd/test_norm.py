@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 SpendRight, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from unittest import TestCase
+
+from msd.cache import get_cache
+from msd.cache import set_cache_sizes
+from msd.norm import DEFAULT_CLEAN_STRING_CACHE_SIZE
+from msd.norm import DEFAULT_NORM_CACHE_SIZE
+from msd.norm import clean_string
+from msd.norm import norm
+from msd.norm import smunch
+
+
+class NormCacheTestCase(TestCase):
+
+    CACHE_SIZES = dict(
+        clean_string=DEFAULT_CLEAN_STRING_CACHE_SIZE,
+        norm=DEFAULT_NORM_CACHE_SIZE,
+        smunch=DEFAULT_NORM_CACHE_SIZE,
+    )
+
+    def setUp(self):
+        # start with empty caches, and put them back how we found them
+        set_cache_sizes(self.CACHE_SIZES)
+        self.addCleanup(set_cache_sizes, self.CACHE_SIZES)
+
+
+class TestCleanString(NormCacheTestCase):
+
+    def test_not_a_string(self):
+        self.assertRaises(TypeError, clean_string, None)
+        self.assertRaises(TypeError, clean_string, b'Foo')
+
+    def test_clean_ascii(self):
+        self.assertEqual(clean_string(''), '')
+        self.assertEqual(clean_string('Foo & Co.'), 'Foo & Co.')
+
+        # ASCII fast path doesn't use the cache
+        self.assertEqual(get_cache('clean_string').stats()['misses'], 0)
+
+    def test_messy_ascii(self):
+        self.assertEqual(clean_string(' Foo'), 'Foo')
+        self.assertEqual(clean_string('Foo\n'), 'Foo')
+        self.assertEqual(clean_string('Foo  &\tCo.'), 'Foo & Co.')
+        self.assertEqual(clean_string('Foo\x1fCo.'), 'Foo Co.')
+
+        self.assertEqual(get_cache('clean_string').stats()['misses'], 4)
+
+    def test_unicode(self):
+        self.assertEqual(clean_string('“Foo”'), '"Foo"')
+        self.assertEqual(clean_string('Foo Co.'), 'Foo Co.')
+        self.assertEqual(clean_string('ﬁne'), 'fine')
+        # NFC
+        self.assertEqual(clean_string('Arçelik'), 'Arçelik')
+
+    def test_cache(self):
+        clean_string('Foo Co.')
+        clean_string('Foo Co.')
+        clean_string('Bar Co.')
+
+        stats = get_cache('clean_string').stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['size'], 2)
+
+    def test_cache_size(self):
+        set_cache_sizes({'clean_string': 1})
+
+        self.assertEqual(clean_string('Foo Co.'), 'Foo Co.')
+        self.assertEqual(clean_string('Bar Co.'), 'Bar Co.')
+        self.assertEqual(clean_string('Foo Co.'), 'Foo Co.')
+
+        stats = get_cache('clean_string').stats()
+        self.assertEqual(stats['hits'], 0)
+        self.assertEqual(stats['misses'], 3)
+        self.assertEqual(stats['size'], 1)
+        self.assertEqual(stats['maxsize'], 1)
+
+
+class TestNorm(NormCacheTestCase):
+
+    def test_ascii(self):
+        self.assertEqual(norm('Foo Co.'), 'foo co.')
+        self.assertEqual(norm(''), '')
+
+        # ASCII fast path doesn't use the cache
+        self.assertEqual(get_cache('norm').stats()['misses'], 0)
+
+    def test_unicode(self):
+        self.assertEqual(norm('Arçelik'), 'arcelik')
+        self.assertEqual(norm('L’Oréal'), "l'oreal")
+        self.assertEqual(norm('Ôréal'), 'oreal')
+
+        self.assertEqual(get_cache('norm').stats()['misses'], 3)
+
+    def test_cache(self):
+        norm('Nestlé')
+        norm('Nestlé')
+        norm('Arçelik')
+
+        stats = get_cache('norm').stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+
+    def test_cache_size(self):
+        set_cache_sizes({'norm': 1})
+
+        self.assertEqual(norm('Nestlé'), 'nestle')
+        self.assertEqual(norm('Arçelik'), 'arcelik')
+        self.assertEqual(norm('Nestlé'), 'nestle')
+
+        stats = get_cache('norm').stats()
+        self.assertEqual(stats['hits'], 0)
+        self.assertEqual(stats['misses'], 3)
+
+
+class TestSmunch(NormCacheTestCase):
+
+    def test_smunch(self):
+        self.assertEqual(smunch('Coca-Cola Co.'), 'cocacolaco.')
+        self.assertEqual(smunch('Crème\u00a0Brûlée'), 'cremebrulee')
+        self.assertEqual(smunch(' \t'), '')
+
+    def test_cache(self):
+        smunch('Coca-Cola')
+        smunch('Coca-Cola')
+
+        stats = get_cache('smunch').stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
@@ -0,0 +1,337 @@
+# Copyright 2016 SpendRight, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from os.path import exists
+from os.path import join
+from unittest import TestCase
+from unittest.mock import patch
+
+import msd.company
+import msd.output
+from msd.db import open_db
+from msd.db import show_tables
+from msd.output import build_output_db
+from msd.output import fill_output_db
+from msd.output import fork_executor_kwargs
+from msd.output import get_builder_dependencies
+from msd.output import get_staging_dir
+from msd.report import clear_stages
+from msd.report import get_stages
+from msd.scratch import create_scratch_tables
+from msd.scratch import get_scratch_fingerprint
+
+from ...db import DBTestCase
+from ...db import insert_rows
+from ...db import select_all
+
+
+class TestGetBuilderDependencies(TestCase):
+
+    def builder_index(self, build):
+        for i, builder in enumerate(msd.output.OUTPUT_BUILDERS):
+            if builder['build'] == build:
+                return i
+
+    def test_company_table(self):
+        deps = get_builder_dependencies()
+
+        company_map_index = self.builder_index(
+            msd.output.build_company_name_and_scraper_company_map_tables)
+
+        i = self.builder_index(msd.output.build_company_table)
+        self.assertEqual(deps[i], {company_map_index})
+
+    def test_no_dependencies(self):
+        deps = get_builder_dependencies()
+
+        i = self.builder_index(msd.output.build_campaign_table)
+        self.assertEqual(deps[i], set())
+
+    def test_read_before_write(self):
+        with patch.object(msd.output, 'OUTPUT_BUILDERS', [
+                dict(build=fill_output_db, reads=['foo'], writes=['bar']),
+                dict(build=fill_output_db, reads=[], writes=['foo'])]):
+            self.assertRaises(ValueError, get_builder_dependencies)
+
+    def test_two_writers(self):
+        with patch.object(msd.output, 'OUTPUT_BUILDERS', [
+                dict(build=fill_output_db, reads=[], writes=['foo']),
+                dict(build=fill_output_db, reads=[], writes=['foo'])]):
+            self.assertRaises(ValueError, get_builder_dependencies)
+
+
+class TestForkExecutorKwargs(TestCase):
+
+    def test_mp_context(self):
+        with patch.object(msd.output.sys, 'version_info', (3, 7, 0)):
+            self.assertEqual(
+                fork_executor_kwargs()['mp_context'].get_start_method(),
+                'fork')
+
+    def test_before_python_3_7(self):
+        with patch.object(msd.output.sys, 'version_info', (3, 5, 0)):
+            self.assertEqual(fork_executor_kwargs(), {})
+
+
+class BuildOutputDBTestCase(DBTestCase):
+
+    def setUp(self):
+        super(BuildOutputDBTestCase, self).setUp()
+
+        self.scratch_db_path = join(self.tmp_dir, 'msd-scratch.sqlite')
+
+        with open_db(self.scratch_db_path) as scratch_db:
+            create_scratch_tables(scratch_db)
+
+            insert_rows(scratch_db, 'campaign', [
+                dict(scraper_id='sr.campaign.qux', campaign_id='qux',
+                     campaign='Qux Guide'),
+            ])
+            insert_rows(scratch_db, 'company', [
+                dict(scraper_id='sr.company', company='Foo Inc.',
+                     url='http://foo.com'),
+                dict(scraper_id='sr.campaign.qux', company='Foo'),
+                dict(scraper_id='sr.company', company='Bar Corp.'),
+            ])
+            insert_rows(scratch_db, 'subsidiary', [
+                dict(scraper_id='sr.company', company='Foo Inc.',
+                     subsidiary='Bar Corp.'),
+            ])
+            insert_rows(scratch_db, 'brand', [
+                dict(scraper_id='sr.company', company='Bar Corp.',
+                     brand='Barz'),
+            ])
+            insert_rows(scratch_db, 'category', [
+                dict(scraper_id='sr.company', company='Bar Corp.',
+                     brand='Barz', category='Food and Drink'),
+            ])
+            insert_rows(scratch_db, 'rating', [
+                dict(scraper_id='sr.campaign.qux', campaign_id='qux',
+                     company='Foo', judgment=1),
+            ])
+
+        scratch_db.close()
+
+    def build(self, name, **kwargs):
+        output_db_path = join(self.tmp_dir, name)
+        build_output_db(self.scratch_db_path, output_db_path, **kwargs)
+        return output_db_path
+
+    def read_bytes(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def assert_same_rows(self, path, expected_path):
+        """Check that two DBs have the same tables and indexes, and the
+        same rows in the same order."""
+        db = open_db(path)
+        self.addCleanup(db.close)
+        expected_db = open_db(expected_path)
+        self.addCleanup(expected_db.close)
+
+        schema_sql = 'SELECT * FROM sqlite_master ORDER BY name'
+        self.assertEqual([tuple(row) for row in db.execute(schema_sql)],
+                         [tuple(row) for row in expected_db.execute(
+                             schema_sql)])
+
+        for table_name in show_tables(expected_db):
+            rows_sql = 'SELECT * FROM `{}` ORDER BY rowid'.format(table_name)
+            self.assertEqual(
+                [tuple(row) for row in db.execute(rows_sql)],
+                [tuple(row) for row in expected_db.execute(rows_sql)])
+
+
+class TestBuildOutputDB(BuildOutputDBTestCase):
+
+    def test_same_as_fill_output_db(self):
+        output_db = open_db(self.build('msd.sqlite'))
+        self.addCleanup(output_db.close)
+
+        with open_db(self.scratch_db_path) as scratch_db:
+            fill_output_db(self.output_db, scratch_db)
+        scratch_db.close()
+
+        # build_output_db() also records which scratch DB it used
+        self.assertEqual(show_tables(output_db),
+                         sorted(show_tables(self.output_db) + ['build_info']))
+
+        for table_name in show_tables(self.output_db):
+            self.assertEqual(select_all(output_db, table_name),
+                             select_all(self.output_db, table_name))
+
+        self.assertEqual(
+            [row['brand'] for row in select_all(output_db, 'brand')],
+            ['Barz'])
+
+    def test_jobs_makes_identical_db(self):
+        parallel_path = self.build('parallel.sqlite', jobs=3)
+        staged_path = self.build('staged.sqlite', jobs=2)
+
+        self.assertEqual(self.read_bytes(parallel_path),
+                         self.read_bytes(staged_path))
+
+    def test_serial_build_makes_same_rows(self):
+        serial_path = self.build('serial.sqlite')
+        parallel_path = self.build('parallel.sqlite', jobs=3)
+
+        self.assert_same_rows(serial_path, parallel_path)
+
+    def test_serial_build_skips_staging(self):
+        clear_stages()
+        self.addCleanup(clear_stages)
+
+        with patch.object(msd.output, 'build_staging_dbs') as m:
+            self.build('msd.sqlite')
+
+        self.assertFalse(m.called)
+        self.assertEqual(
+            len([r for r in get_stages()
+                 if r['name'] == 'build_output_table']),
+            len(msd.output.OUTPUT_BUILDERS))
+
+    def test_report_stages(self):
+        clear_stages()
+        self.addCleanup(clear_stages)
+
+        self.build('msd.sqlite', jobs=2)
+
+        stages = get_stages()
+
+        self.assertEqual(
+            sorted(r['table'] for r in stages
+                   if r['name'] == 'build_output_table'),
+            sorted(builder['writes'][0]
+                   for builder in msd.output.OUTPUT_BUILDERS))
+
+        brand_stage = [r for r in stages if r.get('table') == 'brand'][0]
+        self.assertEqual(brand_stage['rows_out'], 1)
+        self.assertGreater(brand_stage['rows_in'], 0)
+
+        # recorded in a worker process
+        company_map_stage = [r for r in stages
+                             if r.get('table') == 'scraper_company_map'][0]
+        company_keys_stats = company_map_stage['caches']['company_keys']
+        self.assertGreater(
+            company_keys_stats['hits'] + company_keys_stats['misses'], 0)
+
+        self.assertEqual(stages[-1]['name'], 'build_output_db')
+
+    def test_staging_dir_removed(self):
+        output_db_path = self.build('msd.sqlite')
+
+        self.assertFalse(exists(get_staging_dir(output_db_path)))
+
+
+class TestResumeBuildOutputDB(BuildOutputDBTestCase):
+
+    def fail_builder(self, build):
+        """Patch OUTPUT_BUILDERS so that the given builder fails."""
+        def fail(output_db, scratch_db):
+            raise ValueError
+
+        builders = [
+            dict(builder, build=fail) if builder['build'] == build
+            else builder
+            for builder in msd.output.OUTPUT_BUILDERS]
+
+        return patch.object(msd.output, 'OUTPUT_BUILDERS', builders)
+
+    def built_tables(self):
+        return sorted(r['table'] for r in get_stages()
+                      if r['name'] == 'build_output_table')
+
+    def all_tables(self):
+        return sorted(builder['writes'][0]
+                      for builder in msd.output.OUTPUT_BUILDERS)
+
+    def build_and_fail(self, build, name='msd.sqlite'):
+        # only builds that use staging DBs can be resumed
+        with self.fail_builder(build):
+            self.assertRaises(ValueError, self.build, name, resume=True)
+
+        clear_stages()
+        self.addCleanup(clear_stages)
+
+    def test_resume(self):
+        self.build_and_fail(msd.output.build_rating_table)
+
+        self.assertTrue(exists(join(self.tmp_dir, 'msd.sqlite.staging')))
+        self.assertFalse(exists(join(self.tmp_dir, 'msd.sqlite')))
+
+        output_db_path = self.build('msd.sqlite', resume=True)
+
+        self.assertEqual(self.built_tables(), ['rating'])
+        self.assertFalse(exists(get_staging_dir(output_db_path)))
+
+        expected_path = self.build('expected.sqlite', jobs=2)
+        self.assertEqual(self.read_bytes(output_db_path),
+                         self.read_bytes(expected_path))
+
+    def test_resume_rebuilds_dependent_tables(self):
+        self.build_and_fail(
+            msd.output.build_company_name_and_scraper_company_map_tables)
+
+        self.build('msd.sqlite', resume=True)
+
+        built_tables = self.built_tables()
+
+        self.assertIn('scraper_company_map', built_tables)
+        self.assertIn('company', built_tables)
+        self.assertIn('brand', built_tables)
+        self.assertNotIn('campaign', built_tables)
+        self.assertNotIn('subcategory', built_tables)
+
+    def test_resume_with_parallel_jobs(self):
+        self.build_and_fail(msd.output.build_brand_table)
+
+        output_db_path = self.build('msd.sqlite', jobs=3, resume=True)
+
+        self.assertEqual(self.built_tables(),
+                         ['brand', 'category', 'claim', 'rating'])
+        expected_path = self.build('expected.sqlite', jobs=2)
+        self.assertEqual(self.read_bytes(output_db_path),
+                         self.read_bytes(expected_path))
+
+    def test_changed_scratch_db(self):
+        self.build_and_fail(msd.output.build_rating_table)
+
+        old_fingerprint = get_scratch_fingerprint(self.scratch_db_path)
+
+        with open_db(self.scratch_db_path) as scratch_db:
+            insert_rows(scratch_db, 'campaign', [
+                dict(scraper_id='sr.campaign.quux', campaign_id='quux',
+                     campaign='Quux Guide'),
+            ])
+        scratch_db.close()
+
+        self.assertNotEqual(get_scratch_fingerprint(self.scratch_db_path),
+                            old_fingerprint)
+
+        self.build('msd.sqlite', resume=True)
+
+        self.assertEqual(self.built_tables(), self.all_tables())
+
+    def test_changed_max_company_key_freq(self):
+        self.build_and_fail(msd.output.build_rating_table)
+
+        with patch.object(msd.company, 'MAX_COMPANY_KEY_FREQ', 1):
+            self.build('msd.sqlite', resume=True)
+
+        self.assertEqual(self.built_tables(), self.all_tables())
+
+    def test_no_resume(self):
+        self.build_and_fail(msd.output.build_rating_table)
+
+        self.build('msd.sqlite')
+
+        self.assertEqual(self.built_tables(), self.all_tables())
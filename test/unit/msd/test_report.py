@@ -0,0 +1,100 @@
+# Copyright 2016 SpendRight, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+from os import getpid
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from msd.report import add_stages
+from msd.report import clear_stages
+from msd.report import get_report_path
+from msd.report import get_stages
+from msd.report import stage
+from msd.report import write_report
+
+
+class TestStage(TestCase):
+
+    def setUp(self):
+        clear_stages()
+        self.addCleanup(clear_stages)
+
+    def test_record(self):
+        with stage('dump_table_to_scratch', table='brand') as record:
+            record['rows_in'] = 3
+
+        self.assertEqual(get_stages(), [record])
+        self.assertEqual(record['name'], 'dump_table_to_scratch')
+        self.assertEqual(record['table'], 'brand')
+        self.assertEqual(record['rows_in'], 3)
+        self.assertEqual(record['rows_out'], None)
+        self.assertEqual(record['pid'], getpid())
+        self.assertGreaterEqual(record['wall_time'], 0)
+        self.assertGreaterEqual(record['cpu_time'], 0)
+
+    def test_nested_stages_finish_first(self):
+        with stage('outer'):
+            with stage('inner'):
+                pass
+
+        self.assertEqual([r['name'] for r in get_stages()],
+                         ['inner', 'outer'])
+
+    def test_failed_stage_not_recorded(self):
+        def fail():
+            with stage('fail'):
+                raise ValueError
+
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(get_stages(), [])
+
+    def test_get_stages_start(self):
+        with stage('before'):
+            pass
+
+        num_stages = len(get_stages())
+
+        with stage('after'):
+            pass
+
+        self.assertEqual([r['name'] for r in get_stages(num_stages)],
+                         ['after'])
+
+    def test_add_stages(self):
+        add_stages([dict(name='elsewhere', pid=0)])
+
+        self.assertEqual(get_stages(), [dict(name='elsewhere', pid=0)])
+
+
+class TestWriteReport(TestCase):
+
+    def test_get_report_path(self):
+        self.assertEqual(get_report_path('out/msd.sqlite'),
+                         'out/msd.report.json')
+
+    def test_write_report(self):
+        tmp_dir = mkdtemp()
+        self.addCleanup(rmtree, tmp_dir)
+
+        report_path = join(tmp_dir, 'msd.report.json')
+        write_report(report_path, [dict(name='foo', rows_in=1)])
+
+        with open(report_path) as f:
+            report = json.load(f)
+
+        self.assertEqual(report['stages'], [dict(name='foo', rows_in=1)])
+        self.assertIn('msd_version', report)
+        self.assertEqual(report['caches']['norm']['hits'], 0)
@@ -0,0 +1,84 @@
+# Copyright 2016 SpendRight, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from unittest import TestCase
+from unittest.mock import patch
+
+from msd.schema import get_schema
+from msd.schema import get_schemas
+from msd.scratch import scratch_tables_with_cols
+from msd.table import TABLES
+
+
+class TestGetSchema(TestCase):
+
+    def test_brand(self):
+        schema = get_schema('brand')
+
+        self.assertEqual(schema.name, 'brand')
+        self.assertEqual(schema.col_names,
+                         tuple(sorted(TABLES['brand']['columns'])))
+        self.assertEqual(schema.primary_key, ('company', 'brand'))
+        self.assertEqual(schema.bool_cols,
+                         ('is_former', 'is_licensed', 'is_prescription'))
+        self.assertEqual(schema.text_key_cols, {'brand', 'company'})
+        self.assertIn('scraper_id', schema.scratch_col_names)
+        self.assertNotIn('scraper_id', schema.col_names)
+        self.assertTrue(schema.insert_sql.startswith('INSERT INTO `brand`'))
+        self.assertIn('`scraper_id`', schema.scratch_insert_sql)
+        self.assertNotIn('`scraper_id`', schema.insert_sql)
+
+    def test_compiled_once(self):
+        self.assertIs(get_schema('brand'), get_schema('brand'))
+
+    def test_unknown_table(self):
+        self.assertRaises(KeyError, get_schema, 'foo')
+
+    def test_immutable(self):
+        schema = get_schema('brand')
+
+        def set_col_names():
+            schema.col_names = ('foo',)
+
+        def set_column_type():
+            schema.columns['brand'] = 'integer'
+
+        self.assertRaises(AttributeError, set_col_names)
+        self.assertRaises(TypeError, set_column_type)
+
+    def test_recompiled_when_patched(self):
+        with patch.dict(TABLES, brand=dict(columns=dict(brand='text'),
+                                           primary_key=['brand'])):
+            self.assertEqual(get_schema('brand').col_names, ('brand',))
+            self.assertIn('brand', scratch_tables_with_cols(['brand']))
+            self.assertNotIn('brand', scratch_tables_with_cols(['company']))
+
+        self.assertNotEqual(get_schema('brand').col_names, ('brand',))
+        self.assertIn('brand', scratch_tables_with_cols(['company']))
+
+    def test_get_schemas(self):
+        self.assertEqual([schema.name for schema in get_schemas()],
+                         sorted(TABLES))
+
+        with patch.dict(TABLES, foo=dict(columns=dict(foo='text'))):
+            self.assertIn('foo', [schema.name for schema in get_schemas()])
+
+        self.assertNotIn('foo', [schema.name for schema in get_schemas()])
+
+
+class TestCleanOutputRow(TestCase):
+
+    def test_url_table(self):
+        # url's primary key includes scraper_id, which isn't a column
+        self.assertEqual(get_schema('url').clean_output_row(dict(url='x')),
+                         dict(url='x'))
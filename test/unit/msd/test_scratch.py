@@ -12,11 +12,34 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import gzip
+from os import mkdir
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
 from unittest import TestCase
+from unittest.mock import patch
 
+import msd.scratch
+
+from msd.db import open_db
+from msd.scratch import build_distinct_values_tables
+from msd.scratch import build_scratch_db
 from msd.scratch import clean_input_row
+from msd.scratch import copy_db_to_scratch
+from msd.scratch import create_scratch_tables
+from msd.scratch import dump_db_to_scratch
+from msd.scratch import InputPlan
+from msd.scratch import distinct_values_table_name
+from msd.scratch import dump_table_to_scratch
+from msd.scratch import get_distinct_values
+from msd.scratch import get_scratch_fingerprint
 from msd.scratch import parse_input_path
 
+from ...db import DBTestCase
+from ...db import insert_rows
+from ...db import select_all
+
 
 class TestParseInputPath(TestCase):
 
@@ -38,6 +61,20 @@ class TestParseInputPath(TestCase):
         self.assertEqual(parse_input_path('DATA.YAML'),
                          ('DATA', 'yaml'))
 
+    def test_table_file(self):
+        self.assertEqual(parse_input_path('sr.company/brand.csv.gz'),
+                         ('sr.company', 'csv'))
+
+    def test_table_file_not_in_dir(self):
+        self.assertRaises(ValueError, parse_input_path, 'brand.jsonl')
+
+    def test_dir(self):
+        tmp_dir = mkdtemp()
+        self.addCleanup(rmtree, tmp_dir)
+
+        self.assertEqual(parse_input_path(tmp_dir + '/'),
+                         (tmp_dir, 'dir'))
+
 
 # partial test, for newly added feature
 class TestCleanInputRow(TestCase):
@@ -53,3 +90,430 @@ class TestCleanInputRow(TestCase):
                  brand='',
                  scope='',
                  claim=''))
+
+
+class TestInputPlan(TestCase):
+
+    def test_cols(self):
+        plan = InputPlan('claim', ('judgment', 'color', 'brand'))
+
+        self.assertEqual(plan.cols, (
+            'brand', 'campaign_id', 'claim', 'company', 'judgment', 'scope'))
+        self.assertEqual(plan.extra_cols, ('color',))
+
+    def test_clean(self):
+        plan = InputPlan('claim', ('judgment', 'color', 'brand'))
+
+        self.assertEqual(plan.clean((1, 'blue', ' Fooz\u00a0')),
+                         ['Fooz', '', '', '', 1, ''])
+        self.assertEqual(plan.clean((None, None, None)),
+                         ['', '', '', '', None, ''])
+
+    def test_scratch_values(self):
+        plan = InputPlan('subsidiary', ('scraper_id', 'company'))
+
+        # company, company_depth, scraper_id, subsidiary, subsidiary_depth
+        self.assertEqual(plan.scratch_values(('bar', 'Bar'), 'sr'),
+                         ['Bar', None, 'sr.bar', '', None])
+
+        plan = InputPlan('subsidiary', ('company',))
+        self.assertEqual(plan.scratch_values(('Bar',), 'sr'),
+                         ['Bar', None, 'sr', '', None])
+
+
+class TestDumpTableToScratch(DBTestCase):
+
+    SCRATCH_TABLES = ['subsidiary']
+
+    def test_ignore_extra_table(self):
+        dump_table_to_scratch('foo', [dict(foo='bar')], self.scratch_db, 'sr')
+
+    def test_namespace_scraper_id(self):
+        dump_table_to_scratch(
+            'subsidiary', [
+                dict(company='Foo', subsidiary='Foo Jr.'),
+                dict(company='Bar', subsidiary='Bar Jr.', scraper_id='bar'),
+            ], self.scratch_db, 'sr')
+
+        self.assertEqual(
+            [(row['scraper_id'], row['company'])
+             for row in select_all(self.scratch_db, 'subsidiary')],
+            [('sr.bar', 'Bar'), ('sr', 'Foo')])
+
+    def test_clean_and_drop_extra_columns(self):
+        dump_table_to_scratch(
+            'subsidiary', [
+                dict(company='Foo\u2019s  Holdings ', subsidiary='Bar',
+                     company_depth=1, color='blue'),
+            ], self.scratch_db, 'sr')
+
+        self.assertEqual(
+            select_all(self.scratch_db, 'subsidiary'),
+            [dict(company="Foo's Holdings", company_depth=1,
+                  scraper_id='sr', subsidiary='Bar', subsidiary_depth=None)])
+
+    def test_rows_with_different_columns(self):
+        dump_table_to_scratch(
+            'subsidiary', [
+                dict(company='Foo', subsidiary='Foo Jr.'),
+                dict(subsidiary_depth=2, subsidiary='Bar Jr.', company='Bar'),
+            ], self.scratch_db, 'sr')
+
+        self.assertEqual(
+            select_all(self.scratch_db, 'subsidiary'),
+            [dict(company='Bar', company_depth=None, scraper_id='sr',
+                  subsidiary='Bar Jr.', subsidiary_depth=2),
+             dict(company='Foo', company_depth=None, scraper_id='sr',
+                  subsidiary='Foo Jr.', subsidiary_depth=None)])
+
+
+class TestCopyDBToScratch(DBTestCase):
+
+    def setUp(self):
+        super(TestCopyDBToScratch, self).setUp()
+
+        self.input_db_path = join(self.tmp_dir, 'input.sqlite')
+
+        with open_db(self.input_db_path) as input_db:
+            input_db.execute(
+                'CREATE TABLE claim (brand text, claim text, company text,'
+                ' judgment integer, scraper_id text, color text)')
+            input_db.execute(
+                'CREATE TABLE url (url text, twitter_handle text)')
+            input_db.execute('CREATE TABLE foo (bar text)')
+
+            insert_rows(input_db, 'claim', [
+                dict(brand=' Fooz\u00a0', claim='\u201cgreen\u201d',
+                     company='Foo', judgment=1, scraper_id='a',
+                     color='blue'),
+                dict(brand=None, claim='bad', company='Foo', judgment=-1,
+                     scraper_id=' b'),
+            ])
+            insert_rows(input_db, 'url', [
+                dict(url='http://foo.com', twitter_handle='@foo'),
+            ])
+            insert_rows(input_db, 'foo', [dict(bar='baz')])
+
+        input_db.close()
+
+    def rows_in_order(self, db, table_name):
+        return [tuple(row) for row in db.execute(
+            'SELECT * FROM `{}` ORDER BY rowid'.format(table_name))]
+
+    def test_same_as_dump_db_to_scratch(self):
+        create_scratch_tables(self.scratch_db)
+        copy_db_to_scratch(self.input_db_path, self.scratch_db, 'sr')
+
+        dumped_db = open_db(':memory:')
+        self.addCleanup(dumped_db.close)
+        create_scratch_tables(dumped_db)
+
+        with open_db(self.input_db_path) as input_db:
+            dump_db_to_scratch(input_db, dumped_db, 'sr')
+        input_db.close()
+
+        for table_name in ('claim', 'url'):
+            self.assertEqual(self.rows_in_order(self.scratch_db, table_name),
+                             self.rows_in_order(dumped_db, table_name))
+
+        self.assertEqual(
+            select_all(self.scratch_db, 'claim')[0],
+            dict(brand='', campaign_id='', claim='bad', company='Foo',
+                 date=None, judgment=-1, scope='', scraper_id='sr.b',
+                 url=None))
+
+    def test_null_scraper_id(self):
+        with open_db(self.input_db_path) as input_db:
+            insert_rows(input_db, 'claim', [
+                dict(brand='Fooz', claim='vegan', company='Foo',
+                     judgment=1, scraper_id=None),
+            ])
+        input_db.close()
+
+        create_scratch_tables(self.scratch_db)
+        copy_db_to_scratch(self.input_db_path, self.scratch_db, 'sr')
+
+        dumped_db = open_db(':memory:')
+        self.addCleanup(dumped_db.close)
+        create_scratch_tables(dumped_db)
+
+        with open_db(self.input_db_path) as input_db:
+            dump_db_to_scratch(input_db, dumped_db, 'sr')
+        input_db.close()
+
+        self.assertEqual(self.rows_in_order(self.scratch_db, 'claim'),
+                         self.rows_in_order(dumped_db, 'claim'))
+
+        self.assertEqual(
+            [row['scraper_id'] for row in self.scratch_db.execute(
+                'SELECT scraper_id FROM claim ORDER BY rowid')],
+            ['sr.a', 'sr.b', 'sr'])
+
+
+class TestGetDistinctValues(DBTestCase):
+
+    SCRATCH_TABLES = sorted(msd.scratch.TABLES)
+
+    def setUp(self):
+        super(TestGetDistinctValues, self).setUp()
+
+        insert_rows(self.scratch_db, 'company', [
+            dict(scraper_id='a', company='Foo', company_full='Foo Inc.'),
+            dict(scraper_id='a', company='Bar'),
+            dict(scraper_id='b', company='Foo', company_full='Foo Inc.'),
+        ])
+        insert_rows(self.scratch_db, 'brand', [
+            dict(scraper_id='a', company='Foo', brand='Fooz'),
+            dict(scraper_id='c', company='Baz', brand='Bazz'),
+        ])
+        insert_rows(self.scratch_db, 'subsidiary', [
+            dict(scraper_id='c', company='Baz', subsidiary='Qux'),
+        ])
+
+    def get_all_distinct_values(self):
+        return [get_distinct_values(self.scratch_db, cols)
+                for cols in msd.scratch.DISTINCT_VALUES_COLS]
+
+    def test_company(self):
+        self.assertEqual(
+            get_distinct_values(self.scratch_db, ['scraper_id', 'company']),
+            {('a', 'Bar'), ('a', 'Foo'), ('b', 'Foo'), ('c', 'Baz')})
+
+    def test_tables_same_as_scan(self):
+        scanned = self.get_all_distinct_values()
+
+        build_distinct_values_tables(self.scratch_db)
+
+        with patch.object(msd.scratch, 'scratch_tables_with_cols') as m:
+            self.assertEqual(self.get_all_distinct_values(), scanned)
+
+        # didn't need to scan any scratch tables
+        self.assertFalse(m.called)
+
+    def test_tables_with_nulls(self):
+        insert_rows(self.scratch_db, 'brand', [
+            dict(scraper_id=None, company='Qux', brand='Quxx'),
+        ])
+        insert_rows(self.scratch_db, 'subsidiary', [
+            dict(scraper_id=None, company='Qux', subsidiary='Qux Jr.'),
+        ])
+
+        scanned = self.get_all_distinct_values()
+        self.assertIn((None, 'Qux'), scanned[1])
+
+        build_distinct_values_tables(self.scratch_db)
+
+        self.assertEqual(self.get_all_distinct_values(), scanned)
+
+        # no duplicate rows, even though NULLs aren't equal in SQL
+        table_name = distinct_values_table_name(('scraper_id', 'company'))
+        self.assertEqual(
+            self.scratch_db.execute(
+                'SELECT COUNT(*) FROM `{}`'.format(table_name)).fetchone()[0],
+            len(scanned[1]))
+
+
+class TestBuildScratchDB(DBTestCase):
+
+    def setUp(self):
+        super(TestBuildScratchDB, self).setUp()
+
+        self.input_db_path = join(self.tmp_dir, 'sr.company.sqlite')
+        self.other_input_db_path = join(self.tmp_dir, 'sr.campaign.sqlite')
+
+        with open_db(self.other_input_db_path) as input_db:
+            input_db.execute(
+                'CREATE TABLE company (company text, scraper_id text)')
+
+            insert_rows(input_db, 'company', [
+                dict(company='Qux', scraper_id='ethical'),
+                dict(company='Bar', scraper_id='green'),
+            ])
+
+        with open_db(self.input_db_path) as input_db:
+            input_db.execute(
+                'CREATE TABLE company (company text, url text)')
+            input_db.execute(
+                'CREATE TABLE brand (company text, brand text)')
+
+            insert_rows(input_db, 'company', [
+                dict(company='Foo Inc.', url='http://foo.com'),
+                dict(company='Bar', url=None),
+            ])
+            insert_rows(input_db, 'brand', [
+                dict(company='Foo Inc.', brand='Fooz'),
+            ])
+
+    def build(self, name, input_db_paths=None, **kwargs):
+        scratch_db_path = join(self.tmp_dir, name)
+        build_scratch_db(scratch_db_path,
+                         input_db_paths or [self.input_db_path], **kwargs)
+
+        scratch_db = open_db(scratch_db_path)
+        self.addCleanup(scratch_db.close)
+        return scratch_db
+
+    def schema(self, db):
+        return sorted(
+            tuple(row) for row in
+            db.execute('SELECT type, name, tbl_name, sql FROM sqlite_master'))
+
+    def test_scratch_fingerprint(self):
+        self.build('msd-scratch.sqlite')
+        self.build('other-scratch.sqlite', jobs=2)
+        self.build('both-scratch.sqlite',
+                   [self.input_db_path, self.other_input_db_path])
+
+        def fingerprint(name):
+            return get_scratch_fingerprint(join(self.tmp_dir, name))
+
+        # same inputs
+        self.assertEqual(fingerprint('msd-scratch.sqlite'),
+                         fingerprint('other-scratch.sqlite'))
+
+        self.assertNotEqual(fingerprint('msd-scratch.sqlite'),
+                            fingerprint('both-scratch.sqlite'))
+
+    def test_defer_indexes_makes_same_db(self):
+        deferred_db = self.build('deferred.sqlite')
+        immediate_db = self.build('immediate.sqlite', defer_indexes=False)
+
+        self.assertEqual(self.schema(deferred_db), self.schema(immediate_db))
+
+        for table_name in ('brand', 'company'):
+            self.assertEqual(select_all(deferred_db, table_name),
+                             select_all(immediate_db, table_name))
+
+        self.assertEqual(
+            [row['company'] for row in select_all(deferred_db, 'company')],
+            ['Bar', 'Foo Inc.'])
+
+    def test_jobs_makes_same_db(self):
+        input_db_paths = [self.input_db_path, self.other_input_db_path]
+
+        serial_db = self.build('serial.sqlite', input_db_paths)
+        parallel_db = self.build('parallel.sqlite', input_db_paths, jobs=2)
+
+        self.assertEqual(self.schema(parallel_db), self.schema(serial_db))
+
+        for table_name in ('brand', 'company'):
+            self.assertEqual(
+                list(map(tuple, parallel_db.execute(
+                    'SELECT * FROM `{}` ORDER BY rowid'.format(table_name)))),
+                list(map(tuple, serial_db.execute(
+                    'SELECT * FROM `{}` ORDER BY rowid'.format(table_name)))))
+
+        # scraper_prefix includes the path to the input file
+        self.assertEqual(
+            sorted((row['scraper_id'][len(self.tmp_dir) + 1:], row['company'])
+                   for row in select_all(parallel_db, 'company')),
+            [('sr.campaign.ethical', 'Qux'),
+             ('sr.campaign.green', 'Bar'),
+             ('sr.company', 'Bar'),
+             ('sr.company', 'Foo Inc.')])
+
+    def rows_in_order(self, db, table_name):
+        return [tuple(row) for row in db.execute(
+            'SELECT * FROM `{}` ORDER BY rowid'.format(table_name))]
+
+    def test_dir_same_as_sqlite(self):
+        dir_path = join(self.tmp_dir, 'sr.company')
+        mkdir(dir_path)
+
+        with open(join(dir_path, 'company.jsonl'), 'w') as f:
+            f.write('{"company": "Foo Inc.", "url": "http://foo.com"}\n'
+                    '{"company": "Bar", "url": null}\n')
+        with gzip.open(join(dir_path, 'brand.csv.gz'), 'wt') as f:
+            f.write('company,brand\nFoo Inc.,Fooz\n')
+
+        sqlite_db = self.build('sqlite.sqlite', [self.input_db_path])
+        dir_db = self.build('dir.sqlite', [dir_path])
+
+        for table_name in ('brand', 'company'):
+            self.assertEqual(self.rows_in_order(dir_db, table_name),
+                             self.rows_in_order(sqlite_db, table_name))
+
+        # changing a file makes us reload the directory
+        with open(join(dir_path, 'company.jsonl'), 'a') as f:
+            f.write('{"company": "Baz"}\n')
+
+        with patch.object(msd.scratch, 'dump_input_to_scratch',
+                          wraps=msd.scratch.dump_input_to_scratch) as m:
+            dir_db = self.build('dir.sqlite', [dir_path])
+
+        self.assertTrue(m.called)
+        self.assertEqual(
+            [row['company'] for row in select_all(dir_db, 'company')],
+            ['Bar', 'Baz', 'Foo Inc.'])
+
+    def test_profile_makes_same_db(self):
+        input_db_paths = [self.input_db_path, self.other_input_db_path]
+
+        fast_db = self.build('fast.sqlite', input_db_paths, profile='fast')
+        safe_db = self.build('safe.sqlite', input_db_paths, profile='safe')
+
+        self.assertEqual(self.schema(fast_db), self.schema(safe_db))
+
+        for table_name in ('brand', 'company'):
+            self.assertEqual(self.rows_in_order(fast_db, table_name),
+                             self.rows_in_order(safe_db, table_name))
+
+    def test_unchanged_inputs_are_reused(self):
+        input_db_paths = [self.input_db_path, self.other_input_db_path]
+        self.build('msd-scratch.sqlite', input_db_paths).close()
+
+        with open_db(self.other_input_db_path) as input_db:
+            insert_rows(input_db, 'company', [
+                dict(company='Baz', scraper_id='ethical')])
+        input_db.close()
+
+        with patch.object(msd.scratch, 'dump_input_to_scratch',
+                          wraps=msd.scratch.dump_input_to_scratch) as m:
+            scratch_db = self.build('msd-scratch.sqlite', input_db_paths)
+
+        self.assertEqual([args[0] for args, kwargs in m.call_args_list],
+                         [self.other_input_db_path])
+
+        full_db = self.build('full.sqlite', input_db_paths)
+
+        for table_name in ('brand', 'company', 'input_fingerprint'):
+            self.assertEqual(self.rows_in_order(scratch_db, table_name),
+                             self.rows_in_order(full_db, table_name))
+
+    def test_duplicate_input(self):
+        input_db_paths = [self.input_db_path, self.input_db_path]
+
+        # rebuilding shouldn't copy the same namespace twice
+        for _ in range(3):
+            self.build('msd-scratch.sqlite', input_db_paths).close()
+
+        scratch_db = self.build('msd-scratch.sqlite', input_db_paths)
+        full_db = self.build('full.sqlite', input_db_paths, force=True)
+
+        for table_name in ('brand', 'company', 'input_fingerprint'):
+            self.assertEqual(self.rows_in_order(scratch_db, table_name),
+                             self.rows_in_order(full_db, table_name))
+
+        # loaded once per listing, like the first build
+        self.assertEqual(
+            [row['company'] for row in select_all(scratch_db, 'brand')],
+            ['Foo Inc.', 'Foo Inc.'])
+
+    def test_up_to_date(self):
+        self.build('msd-scratch.sqlite').close()
+
+        with patch.object(msd.scratch, 'dump_input_to_scratch') as m:
+            scratch_db = self.build('msd-scratch.sqlite')
+
+        self.assertFalse(m.called)
+        self.assertEqual(
+            [row['company'] for row in select_all(scratch_db, 'company')],
+            ['Bar', 'Foo Inc.'])
+
+    def test_force(self):
+        self.build('msd-scratch.sqlite').close()
+
+        with patch.object(msd.scratch, 'dump_input_to_scratch') as m:
+            self.build('msd-scratch.sqlite', force=True).close()
+
+        self.assertTrue(m.called)